@@ -0,0 +1,2 @@
+from .synthetic import synthetic_contacts, write_contacts, synthetic_map, compartment_track
+from .run import run_benchmarks, compare_results, BENCHMARKS
@@ -0,0 +1,223 @@
+"""
+Time and peak memory of the main pyHiC functions on synthetic data of several sizes.
+
+    python -m pyHiC.benchmarks run --sizes 1000 2000 5000 --output results.json
+    python -m pyHiC.benchmarks compare old.json new.json
+
+Each benchmark is timed "repeat" times (the best and the median are kept),
+then run once more under tracemalloc for the peak memory allocated by Python and numpy.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+import numpy as np
+import scipy
+from .synthetic import synthetic_contacts, write_contacts, synthetic_map
+
+
+BENCHMARKS = ['load_HiC[short]', 'load_HiC[long]', 'load_HiC[long.gz]',
+              'normalization[OE]', 'normalization[VC]', 'normalization[VC_SQRT]', 'normalization[KR]',
+              'normalization[IC]', 'iterativeCorrection', 'HiCRep', 'AB_compartment',
+              'visualize_HiC_triangle', 'visualize_HiC_epigenetics']
+
+
+def _benchmark_functions(n_bins, resolution, contacts_per_bin, seed, workdir):
+    """{name: function without arguments} for one map size; the input files and maps are made here."""
+    from ..loading import load_HiC
+    from ..normalization import normalization, iterativeCorrection
+    from ..reproducibility import HiCRep
+    from ..structures import AB_compartment
+    from ..visualization import visualize_HiC_triangle, visualize_HiC_epigenetics
+    import matplotlib.pyplot as plt
+
+    sizes = {'chr1': n_bins * resolution}
+    kwargs = dict(n_contacts=n_bins * contacts_per_bin, min_distance=resolution // 10, seed=seed)
+    files = {}
+    for fmt, gzip in [('short', False), ('long', False), ('long', True)]:
+        name = '{0}{1}'.format(fmt, '.gz' if gzip else '')
+        files[name] = os.path.join(workdir, 'chr1_{0}.{1}.txt{2}'.format(n_bins, fmt, '.gz' if gzip else ''))
+        write_contacts(synthetic_contacts(sizes, **kwargs), files[name], format=fmt, gzip=gzip)
+    mat = synthetic_map(n_bins, resolution, contacts_per_bin, seed=seed)
+    mat2 = synthetic_map(n_bins, resolution, contacts_per_bin, seed=seed + 1)
+    tracks = [np.asarray(mat.sum(axis=1)).ravel(), np.asarray(mat2.sum(axis=1)).ravel()]
+    figure = os.path.join(workdir, 'figure.png')
+
+    def _plot(func, *args):
+        def _run():
+            func(*args)
+            plt.close('all')
+        return _run
+
+    functions = {
+        'load_HiC[short]': lambda: load_HiC(files['short'], format='short', resolution=resolution),
+        'load_HiC[long]': lambda: load_HiC(files['long'], format='long', chromosome='chr1', resolution=resolution),
+        'load_HiC[long.gz]': lambda: load_HiC(files['long.gz'], format='long', chromosome='chr1',
+                                              resolution=resolution, gzip=True),
+        'iterativeCorrection': lambda: iterativeCorrection(mat, verbose=0),
+        'HiCRep': lambda: HiCRep(mat, mat2, n_strata=10, h=1),
+        'AB_compartment': lambda: AB_compartment(mat),
+        'visualize_HiC_triangle': _plot(visualize_HiC_triangle, mat, figure),
+        'visualize_HiC_epigenetics': _plot(visualize_HiC_epigenetics, mat, tracks, figure),
+    }
+    for method in ['OE', 'VC', 'VC_SQRT', 'KR', 'IC']:
+        kw = {'verbose': 0} if method in ['KR', 'IC'] else {}
+        functions['normalization[{0}]'.format(method)] = \
+            (lambda _m, _kw: lambda: normalization(mat, _m, **_kw))(method, kw)
+    return functions, int(mat.sum())
+
+
+def _measure(func, repeat):
+    """Seconds of each run, and the peak traced memory (MB) of one more run."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak / 2 ** 20
+
+
+def environment():
+    """Versions, machine and git commit of this run."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def run_benchmarks(sizes=(1000, 2000, 5000), resolution=10000, contacts_per_bin=200, benchmarks=None,
+                   repeat=3, seed=0, output=None, workdir=None, verbose=1):
+    """
+    Run the benchmarks on synthetic maps of several sizes.
+
+    Args:
+        sizes (list): numbers of bins. Default: (1000, 2000, 5000)
+        resolution (int): Default: 10000
+        contacts_per_bin (int): number of read pairs / number of bins. Default: 200
+        benchmarks (list or None): names in BENCHMARKS (None: all). Default: None
+        repeat (int): number of timed runs. Default: 3
+        seed (int): random seed of the synthetic data. Default: 0
+        output (str or None): save the results as JSON. Default: None
+        workdir (str or None): folder of the synthetic files. Default: None (a temporary folder)
+        verbose (int): print each result. Default: 1
+
+    Return:
+        dict {"environment": ..., "settings": ..., "results": [{"name", "n_bins", "resolution", "contacts",
+        "times", "best", "median", "peak_mb"}]}
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    names = BENCHMARKS if benchmarks is None else list(benchmarks)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark: {0}. Choose from {1}'.format(name, BENCHMARKS))
+    report = {'environment': environment(),
+              'settings': {'sizes': list(sizes), 'resolution': resolution, 'contacts_per_bin': contacts_per_bin,
+                           'repeat': repeat, 'seed': seed},
+              'results': []}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_bins in sizes:
+            functions, contacts = _benchmark_functions(n_bins, resolution, contacts_per_bin, seed, workdir or tmp)
+            for name in names:
+                # The progress prints of the functions are not part of the results
+                with contextlib.redirect_stdout(io.StringIO()):
+                    times, peak = _measure(functions[name], repeat)
+                result = {'name': name, 'n_bins': n_bins, 'resolution': resolution, 'contacts': contacts,
+                          'times': times, 'best': min(times), 'median': float(np.median(times)), 'peak_mb': peak}
+                report['results'].append(result)
+                if verbose:
+                    print('{0:<28s} {1:>7d} bins  {2:9.4f} s  {3:9.1f} MB'.format(name, n_bins, min(times), peak))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+def compare_results(old, new, threshold=1.2, verbose=1):
+    """
+    Compare two benchmark reports (dicts or JSON files) by the best time and the peak memory.
+
+    Args:
+        old, new (dict or str): reports of run_benchmarks
+        threshold (float): a ratio new / old above it is a regression. Default: 1.2
+
+    Return:
+        list of (name, n_bins, "time" or "memory", old value, new value, ratio) of the regressions
+    """
+    reports = []
+    for report in [old, new]:
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append({(r['name'], r['n_bins']): r for r in report['results']})
+    old, new = reports
+    regressions = []
+    if verbose:
+        print('{0:<28s} {1:>7s} {2:>10s} {3:>10s} {4:>7s} {5:>10s} {6:>10s} {7:>7s}'.format(
+            'benchmark', 'bins', 'old (s)', 'new (s)', 'ratio', 'old (MB)', 'new (MB)', 'ratio'))
+    for key in [k for k in new if k in old]:
+        t_ratio = new[key]['best'] / max(old[key]['best'], 1e-12)
+        m_ratio = new[key]['peak_mb'] / max(old[key]['peak_mb'], 1e-12)
+        if t_ratio > threshold:
+            regressions.append(key + ('time', old[key]['best'], new[key]['best'], t_ratio))
+        if m_ratio > threshold:
+            regressions.append(key + ('memory', old[key]['peak_mb'], new[key]['peak_mb'], m_ratio))
+        if verbose:
+            print('{0:<28s} {1:>7d} {2:10.4f} {3:10.4f} {4:7.2f} {5:10.1f} {6:10.1f} {7:7.2f}{8}'.format(
+                key[0], key[1], old[key]['best'], new[key]['best'], t_ratio, old[key]['peak_mb'],
+                new[key]['peak_mb'], m_ratio, '  <-' if max(t_ratio, m_ratio) > threshold else ''))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m pyHiC.benchmarks', description='pyHiC benchmarks')
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run', help='run the benchmarks')
+    run.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 5000], help='numbers of bins')
+    run.add_argument('--resolution', type=int, default=10000)
+    run.add_argument('--contacts-per-bin', type=int, default=200)
+    run.add_argument('--benchmarks', nargs='+', default=None, help='any of: ' + ' '.join(BENCHMARKS))
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', default='benchmarks.json')
+    run.add_argument('--workdir', default=None, help='keep the synthetic files in this folder')
+    compare = sub.add_parser('compare', help='compare two results')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        if args.workdir:
+            os.makedirs(args.workdir, exist_ok=True)
+        run_benchmarks(args.sizes, args.resolution, args.contacts_per_bin, args.benchmarks, args.repeat,
+                       args.seed, args.output, args.workdir)
+        return 0
+    if args.command == 'compare':
+        return 1 if compare_results(args.old, args.new, args.threshold) else 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
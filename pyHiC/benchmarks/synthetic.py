@@ -0,0 +1,196 @@
+"""
+Seeded synthetic Hi-C contacts with a power-law distance decay and A/B compartments.
+
+Intra-chromosomal contacts: the distance s follows P(s) ~ s ** decay (between min_distance and the chromosome length),
+the first end is uniform on the chromosome, and pairs in different compartments are kept with a lower probability.
+Inter-chromosomal contacts: uniform on two chromosomes chosen proportional to their lengths.
+"""
+
+import gzip as gz
+import numpy as np
+import scipy.sparse as sp
+
+
+def _distances(rng, n, min_distance, max_distance, decay):
+    """Sample n distances from P(s) ~ s ** decay on [min_distance, max_distance) by inverting the CDF."""
+    u = rng.random(n)
+    if abs(decay + 1) < 1e-9:
+        return (min_distance * (max_distance / min_distance) ** u).astype(np.int64)
+    a = decay + 1
+    return ((min_distance ** a + u * (max_distance ** a - min_distance ** a)) ** (1 / a)).astype(np.int64)
+
+
+def compartment_track(length, compartment_size=2000000, seed=0):
+    """
+    Random alternating A (+1) / B (-1) segments with exponential lengths (mean: compartment_size).
+
+    Return:
+        breakpoints (numpy.array of segment starts), signs (numpy.array)
+    """
+    rng = np.random.default_rng(seed)
+    starts = [0]
+    while starts[-1] < length:
+        starts.append(starts[-1] + max(int(rng.exponential(compartment_size)), 1))
+    starts = np.array(starts[:-1])
+    signs = np.where(np.arange(len(starts)) % 2 == 0, 1, -1) * rng.choice([-1, 1])
+    return starts, signs
+
+
+def _cis_contacts(rng, length, n, decay, min_distance, track, compartment_strength):
+    """n intra-chromosomal pairs (pos1 <= pos2)."""
+    starts, signs = track
+    keep_opposite = (1 - compartment_strength) / (1 + compartment_strength)
+    p1s, p2s, n_done = [], [], 0
+    while n_done < n:
+        m = int((n - n_done) * 1.2 / (0.5 + 0.5 * keep_opposite)) + 16
+        s = _distances(rng, m, min_distance, max(length, min_distance + 1), decay)
+        s = s[s < length]
+        p1 = (rng.random(len(s)) * (length - s)).astype(np.int64)
+        p2 = p1 + s
+        same = signs[np.searchsorted(starts, p1, side='right') - 1] == \
+            signs[np.searchsorted(starts, p2, side='right') - 1]
+        keep = same | (rng.random(len(s)) < keep_opposite)
+        p1s.append(p1[keep][:n - n_done])
+        p2s.append(p2[keep][:n - n_done])
+        n_done += len(p1s[-1])
+    return np.concatenate(p1s), np.concatenate(p2s)
+
+
+def _bin_pairs(p1, p2, resolution):
+    """Aggregate pairs into pixels at bin starts; return pos1, pos2, count sorted by (pos1, pos2)."""
+    b1, b2 = p1 // resolution, p2 // resolution
+    n = int(max(b1.max(initial=0), b2.max(initial=0))) + 1
+    keys, counts = np.unique(b1 * n + b2, return_counts=True)
+    return keys // n * resolution, keys % n * resolution, counts
+
+
+def synthetic_contacts(chrom_sizes, n_contacts=1000000, resolution=None, decay=-1.0, min_distance=1000,
+                       trans_fraction=0.1, compartment_size=2000000, compartment_strength=0.3,
+                       chunk_size=1000000, seed=0):
+    """
+    Generate synthetic contacts, chromosome by chromosome (then the inter-chromosomal ones).
+
+    Args:
+        chrom_sizes (dict): {chromosome: length (bp)}
+        n_contacts (int): total number of read pairs. Default: 1000000
+        resolution (int or None): if given, pairs are binned and each chunk is a pixel list (positions at bin starts)
+            with counts; if None, each pair is one contact with a count of 1. Default: None
+        decay (float): exponent of the distance decay P(s) ~ s ** decay. Default: -1.0
+        min_distance (int): the smallest distance (bp). Default: 1000
+        trans_fraction (float): fraction of inter-chromosomal pairs. Default: 0.1
+        compartment_size (int): mean length of A / B segments. Default: 2000000
+        compartment_strength (float): 0 (no compartments) to 1 (no contacts between A and B). Default: 0.3
+        chunk_size (int): max number of pairs generated at once. Default: 1000000
+        seed (int): random seed. Default: 0
+
+    Yield:
+        dict {"chrom1", "pos1", "chrom2", "pos2", "count"} (chrom1 / chrom2 are str, or numpy.array for trans chunks)
+    """
+    rng = np.random.default_rng(seed)
+    names = list(chrom_sizes.keys())
+    lengths = np.array([chrom_sizes[ch] for ch in names], dtype=float)
+    n_cis = np.round(n_contacts * (1 - trans_fraction) * lengths / lengths.sum()).astype(np.int64) \
+        if len(names) > 1 else np.array([n_contacts])
+
+    for i, ch in enumerate(names):
+        track = compartment_track(chrom_sizes[ch], compartment_size, seed=seed + i + 1)
+        pos1, pos2 = [], []
+        for st in range(0, n_cis[i], chunk_size):
+            p1, p2 = _cis_contacts(rng, chrom_sizes[ch], min(chunk_size, n_cis[i] - st), decay, min_distance,
+                                   track, compartment_strength)
+            if resolution is None:
+                yield {'chrom1': ch, 'pos1': p1, 'chrom2': ch, 'pos2': p2, 'count': np.ones((len(p1),))}
+            else:
+                pos1.append(p1)
+                pos2.append(p2)
+        if resolution is not None and pos1:
+            # Pixels are aggregated over all chunks of the chromosome
+            p1, p2, counts = _bin_pairs(np.concatenate(pos1), np.concatenate(pos2), resolution)
+            yield {'chrom1': ch, 'pos1': p1, 'chrom2': ch, 'pos2': p2, 'count': counts.astype(float)}
+
+    if len(names) > 1:
+        n_trans = n_contacts - int(n_cis.sum())
+        probs = lengths / lengths.sum()
+        for st in range(0, max(n_trans, 0), chunk_size):
+            m = min(chunk_size, n_trans - st)
+            c1, c2 = np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+            while len(c1) < m:
+                a, b = rng.choice(len(names), 2 * m, p=probs), rng.choice(len(names), 2 * m, p=probs)
+                ok = a != b
+                c1, c2 = np.concatenate([c1, np.minimum(a[ok], b[ok])]), np.concatenate([c2, np.maximum(a[ok], b[ok])])
+            c1, c2 = c1[:m], c2[:m]
+            p1 = (rng.random(len(c1)) * lengths[c1]).astype(np.int64)
+            p2 = (rng.random(len(c2)) * lengths[c2]).astype(np.int64)
+            if resolution is not None:
+                p1, p2 = p1 // resolution * resolution, p2 // resolution * resolution
+            yield {'chrom1': np.array(names)[c1], 'pos1': p1, 'chrom2': np.array(names)[c2], 'pos2': p2,
+                   'count': np.ones((len(p1),))}
+
+
+def write_contacts(chunks, file, format='long', gzip=False):
+    """
+    Write contacts (e.g., from synthetic_contacts) into a text file readable by pyHiC.loading.load_HiC.
+
+    Args:
+        chunks (iterable): dicts {"chrom1", "pos1", "chrom2", "pos2", "count"}
+        file (str): output file
+        format (str): "long" (chr1 pos1 chr2 pos2 count) or "short" (pos1 pos2 count; only the
+            intra-chromosomal contacts of the first chromosome are written). Default: "long"
+        gzip (bool): whether zip the file. Default: False
+
+    Return:
+        number of lines written
+    """
+    if format not in ['long', 'short']:
+        raise ValueError('Unrecognized format: ' + format)
+    n_lines, first = 0, None
+    with (gz.open(file, 'wt', compresslevel=3) if gzip else open(file, 'w')) as f:
+        for chunk in chunks:
+            c1, c2 = chunk['chrom1'], chunk['chrom2']
+            count = chunk['count']
+            count = count.astype(np.int64) if np.all(count == np.round(count)) else count
+            if format == 'short':
+                if not isinstance(c1, str) or c1 != c2:
+                    continue
+                first = c1 if first is None else first
+                if c1 != first:
+                    continue
+                lines = '\n'.join('{0} {1} {2}'.format(*row) for row in
+                                  zip(chunk['pos1'].tolist(), chunk['pos2'].tolist(), count.tolist()))
+            else:
+                n = len(chunk['pos1'])
+                c1 = np.full(n, c1) if isinstance(c1, str) else c1
+                c2 = np.full(n, c2) if isinstance(c2, str) else c2
+                lines = '\n'.join('{0} {1} {2} {3} {4}'.format(*row) for row in
+                                  zip(c1.tolist(), chunk['pos1'].tolist(), c2.tolist(), chunk['pos2'].tolist(),
+                                      count.tolist()))
+            if lines:
+                f.write(lines + '\n')
+                n_lines += lines.count('\n') + 1
+    return n_lines
+
+
+def synthetic_map(n_bins, resolution=10000, contacts_per_bin=200, seed=0, **kwargs):
+    """
+    Synthetic contact map of one chromosome (n_bins bins), the same as loading a synthetic file
+    (without the epsilon diagonal added by the loaders).
+
+    Args:
+        n_bins (int): number of bins
+        resolution (int): Default: 10000
+        contacts_per_bin (int): number of read pairs / n_bins. Default: 200
+        seed (int): Default: 0
+        kwargs: other arguments of synthetic_contacts
+
+    Return:
+        scipy.sparse.csr_matrix (symmetric)
+    """
+    kwargs.setdefault('min_distance', resolution // 10)
+    mat = None
+    for chunk in synthetic_contacts({'chr1': n_bins * resolution}, n_bins * contacts_per_bin,
+                                    resolution=resolution, seed=seed, **kwargs):
+        m = sp.coo_matrix((chunk['count'], (chunk['pos1'] // resolution, chunk['pos2'] // resolution)),
+                          shape=(n_bins, n_bins)).tocsr()
+        mat = m if mat is None else mat + m
+    mat = mat + sp.triu(mat, 1).T
+    return sp.csr_matrix(mat)
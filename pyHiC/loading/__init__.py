@@ -1 +1,4 @@
-from .loading import load_HiC
+from .loading import load_HiC, load_HiC_genome, read_chrom_sizes, convert_to_store
+from .store import ContactStore
+from .hic import HiCFile
+from .pairs import ingest_pairs, read_pairs_header, PairsFile
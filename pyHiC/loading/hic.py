@@ -0,0 +1,380 @@
+"""
+Reader of Juicer .hic files (versions 6 - 9), without Java or intermediate text files.
+
+Only the header and the footer (master index) are read when opening a file. The first query of a
+chromosome pair reads the block index of its matrix; a region query then decompresses the zlib blocks
+overlapping the region at the requested resolution and nothing else.
+
+Layout (little-endian; "str" is null-terminated):
+    header      "HIC", version, footer position, genome, [v9: norm index position & length],
+                attributes, chromosomes (name, length), base-pair resolutions, fragment resolutions
+    footer      master index {"<chr1 index>_<chr2 index>": matrix position}, expected values,
+                normalized expected values, normalization vector index
+    matrix      chromosome indices, and for each resolution: bin size, block size and the block index
+                {block number: (position, size)}
+    block       zlib-compressed records (binX, binY, count) of a square of bins;
+                binX is on the first chromosome, binY on the second, binX <= binY for intra-chromosomal maps
+"""
+
+import zlib
+import struct
+import numpy as np
+import scipy.sparse as sp
+
+
+MAGIC = b'HIC'
+
+
+class _FileReader:
+    """Read little-endian values from a binary file."""
+    def __init__(self, f):
+        self.f = f
+
+    def _unpack(self, fmt, size):
+        return struct.unpack(fmt, self.f.read(size))[0]
+
+    def int8(self):
+        return self._unpack('<b', 1)
+
+    def int32(self):
+        return self._unpack('<i', 4)
+
+    def int64(self):
+        return self._unpack('<q', 8)
+
+    def float32(self):
+        return self._unpack('<f', 4)
+
+    def string(self):
+        chars = bytearray()
+        while True:
+            c = self.f.read(1)
+            if c in (b'\x00', b''):
+                return chars.decode('utf-8', errors='replace')
+            chars += c
+
+    def skip(self, n_bytes):
+        self.f.seek(n_bytes, 1)
+
+
+class _BufferReader:
+    """Read little-endian values from a decompressed block."""
+    def __init__(self, data):
+        self.data, self.pos = data, 0
+
+    def _unpack(self, fmt, size):
+        value = struct.unpack_from(fmt, self.data, self.pos)[0]
+        self.pos += size
+        return value
+
+    def int8(self):
+        return self._unpack('<b', 1)
+
+    def int16(self):
+        return self._unpack('<h', 2)
+
+    def int32(self):
+        return self._unpack('<i', 4)
+
+    def array(self, dtype, count):
+        values = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.pos)
+        self.pos += values.nbytes
+        return values
+
+
+def _parse_block(data, version):
+    """Records of a decompressed block. Return binX, binY (numpy.array of int64), count (numpy.array)."""
+    buf = _BufferReader(data)
+    n_records = buf.int32()
+    if version < 7:
+        rec = buf.array(np.dtype([('x', '<i4'), ('y', '<i4'), ('v', '<f4')]), n_records)
+        return rec['x'].astype(np.int64), rec['y'].astype(np.int64), rec['v'].astype(np.float64)
+
+    x_offset, y_offset = buf.int32(), buf.int32()
+    # Flags: 0 for 16-bit values, 1 for 32-bit values (float counts / int bins)
+    short_count = buf.int8() == 0
+    short_x, short_y = (buf.int8() == 0, buf.int8() == 0) if version > 8 else (True, True)
+    block_type = buf.int8()
+    count_type = '<i2' if short_count else '<f4'
+
+    if block_type == 1:
+        # Rows of binY, each with its list of (binX, count)
+        read_y = buf.int16 if short_y else buf.int32
+        read_n = buf.int16 if short_x else buf.int32
+        record = np.dtype([('x', '<i2' if short_x else '<i4'), ('v', count_type)])
+        xs, ys, vs = [], [], []
+        for _ in range(read_y()):
+            y = read_y()
+            rec = buf.array(record, read_n())
+            xs.append(rec['x'])
+            vs.append(rec['v'])
+            ys.append(np.full((len(rec),), y, dtype=np.int64))
+        if not xs:
+            return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64), np.zeros((0,))
+        x = np.concatenate(xs).astype(np.int64) + x_offset
+        y = np.concatenate(ys) + y_offset
+        v = np.concatenate(vs).astype(np.float64)
+        return x, y, v
+
+    if block_type == 2:
+        # A dense w-column square of counts (missing values: -32768 or NaN)
+        n_points, width = buf.int32(), buf.int16()
+        values = buf.array(count_type, n_points)
+        keep = np.flatnonzero(values != -32768) if short_count else np.flatnonzero(~np.isnan(values))
+        return keep % width + x_offset, keep // width + y_offset, values[keep].astype(np.float64)
+
+    raise ValueError('Unknown block type: {0}'.format(block_type))
+
+
+class HiCFile:
+    """
+    Read-only access to a .hic file.
+
+    Args:
+        path (str): the .hic file
+
+    Attributes:
+        version (int), genome (str), attributes (dict),
+        chromosomes (dict): {chromosome: length (bp)},
+        resolutions (list): base-pair resolutions
+    """
+    def __init__(self, path):
+        self.path = path
+        self._matrices = {}
+        self._norm_index = None
+        with open(path, 'rb') as f:
+            r = _FileReader(f)
+            if f.read(4) != MAGIC + b'\x00':
+                raise ValueError('Not a .hic file: ' + path)
+            self.version = r.int32()
+            if self.version < 6:
+                raise ValueError('.hic version {0} is not supported (6 - 9 only)'.format(self.version))
+            self._footer_position = r.int64()
+            self.genome = r.string()
+            if self.version > 8:
+                r.int64(), r.int64()
+            self.attributes = {}
+            for _ in range(r.int32()):
+                key = r.string()
+                self.attributes[key] = r.string()
+            self._names = []
+            self.chromosomes = {}
+            for _ in range(r.int32()):
+                name = r.string()
+                length = r.int64() if self.version > 8 else r.int32()
+                self._names.append(name)
+                if name.lower() != 'all':
+                    self.chromosomes[name] = length
+            self.resolutions = [r.int32() for _ in range(r.int32())]
+
+            f.seek(self._footer_position)
+            r.int64() if self.version > 8 else r.int32()
+            self._master = {}
+            for _ in range(r.int32()):
+                key = r.string()
+                position = r.int64()
+                r.int32()
+                self._master[key] = position
+            # The expected values and the normalization vector index follow; they are read when needed
+            self._after_master = f.tell()
+
+    def __repr__(self):
+        return 'HiCFile({0}, version={1}, {2} chromosomes, resolutions={3})'.format(
+            self.path, self.version, len(self.chromosomes), self.resolutions)
+
+    def _chromosome(self, name):
+        """Index of a chromosome; "chr1" and "1" are the same."""
+        for candidate in [name, name[3:] if name.lower().startswith('chr') else 'chr' + name]:
+            if candidate in self._names and candidate.lower() != 'all':
+                return self._names.index(candidate)
+        raise ValueError('Chromosome not in the .hic file: {0}'.format(name))
+
+    def _zoom(self, i, j, resolution):
+        """Block index of the matrix of chromosomes i <= j at a resolution, or None if there is no contact."""
+        if resolution not in self.resolutions:
+            raise ValueError('Resolution {0} is not in the .hic file. Choose from {1}'.format(
+                resolution, self.resolutions))
+        key = (i, j, resolution)
+        if key not in self._matrices:
+            self._matrices[key] = None
+            position = self._master.get('{0}_{1}'.format(i, j))
+            if position is not None:
+                with open(self.path, 'rb') as f:
+                    f.seek(position)
+                    self._read_matrix(_FileReader(f), i, j)
+        return self._matrices[key]
+
+    def _read_matrix(self, r, i, j):
+        r.int32(), r.int32()
+        for _ in range(r.int32()):
+            unit = r.string()
+            r.int32()
+            for _ in range(4):
+                # sum of counts, occupied cells, standard deviation, 95th percentile
+                r.float32()
+            bin_size, block_bin_count, block_column_count = r.int32(), r.int32(), r.int32()
+            blocks = {}
+            for _ in range(r.int32()):
+                number = r.int32()
+                position = r.int64()
+                blocks[number] = (position, r.int32())
+            if unit == 'BP':
+                self._matrices[(i, j, bin_size)] = {'block_bin_count': block_bin_count,
+                                                    'block_column_count': block_column_count, 'blocks': blocks}
+
+    def _block_numbers(self, zoom, x0, x1, y0, y1, intra):
+        """Numbers of the blocks which may hold the bins x0 <= binX <= x1 and y0 <= binY <= y1."""
+        size, n_columns = zoom['block_bin_count'], zoom['block_column_count']
+        if intra and self.version > 8:
+            # Version 9 numbers the intra-chromosomal blocks by their position along the diagonal and their depth
+            lower_pad, higher_pad = (x0 + y0) // 2 // size, (x1 + y1) // 2 // size + 1
+            nearer = int(np.log2(1 + abs(x0 - y1) / np.sqrt(2) / size))
+            further = int(np.log2(1 + abs(x1 - y0) / np.sqrt(2) / size))
+            nearer, further = min(nearer, further), max(nearer, further) + 1
+            if (x0 > y1 and x1 < y0) or (x1 > y0 and x0 < y1):
+                nearer = 0
+            return {depth * n_columns + pad for depth in range(nearer, further + 1)
+                    for pad in range(lower_pad, higher_pad + 1)}
+        numbers = {row * n_columns + col for row in range(y0 // size, y1 // size + 1)
+                   for col in range(x0 // size, x1 // size + 1)}
+        if intra:
+            numbers |= {row * n_columns + col for row in range(x0 // size, x1 // size + 1)
+                        for col in range(y0 // size, y1 // size + 1)}
+        return numbers
+
+    def _records(self, i, j, resolution, x0, x1, y0, y1):
+        """Stored records (binX, binY, count) of the matrix i <= j in the bins x0..x1 and y0..y1 (inclusive)."""
+        zoom = self._zoom(i, j, resolution)
+        empty = np.zeros((0,), dtype=np.int64)
+        if zoom is None or x1 < x0 or y1 < y0:
+            return empty, empty, np.zeros((0,))
+        numbers = sorted(self._block_numbers(zoom, x0, x1, y0, y1, i == j) & set(zoom['blocks']))
+        xs, ys, vs = [empty], [empty], [np.zeros((0,))]
+        with open(self.path, 'rb') as f:
+            for number in numbers:
+                position, size = zoom['blocks'][number]
+                f.seek(position)
+                x, y, v = _parse_block(zlib.decompress(f.read(size)), self.version)
+                xs.append(x)
+                ys.append(y)
+                vs.append(v)
+        x, y, v = np.concatenate(xs), np.concatenate(ys), np.concatenate(vs)
+        if i == j:
+            x, y = np.minimum(x, y), np.maximum(x, y)
+        return x, y, v
+
+    def bin_range(self, chrom, start=0, end=-1, resolution=10000):
+        """The bins [bin_start, bin_end) of a region at a resolution (see ContactStore.bin_range)."""
+        n = int(np.ceil(self.chromosomes[self._names[self._chromosome(chrom)]] / resolution))
+        b0 = max(start // resolution, 0)
+        b1 = n if end == -1 or end is None else min(int(np.ceil(end / resolution)), n)
+        return b0, max(b1, b0)
+
+    def pixels(self, chrom, start=0, end=-1, chrom2=None, start2=None, end2=None, resolution=10000):
+        """
+        Pixels of a region, as bin indices relative to the start of the region (see ContactStore.pixels).
+
+        Return:
+            bin1, bin2, count (numpy.array), shape (tuple)
+        """
+        chrom2 = chrom if chrom2 is None else chrom2
+        if start2 is None and end2 is None and chrom2 == chrom:
+            start2, end2 = start, end
+        start2 = 0 if start2 is None else start2
+        end2 = -1 if end2 is None else end2
+        i, j = self._chromosome(chrom), self._chromosome(chrom2)
+        r0, r1 = self.bin_range(chrom, start, end, resolution)
+        c0, c1 = self.bin_range(chrom2, start2, end2, resolution)
+        shape = (r1 - r0, c1 - c0)
+
+        if i == j:
+            # Stored upper-triangle pixels in rows [r0, r1) and columns [c0, c1), and the mirrored ones
+            x, y, v = self._records(i, i, resolution, r0, r1 - 1, c0, c1 - 1)
+            upper = (x >= r0) & (x < r1) & (y >= c0) & (y < c1)
+            lower = (y >= r0) & (y < r1) & (x >= c0) & (x < c1) & (x != y)
+            b1, b2 = np.concatenate([x[upper], y[lower]]), np.concatenate([y[upper], x[lower]])
+            v = np.concatenate([v[upper], v[lower]])
+        elif i < j:
+            x, y, v = self._records(i, j, resolution, r0, r1 - 1, c0, c1 - 1)
+            keep = (x >= r0) & (x < r1) & (y >= c0) & (y < c1)
+            b1, b2, v = x[keep], y[keep], v[keep]
+        else:
+            x, y, v = self._records(j, i, resolution, c0, c1 - 1, r0, r1 - 1)
+            keep = (x >= c0) & (x < c1) & (y >= r0) & (y < r1)
+            b1, b2, v = y[keep], x[keep], v[keep]
+        return b1 - r0, b2 - c0, v, shape
+
+    def query(self, chrom, start=0, end=-1, chrom2=None, start2=None, end2=None, resolution=10000, sparse=True):
+        """
+        Raw contact map of a region (see ContactStore.query).
+
+        Return:
+            HiC contact matrix (numpy.array or scipy.sparse.csr_matrix)
+        """
+        b1, b2, v, shape = self.pixels(chrom, start, end, chrom2, start2, end2, resolution)
+        mat = sp.csr_matrix((v, (b1, b2)), shape=shape)
+        return mat if sparse else mat.toarray()
+
+    def _read_norm_index(self):
+        """{(type, chromosome index, resolution): (position, size)} of the normalization vectors (BP only)."""
+        if self._norm_index is not None:
+            return self._norm_index
+        wide = self.version > 8
+        value_size = 4 if wide else 8
+        self._norm_index = {}
+        with open(self.path, 'rb') as f:
+            r = _FileReader(f)
+            f.seek(self._after_master)
+            try:
+                for normalized in [False, True]:
+                    # Expected values (then the normalized ones), skipped
+                    for _ in range(r.int32()):
+                        if normalized:
+                            r.string()
+                        r.string(), r.int32()
+                        r.skip((r.int64() if wide else r.int32()) * value_size)
+                        r.skip(r.int32() * (4 + value_size))
+                for _ in range(r.int32()):
+                    norm, chrom, unit, resolution = r.string(), r.int32(), r.string(), r.int32()
+                    position = r.int64()
+                    size = r.int64() if wide else r.int32()
+                    if unit == 'BP':
+                        self._norm_index[(norm, chrom, resolution)] = (position, size)
+            except struct.error:
+                # Files without normalization end after the expected values
+                pass
+        return self._norm_index
+
+    @property
+    def norms(self):
+        """Types of the stored normalization vectors (e.g., "KR", "VC", "VC_SQRT", "SCALE")."""
+        return sorted({key[0] for key in self._read_norm_index()})
+
+    def norm_vector(self, norm, chrom, resolution=10000):
+        """
+        A stored normalization vector of one chromosome (normalized = raw / (vector[i] * vector[j])).
+
+        Args:
+            norm (str): e.g., "KR", "VC", "VC_SQRT" or "SCALE"
+            chrom (str): chromosome
+            resolution (int): Default: 10000
+
+        Return:
+            numpy.array (one value for each bin; NaN for removed bins)
+        """
+        i = self._chromosome(chrom)
+        key = (norm, i, resolution)
+        index = self._read_norm_index()
+        if key not in index:
+            raise ValueError('No {0} vector of {1} at {2} in the .hic file. Available: {3}'.format(
+                norm, chrom, resolution, self.norms))
+        with open(self.path, 'rb') as f:
+            r = _FileReader(f)
+            f.seek(index[key][0])
+            n = r.int64() if self.version > 8 else r.int32()
+            vector = np.frombuffer(f.read(n * (4 if self.version > 8 else 8)),
+                                   dtype='<f4' if self.version > 8 else '<f8').astype(np.float64)
+        n_bins = self.bin_range(chrom, 0, -1, resolution)[1]
+        vector = np.concatenate([vector[:n_bins], np.full((max(n_bins - len(vector), 0),), np.nan)])
+        vector[vector == 0] = np.nan
+        return vector
@@ -5,57 +5,46 @@ Used by other functions.
 
 import numpy as np
 import scipy.sparse as sp
-import networkx as nx
-import gzip as gz
-
-
-def file_line_generator(file, chrom=None, header=False, format=None, gzip=False):
-    if len(format) == 3:
-        format = [0, format[0], 0, format[1], format[2]]
-    count = 0
-    f = gz.open(file) if gzip else open(file)
-    if header:
-        next(f)
-    for line in f:
-        count += 1
-        if count % 100000 == 0:
-            print('Line: ', count)
-
-        lst = line.strip().split()
-        if len(format) not in [4, 5]:
-            raise ValueError('Wrong custom format!')
-        if format[0] != 0 and format[2] != 0:
-            c1, c2 = lst[format[0]-1], lst[format[2]-1]
-            if c1 != chrom or c2 != chrom:
-                continue
-        p1, p2 = int(lst[format[1]-1]), int(lst[format[3]-1])
-        if len(format) == 4:
-            v = 1
-        else:
-            v = float(lst[format[4]-1])
-        yield p1, p2, v
+from .parsing import file_lines_generator, file_block_generator, COOAccumulator, bin_contacts, parse_format, \
+    group_contacts
+from .parallel import parallel_load
+from .store import ContactStore, save_to_store, write_store
+from .hic import HiCFile
+from .pairs import region_pairs, ingest_pairs
+from ..utils import BandMatrix
+from ..utils.instrument import phase
 
 
 def load_HiC(file, format=None, custom_format=None, header=False,
              chromosome=None, start_pos=0, end_pos=-1,
-             resolution=10000, gzip=False, sparse=True):
+             resolution=10000, gzip=False, sparse=True, n_workers=1, max_distance=None, norm=None):
     """
     Load the contact matrix of one chromosome (or part of one chromosome) from a HiC file
 
     Args:
         file: (str) file name;
-        format: (str or None) default: None. "short" / "Short", "long" / "Long", "noscore" / "NoScore", "npy" or "npz". If customized, leave it "None".
+        format: (str or None) default: None. "short" / "Short", "long" / "Long", "noscore" / "NoScore", "npy", "npz", "store", "hic" or "pairs" (4DN .pairs file, or its sorted copy from ingest_pairs). If customized, leave it "None".
         custom_format: (str or list or None) default: None. For customized input, provide the indices like "2356"".
         header: (bool or None) default: None. For customized input, whether the file has a header line.
         chromosome: (str) default: None. For formats other than "short", give the chromosome you would like to extract, eg. "chr1".
-        start_pos & end_pos: (int) default: 0 and -1. (0: start, -1: end).
-        resolution: (int) default: 10000.
-        gzip (bool): whether zipped file. Default: False
+        start_pos & end_pos: (int) default: 0 and -1. (0: start, -1: end). For "store" and "hic", rounded to the bins of the file.
+        resolution: (int) default: 10000. For "store", must match the resolution of the store; for "hic", one of its resolutions.
+        gzip (bool): whether zipped file. Default: False (for "pairs", also True if the file name ends with .gz)
         sparse: (bool) default: True. If True, store with scipy.sparse.csr_matrix; if false, with numpy.array.
+        n_workers: (int or None) default: 1. Number of processes for parsing text files (None: number of CPUs).
+            Plain files are split into byte ranges; zipped files are decompressed ahead by the main process.
+        max_distance: (int or None) default: None. If given, only keep the contacts within this distance (in base pairs)
+            and return a pyHiC.utils.BandMatrix with max_distance // resolution + 1 diagonals ("sparse" is ignored).
+        norm: (str or None) default: None. For "hic", also return a normalization vector stored in the file
+            ("KR", "VC", "VC_SQRT", "SCALE", ...) for the bins of the region (normalized = mat / (norm[i] * norm[j])).
 
     Return:
-         HiC contact matrix (numpy.array or scipy.sparse.csr_matrix)
+         HiC contact matrix (numpy.array or scipy.sparse.csr_matrix or pyHiC.utils.BandMatrix),
+         and the normalization vector (numpy.array) if norm is given
     """
+    n_diagonals = None if max_distance is None else max_distance // resolution + 1
+    if norm is not None and format != 'hic':
+        raise ValueError('Stored normalization vectors are only in .hic files!')
 
     if format in ['npy', 'npz']:
         if format == 'npy':
@@ -69,53 +58,219 @@ def load_HiC(file, format=None, custom_format=None, header=False,
             if sparse and not isinstance(mat, sp.csr_matrix):
                 mat = mat.tocsr()
 
+    elif format == 'store':
+        store = ContactStore(file)
+        if resolution != store.resolution:
+            raise ValueError('Resolution {0} does not match the store ({1})!'.format(resolution, store.resolution))
+        if chromosome is None:
+            raise ValueError('Please provide the chromosome!')
+        assert end_pos == -1 or end_pos > start_pos
+        mat = store.query(chromosome, start_pos, end_pos, sparse=sparse)
+
+    elif format == 'hic':
+        if chromosome is None:
+            raise ValueError('Please provide the chromosome!')
+        assert end_pos == -1 or end_pos > start_pos
+        mat, bias = _load_hic(file, chromosome, start_pos, end_pos, resolution, sparse, n_diagonals, norm)
+        return (mat, bias) if norm is not None else mat
+
+    elif format == 'pairs':
+        if chromosome is None:
+            raise ValueError('Please provide the chromosome!')
+        assert end_pos == -1 or end_pos > start_pos
+        size = int(np.ceil((end_pos - start_pos) / resolution)) if end_pos != -1 else None
+        with phase('load_HiC.pairs', file=file):
+            p1, p2 = region_pairs(file, chromosome, start_pos, end_pos, gzip=gzip or None, n_workers=n_workers)
+        acc = COOAccumulator(size=size)
+        acc.add(*bin_contacts(p1, p2, np.ones((len(p1),)), start_pos, end_pos, resolution, n_diagonals))
+        return _accumulated(acc, sparse, n_diagonals)
+
     else:
-        if format in ['short', 'Short']:
-            gen = file_line_generator(file, format=[0, 1, 0, 2, 3], gzip=gzip)
-        elif format in ['long', 'Long']:
-            gen = file_line_generator(file, chrom=chromosome, format=[1, 2, 3, 4, 5], gzip=gzip)
-        elif format in ['NoScore', 'noscore']:
-            gen = file_line_generator(file, chrom=chromosome, format=[1, 2, 3, 4, 0], gzip=gzip)
-        elif format is None:
-            if custom_format is None:
-                raise ValueError('Please provide file format!')
-            else:
-                if isinstance(custom_format, int):
-                    custom_format = [int(elm) for elm in str(custom_format)]
-                gen = file_line_generator(file, header=header, chrom=chromosome, format=custom_format, gzip=gzip)
-        else:
-            raise ValueError('Unrecognized format: ' + format)
+        columns, chrom = parse_format(format, custom_format, chromosome)
+        # The header line is only considered for customized input
+        header = header if format is None else False
 
         assert end_pos == -1 or end_pos > start_pos
-        size = int(np.ceil((end_pos - start_pos) / resolution)) if end_pos != -1 else 1
-
-        G = nx.Graph()
-        for i in range(size):
-            G.add_node(i)
-            G.add_edge(i, i, weight=np.finfo(float).eps)
-
-        for p1, p2, val in gen:
-            if p1 < start_pos or p2 < start_pos:
-                continue
-            if end_pos != -1:
-                if p1 >= end_pos or p2 >= end_pos:
-                    continue
-            p1, p2 = (p1 - start_pos) // resolution, (p2 - start_pos) // resolution
-            if end_pos == -1:
-                max_pos = max(p1, p2)
-                if max_pos > size:
-                    for i in range(size, max_pos + 1):
-                        G.add_node(i)
-                        G.add_edge(i, i, weight=np.finfo(float).eps)
-                    size = max_pos + 1
-
-            if G.has_edge(p1, p2):
-                G[p1][p2]['weight'] += val
+        size = int(np.ceil((end_pos - start_pos) / resolution)) if end_pos != -1 else None
+
+        with phase('load_HiC.parse', file=file, workers=n_workers):
+            if n_workers == 1:
+                acc = COOAccumulator(size=size)
+                for p1, p2, v in file_block_generator(file, chrom=chrom, header=header, format=columns, gzip=gzip):
+                    acc.add(*bin_contacts(p1, p2, v, start_pos, end_pos, resolution, n_diagonals))
             else:
-                G.add_edge(p1, p2, weight=val)
+                acc = parallel_load(file, columns, chrom=chrom, header=header, gzip=gzip,
+                                    start_pos=start_pos, end_pos=end_pos, resolution=resolution, size=size,
+                                    n_diagonals=n_diagonals, n_workers=n_workers)
+
+        return _accumulated(acc, sparse, n_diagonals)
 
-        mat = nx.adj_matrix(G)
-        if not sparse:
-            mat = mat.toarray()
+    if n_diagonals is not None:
+        mat = BandMatrix.from_matrix(mat, n_diagonals)
     return mat
 
+
+def _accumulated(acc, sparse=True, n_diagonals=None):
+    """The contact map of a COOAccumulator: csr_matrix, numpy.array or BandMatrix (if n_diagonals is given)."""
+    if n_diagonals is not None:
+        upper = acc.tocoo()
+        mat = BandMatrix.from_upper(upper.row, upper.col, upper.data, upper.shape[0], n_diagonals)
+        # Keep the explicit (epsilon) diagonal, same as the csr output
+        mat.data[0] += np.finfo(float).eps
+        return mat
+    mat = acc.tocsr()
+    return mat if sparse else mat.toarray()
+
+
+def _load_hic(file, chromosome, start_pos, end_pos, resolution, sparse, n_diagonals, norm):
+    """The contact map of a region of a .hic file (same output as the text formats), and the norm vector or None."""
+    hic = HiCFile(file)
+    with phase('load_HiC.hic', file=file, resolution=resolution):
+        b1, b2, v, shape = hic.pixels(chromosome, start_pos, end_pos, resolution=resolution)
+    keep = b1 <= b2
+    if n_diagonals is not None:
+        keep &= (b2 - b1) < n_diagonals
+    acc = COOAccumulator(size=shape[0])
+    acc.add(b1[keep], b2[keep], v[keep])
+    bias = None
+    if norm is not None:
+        b0 = hic.bin_range(chromosome, start_pos, end_pos, resolution)[0]
+        bias = hic.norm_vector(norm, chromosome, resolution)[b0:b0 + shape[0]]
+
+    return _accumulated(acc, sparse, n_diagonals), bias
+
+
+def read_chrom_sizes(chrom_sizes):
+    """
+    Read a chromosome-size table.
+
+    Args:
+        chrom_sizes (str or dict): a two-column file "<chromosome> <length>" (e.g., hg38.chrom.sizes)
+            or a dict {chromosome: length}
+
+    Return:
+        dict {chromosome (str): length (int)}, in the order of the table
+    """
+    if isinstance(chrom_sizes, dict):
+        return {str(k): int(v) for k, v in chrom_sizes.items()}
+    sizes = {}
+    with open(chrom_sizes) as f:
+        for line in f:
+            lst = line.strip().split()
+            if len(lst) >= 2:
+                sizes[lst[0]] = int(lst[1])
+    return sizes
+
+
+def load_HiC_genome(file, format='long', custom_format=None, header=False,
+                    chrom_sizes=None, resolution=10000, gzip=False, sparse=True,
+                    inter=False):
+    """
+    Load the contact matrices of all chromosomes with one pass over a genome-wide HiC file
+
+    Args:
+        file: (str) file name;
+        format: (str or None) default: "long". "long" / "Long" or "noscore" / "NoScore". If customized, leave it "None".
+        custom_format: (str or list or None) default: None. For customized input, provide the indices like "2356"".
+            The chromosome columns are required.
+        header: (bool or None) default: None. For customized input, whether the file has a header line.
+        chrom_sizes: (str or dict or None) default: None. Chromosome-size file or dict {chromosome: length}.
+            If given, only these chromosomes are loaded and the matrix shapes are ceil(length / resolution).
+            If None, the shapes are decided by the largest position of each chromosome.
+        resolution: (int) default: 10000.
+        gzip (bool): whether zipped file. Default: False
+        sparse: (bool) default: True. If True, store with scipy.sparse.csr_matrix; if false, with numpy.array.
+        inter (bool): whether also return inter-chromosomal matrices. Default: False
+
+    Return:
+        intra: dict {chromosome: HiC contact matrix}
+        inter (only if inter=True): dict {(chromosome1, chromosome2): HiC contact matrix},
+            chromosome1 is before chromosome2 in chrom_sizes (or in alphabetical order if chrom_sizes is None)
+    """
+    columns, _ = parse_format(format, custom_format)
+    if columns[0] == 0 or columns[2] == 0:
+        raise ValueError('Genome-wide loading requires the chromosome columns!')
+
+    sizes = read_chrom_sizes(chrom_sizes) if chrom_sizes is not None else None
+    n_bins = {ch: int(np.ceil(length / resolution)) for ch, length in sizes.items()} if sizes else None
+    order = {ch: i for i, ch in enumerate(sizes)} if sizes else None
+
+    intra_acc, inter_acc = {}, {}
+    with phase('load_HiC_genome.parse', file=file):
+        for lines in file_lines_generator(file, header=header if format is None else False, gzip=gzip):
+            for c1, c2, p1, p2, val in group_contacts(lines, columns, intra_only=not inter):
+                b1, b2 = p1 // resolution, p2 // resolution
+                if sizes is not None:
+                    if c1 not in sizes or c2 not in sizes:
+                        continue
+                    keep = (b1 < n_bins[c1]) & (b2 < n_bins[c2])
+                    b1, b2, val = b1[keep], b2[keep], val[keep]
+
+                if c1 == c2:
+                    if c1 not in intra_acc:
+                        intra_acc[c1] = COOAccumulator(size=n_bins[c1] if sizes else None)
+                    intra_acc[c1].add(b1, b2, val)
+                else:
+                    if (order[c1] > order[c2]) if sizes else (c1 > c2):
+                        c1, c2, b1, b2 = c2, c1, b2, b1
+                    if (c1, c2) not in inter_acc:
+                        inter_acc[(c1, c2)] = COOAccumulator(
+                            size=(n_bins[c1], n_bins[c2]) if sizes else None, symmetric=False)
+                    inter_acc[(c1, c2)].add(b1, b2, val)
+
+    if sizes is None:
+        # Without a chromosome-size table, use the largest bin of each chromosome (over intra and inter contacts)
+        n_bins = {}
+        for ch, acc in intra_acc.items():
+            n_bins[ch] = max(n_bins.get(ch, 1), acc.max_col + 1)
+        for (c1, c2), acc in inter_acc.items():
+            n_bins[c1] = max(n_bins.get(c1, 1), acc.max_row + 1)
+            n_bins[c2] = max(n_bins.get(c2, 1), acc.max_col + 1)
+        order = {ch: i for i, ch in enumerate(sorted(n_bins))}
+    chroms = sorted(n_bins, key=lambda ch: order[ch])
+
+    intra_mats = {}
+    for ch in chroms:
+        acc = intra_acc.pop(ch, COOAccumulator())
+        acc.shape = (n_bins[ch], n_bins[ch])
+        mat = acc.tocsr()
+        intra_mats[ch] = mat if sparse else mat.toarray()
+    if not inter:
+        return intra_mats
+
+    inter_mats = {}
+    for key in sorted(inter_acc, key=lambda k: (order[k[0]], order[k[1]])):
+        acc = inter_acc.pop(key)
+        acc.shape = (n_bins[key[0]], n_bins[key[1]])
+        mat = acc.tocsr()
+        inter_mats[key] = mat if sparse else mat.toarray()
+    return intra_mats, inter_mats
+
+
+def convert_to_store(file, output, format=None, custom_format=None, header=False,
+                     chromosome=None, resolution=10000, gzip=False, chrom_sizes=None, inter=False):
+    """
+    Convert a HiC file into a pyHiC store (see pyHiC.loading.store), which supports fast region queries.
+
+    Args:
+        file: (str) file name;
+        output: (str) the folder of the store. If it exists, the chromosome(s) are added to / replaced in the store.
+        format, custom_format, header, resolution, gzip: same as load_HiC.
+        chromosome: (str) default: None. Required for "short", "npy" and "npz" (the chromosome of the map).
+            For other formats, if None, all chromosomes are converted with load_HiC_genome (ingest_pairs for "pairs").
+        chrom_sizes: (str or dict or None) default: None. Same as load_HiC_genome.
+        inter (bool): whether also store inter-chromosomal maps. Default: False
+    """
+    if format in ['short', 'Short', 'npy', 'npz'] or chromosome is not None:
+        if chromosome is None:
+            raise ValueError('Please provide the chromosome!')
+        mat = load_HiC(file, format=format, custom_format=custom_format, header=header,
+                       chromosome=chromosome, resolution=resolution, gzip=gzip, sparse=True)
+        save_to_store(output, mat, chromosome, resolution=resolution)
+    elif format == 'pairs':
+        ingest_pairs(file, [resolution], output=output, chrom_sizes=chrom_sizes, inter=inter, gzip=gzip or None)
+    else:
+        mats = load_HiC_genome(file, format=format, custom_format=custom_format, header=header,
+                               chrom_sizes=chrom_sizes, resolution=resolution, gzip=gzip, inter=inter)
+        intra, inter_mats = mats if inter else (mats, None)
+        write_store(output, intra, inter_mats, resolution=resolution)
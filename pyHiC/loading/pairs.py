@@ -0,0 +1,641 @@
+"""
+Ingestion of 4DN .pairs files (read pairs, one line each; zipped or not, sorted or not).
+
+    ## pairs format v1.0
+    #chromsize: chr1 248956422
+    #columns: readID chr1 pos1 chr2 pos2 strand1 strand2
+    read_1 chr1 10001 chr1 20001 + -
+
+Positions are 1-based. Each pair is oriented so that chrom1 comes first (in the order of the chromosome sizes,
+or by name) and pos1 <= pos2 on the same chromosome, i.e., the upper triangle.
+
+ingest_pairs reads a file once and bins it at several resolutions together, and can write a sorted copy:
+a gzip file made of independent gzip members ("blocks"), each holding the pairs of one chromosome pair
+sorted by position, with an index (<copy>.index.npz: offset, size and position ranges of each block).
+The copy is still a valid .pairs.gz file; PairsFile queries it by decompressing only the blocks of a region.
+"""
+
+import os
+import gzip as gz
+import numpy as np
+import scipy.sparse as sp
+from .parsing import COOAccumulator, file_lines_generator, BLOCK_SIZE
+from .parallel import map_file_blocks
+from .store import write_store
+from ..utils import coarsen
+from ..utils.instrument import phase
+
+
+DEFAULT_COLUMNS = ['readID', 'chr1', 'pos1', 'chr2', 'pos2', 'strand1', 'strand2']
+INDEX_SUFFIX = '.index.npz'
+# Keys of the sorted copy: (chromosome pair << POS_BITS) + pos1, then pos2
+POS_BITS = 31
+MAX_CHROMOSOMES = 1 << 16
+
+
+def read_pairs_header(file, gzip=None):
+    """
+    Header of a .pairs file.
+
+    Return:
+        dict {"lines": header lines, "columns": column names, "chromsizes": {chromosome: length},
+        "sorted": str or None, "shape": str or None}
+    """
+    gzip = file.endswith('.gz') if gzip is None else gzip
+    header = {'lines': [], 'columns': list(DEFAULT_COLUMNS), 'chromsizes': {}, 'sorted': None, 'shape': None}
+    with (gz.open(file, 'rt') if gzip else open(file)) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header['lines'].append(line.rstrip('\n'))
+            key, _, value = line[1:].partition(':')
+            key, value = key.strip(), value.strip()
+            if key == 'columns':
+                header['columns'] = value.split()
+            elif key == 'chromsize':
+                name, length = value.split()
+                header['chromsizes'][name] = int(length)
+            elif key in ['sorted', 'shape']:
+                header[key] = value
+    return header
+
+
+def _column_indices(columns):
+    """Indices (from 0) of chr1, pos1, chr2 and pos2 among the columns of the header."""
+    for names in [['chr1', 'pos1', 'chr2', 'pos2'], ['chrom1', 'pos1', 'chrom2', 'pos2']]:
+        if all(name in columns for name in names):
+            return [columns.index(name) for name in names]
+    raise ValueError('The pairs file has no chr1 / pos1 / chr2 / pos2 columns: {0}'.format(columns))
+
+
+def _pairs_table(lines, n_cols):
+    """Tokens of the lines (at least n_cols each), and the indices of the lines kept (None if all)."""
+    tokens = b''.join(lines).split()
+    width = len(lines[0].split())
+    if width >= n_cols and len(tokens) == width * len(lines):
+        return np.array(tokens).reshape((len(lines), width)), None
+    rows = [line.split() for line in lines]
+    kept = [i for i, row in enumerate(rows) if len(row) >= n_cols]
+    return np.array([rows[i][:n_cols] for i in kept]).reshape((-1, n_cols)), np.array(kept, dtype=np.int64)
+
+
+def _parse_pairs(lines, columns, order=None):
+    """
+    Parse a block of lines of a .pairs file (header lines are skipped).
+
+    Args:
+        columns (list): indices of chr1, pos1, chr2, pos2
+        order (dict or None): {chromosome: rank}; pairs on other chromosomes are dropped.
+            Default: None (all chromosomes, ranked by name)
+
+    Return:
+        names (list of str), code1, code2 (chromosome indices in names), pos1, pos2 (0-based, oriented),
+        and the indices of the parsed lines
+    """
+    index = np.arange(len(lines))
+    if lines and lines[0].startswith(b'#'):
+        index = np.array([i for i, line in enumerate(lines) if not line.startswith(b'#')], dtype=np.int64)
+        lines = [lines[i] for i in index]
+    empty = np.zeros((0,), dtype=np.int64)
+    if not lines:
+        return [], empty, empty, empty, empty, empty
+    table, kept = _pairs_table(lines, max(columns) + 1)
+    if kept is not None:
+        index = index[kept]
+    n = len(table)
+    names, codes = np.unique(np.concatenate([table[:, columns[0]], table[:, columns[2]]]), return_inverse=True)
+    names = [name.decode() for name in names]
+    code1, code2 = codes[:n].astype(np.int64), codes[n:].astype(np.int64)
+    pos1 = table[:, columns[1]].astype(np.int64) - 1
+    pos2 = table[:, columns[3]].astype(np.int64) - 1
+
+    if order is None:
+        # np.unique sorts the names
+        rank = np.arange(len(names))
+    else:
+        rank = np.array([order.get(name, -1) for name in names], dtype=np.int64)
+        keep = (rank[code1] >= 0) & (rank[code2] >= 0)
+        if not np.all(keep):
+            code1, code2, pos1, pos2, index = code1[keep], code2[keep], pos1[keep], pos2[keep], index[keep]
+    swap = (rank[code1] > rank[code2]) | ((code1 == code2) & (pos1 > pos2))
+    code1, code2 = np.where(swap, code2, code1), np.where(swap, code1, code2)
+    pos1, pos2 = np.where(swap, pos2, pos1), np.where(swap, pos1, pos2)
+    return names, code1, code2, pos1, pos2, index
+
+
+def _bin_pairs(names, code1, code2, pos1, pos2, resolutions, inter=True):
+    """{(chrom1, chrom2, resolution): (bin1, bin2, count)} of oriented pairs, with the duplicates summed."""
+    results = {}
+    if len(pos1) == 0:
+        return results
+    pair = code1 * len(names) + code2
+    idx = np.argsort(pair, kind='stable')
+    pairs, starts = np.unique(pair[idx], return_index=True)
+    ends = np.append(starts[1:], len(idx))
+    for p, st, ed in zip(pairs, starts, ends):
+        c1, c2 = names[p // len(names)], names[p % len(names)]
+        if c1 != c2 and not inter:
+            continue
+        sel = idx[st:ed]
+        for res in resolutions:
+            b1, b2 = pos1[sel] // res, pos2[sel] // res
+            width = int(b2.max()) + 1
+            keys, counts = np.unique(b1 * width + b2, return_counts=True)
+            results[(c1, c2, res)] = (keys // width, keys % width, counts.astype(np.float64))
+    return results
+
+
+def _bin_pairs_blocks(blocks, columns, order, resolutions, inter):
+    """Bin the pairs of some blocks of lines (run by the workers of map_file_blocks)."""
+    accs = {}
+    for lines in blocks:
+        names, code1, code2, pos1, pos2, _ = _parse_pairs(lines, columns, order)
+        for key, (b1, b2, v) in _bin_pairs(names, code1, code2, pos1, pos2, resolutions, inter).items():
+            if key not in accs:
+                accs[key] = COOAccumulator(symmetric=False)
+            accs[key].add(b1, b2, v)
+    results = {}
+    for key, acc in accs.items():
+        coo = acc.tocoo()
+        results[key] = (coo.row, coo.col, coo.data)
+    return results
+
+
+def _region_blocks(blocks, columns, chrom, start, end):
+    """Positions of the pairs within [start, end) of chrom in some blocks of lines (run by map_file_blocks)."""
+    pos1, pos2 = [np.zeros((0,), dtype=np.int64)], [np.zeros((0,), dtype=np.int64)]
+    for lines in blocks:
+        names, code1, code2, p1, p2, _ = _parse_pairs(lines, columns)
+        if chrom not in names:
+            continue
+        keep = (code1 == names.index(chrom)) & (code2 == names.index(chrom)) & (p1 >= start)
+        if end != -1:
+            keep &= p2 < end
+        pos1.append(p1[keep])
+        pos2.append(p2[keep])
+    return np.concatenate(pos1), np.concatenate(pos2)
+
+
+def region_pairs(file, chrom, start=0, end=-1, gzip=None, n_workers=1):
+    """
+    Pairs within a region of one chromosome: from the index if the file is a sorted copy (see ingest_pairs),
+    otherwise by reading the whole file.
+
+    Args:
+        file (str): .pairs file
+        chrom (str): chromosome
+        start & end (int): region in base pairs. Default: 0 and -1. (0: start, -1: end).
+        gzip (bool or None): Default: None (True if the file name ends with .gz)
+        n_workers (int or None): number of processes for reading a file without index. Default: 1
+
+    Return:
+        pos1, pos2: numpy.array of 0-based positions, pos1 <= pos2
+    """
+    if os.path.exists(file + INDEX_SUFFIX):
+        return PairsFile(file).pairs(chrom, start, end)
+    gzip = file.endswith('.gz') if gzip is None else gzip
+    columns = _column_indices(read_pairs_header(file, gzip=gzip)['columns'])
+    if n_workers == 1:
+        return _region_blocks(file_lines_generator(file, gzip=gzip), columns, chrom, start, end)
+    parts = list(map_file_blocks(file, _region_blocks, args=(columns, chrom, start, end), gzip=gzip,
+                                 n_workers=n_workers))
+    return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+
+class _BlockWriter:
+    """
+    Write sorted pairs as gzip members of at most block_lines lines, one chromosome pair per block,
+    and keep the index of the blocks. If keys_file is given, the keys of the pairs are saved as well (for merging).
+    """
+    def __init__(self, path, header_lines=(), block_lines=100000, keys_file=None):
+        self.f = open(path, 'wb')
+        self.block_lines = block_lines
+        self.keys = open(keys_file, 'wb') if keys_file is not None else None
+        self.index = {name: [] for name in ['offset', 'size', 'n_pairs', 'pair', 'pos1_min', 'pos1_max',
+                                            'pos2_min', 'pos2_max']}
+        self._lines, self._k1, self._k2 = [], [], []
+        self._n_pending = 0
+        self.last_key = None
+        if header_lines:
+            header = ''.join(line + '\n' for line in header_lines).encode()
+            self.f.write(gz.compress(header, compresslevel=3, mtime=0))
+
+    def add(self, lines, k1, k2):
+        """Add pairs sorted by (k1, k2), all after the pairs added before."""
+        if len(k1) == 0:
+            return
+        self._lines.append(lines)
+        self._k1.append(k1)
+        self._k2.append(k2)
+        self._n_pending += len(k1)
+        self.last_key = (int(k1[-1]), int(k2[-1]))
+        if self._n_pending >= self.block_lines:
+            self._flush(final=False)
+
+    def _flush(self, final=True):
+        lines = np.concatenate(self._lines)
+        k1, k2 = np.concatenate(self._k1), np.concatenate(self._k2)
+        pair = k1 >> POS_BITS
+        # Block boundaries: at each change of the chromosome pair, then every block_lines pairs of the pair
+        # (counted from its first pair, so the blocks do not depend on how the pairs were added)
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(pair)) + 1])
+        offset = np.arange(len(k1)) - np.repeat(starts, np.diff(np.append(starts, len(k1))))
+        cuts = np.flatnonzero(offset % self.block_lines == 0)[1:]
+        bounds = np.concatenate([[0], cuts, [len(k1)]]).astype(np.int64)
+        # Unless final, the last (partial) block waits for more pairs of the same chromosome pair
+        n_write = len(bounds) - 1 if final else len(bounds) - 2
+        for st, ed in zip(bounds[:n_write], bounds[1:n_write + 1]):
+            self._write_block(lines[st:ed], k1[st:ed], k2[st:ed])
+        rest = bounds[n_write]
+        self._lines, self._k1, self._k2 = [lines[rest:]], [k1[rest:]], [k2[rest:]]
+        self._n_pending = len(k1) - rest
+
+    def _write_block(self, lines, k1, k2):
+        data = gz.compress(b''.join(lines), compresslevel=3, mtime=0)
+        pos1 = k1 & ((1 << POS_BITS) - 1)
+        for name, value in [('offset', self.f.tell()), ('size', len(data)), ('n_pairs', len(k1)),
+                            ('pair', k1[0] >> POS_BITS), ('pos1_min', pos1[0]), ('pos1_max', pos1[-1]),
+                            ('pos2_min', k2.min()), ('pos2_max', k2.max())]:
+            self.index[name].append(int(value))
+        self.f.write(data)
+        if self.keys is not None:
+            np.stack([k1, k2], axis=1).astype(np.int64).tofile(self.keys)
+
+    def close(self):
+        if self._n_pending > 0:
+            self._flush(final=True)
+        self.f.close()
+        if self.keys is not None:
+            self.keys.close()
+        return {name: np.array(values, dtype=np.int64) for name, values in self.index.items()}
+
+
+class _RunReader:
+    """Read back the blocks (lines and keys) of a sorted run."""
+    def __init__(self, path, index, keys_file):
+        self.path, self.index, self.keys_file = path, index, keys_file
+        self.block, self.n_done = 0, 0
+
+    @property
+    def exhausted(self):
+        return self.block >= len(self.index['offset'])
+
+    def next_block(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.index['offset'][self.block])
+            lines = gz.decompress(f.read(self.index['size'][self.block])).splitlines(keepends=True)
+        n = self.index['n_pairs'][self.block]
+        keys = np.fromfile(self.keys_file, dtype=np.int64, count=2 * n, offset=16 * self.n_done).reshape((n, 2))
+        self.block += 1
+        self.n_done += n
+        return np.array(lines, dtype=object), keys[:, 0], keys[:, 1]
+
+
+def _count_until(k1, k2, key):
+    """Number of entries of sorted (k1, k2) <= key."""
+    lo, hi = np.searchsorted(k1, key[0], 'left'), np.searchsorted(k1, key[0], 'right')
+    return lo + np.searchsorted(k2[lo:hi], key[1], 'right')
+
+
+def _merge_runs(runs, writer):
+    """Merge sorted runs into the writer, a block of each run at a time."""
+    buffers = [None] * len(runs)
+    while True:
+        for i, run in enumerate(runs):
+            if (buffers[i] is None or len(buffers[i][1]) == 0) and not run.exhausted:
+                buffers[i] = run.next_block()
+        active = [i for i, b in enumerate(buffers) if b is not None and len(b[1]) > 0]
+        if not active:
+            return
+        # Everything up to the smallest last key of the runs with more blocks can be written
+        pending = [(int(buffers[i][1][-1]), int(buffers[i][2][-1])) for i in active if not runs[i].exhausted]
+        frontier = min(pending) if pending else None
+        parts = []
+        for i in active:
+            lines, k1, k2 = buffers[i]
+            n = len(k1) if frontier is None else _count_until(k1, k2, frontier)
+            parts.append((lines[:n], k1[:n], k2[:n]))
+            buffers[i] = (lines[n:], k1[n:], k2[n:])
+        lines = np.concatenate([p[0] for p in parts])
+        k1, k2 = np.concatenate([p[1] for p in parts]), np.concatenate([p[2] for p in parts])
+        order = np.lexsort((k2, k1))
+        writer.add(lines[order], k1[order], k2[order])
+
+
+class _SortedCopy:
+    """Sort pairs into runs of run_lines pairs, then merge the runs into a block-gzipped copy with an index."""
+    def __init__(self, path, header, order, block_lines, run_lines):
+        self.path, self.header, self.order = path, header, order
+        self.block_lines, self.run_lines = block_lines, run_lines
+        self.chromosomes = {}
+        self.runs = []
+        self._writer = None
+        self._buffer = []
+        self._n_buffer = 0
+
+    def _codes(self, names):
+        """Chromosome numbers in the order they are first seen."""
+        for name in names:
+            if name not in self.chromosomes:
+                if len(self.chromosomes) >= MAX_CHROMOSOMES:
+                    raise ValueError('Too many chromosomes for a sorted copy (max: {0})'.format(MAX_CHROMOSOMES))
+                self.chromosomes[name] = len(self.chromosomes)
+        return np.array([self.chromosomes[name] for name in names], dtype=np.int64)
+
+    def add(self, lines, names, code1, code2, pos1, pos2):
+        if len(pos1) == 0:
+            return
+        if max(pos1.max(), pos2.max()) >= 1 << POS_BITS:
+            raise ValueError('Positions above {0} are not supported in a sorted copy'.format(1 << POS_BITS))
+        codes = self._codes(names)
+        k1 = ((codes[code1] * MAX_CHROMOSOMES + codes[code2]) << POS_BITS) + pos1
+        self._buffer.append((np.array(lines, dtype=object), k1, pos2))
+        self._n_buffer += len(k1)
+        if self._n_buffer >= self.run_lines:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        lines = np.concatenate([b[0] for b in self._buffer])
+        k1, k2 = np.concatenate([b[1] for b in self._buffer]), np.concatenate([b[2] for b in self._buffer])
+        self._buffer, self._n_buffer = [], 0
+        order = np.lexsort((k2, k1))
+        lines, k1, k2 = lines[order], k1[order], k2[order]
+        # A sorted input continues the current run; otherwise a new run starts
+        if self._writer is None or (int(k1[0]), int(k2[0])) < self._writer.last_key:
+            if self._writer is not None:
+                self.runs[-1]['index'] = self._writer.close()
+            name = '{0}.run{1}.tmp'.format(self.path, len(self.runs))
+            self.runs.append({'path': name, 'keys': name + '.keys'})
+            self._writer = _BlockWriter(name, self.header['lines'] if len(self.runs) == 1 else (),
+                                        self.block_lines, keys_file=name + '.keys')
+        self._writer.add(lines, k1, k2)
+
+    def close(self):
+        self._flush()
+        if self._writer is None:
+            self.runs.append({'path': self.path + '.run0.tmp', 'keys': None})
+            self._writer = _BlockWriter(self.runs[0]['path'], self.header['lines'], self.block_lines)
+        self.runs[-1]['index'] = self._writer.close()
+        try:
+            if len(self.runs) == 1:
+                os.replace(self.runs[0]['path'], self.path)
+                index = self.runs[0]['index']
+            else:
+                with phase('ingest_pairs.merge', runs=len(self.runs)):
+                    writer = _BlockWriter(self.path, self.header['lines'], self.block_lines)
+                    _merge_runs([_RunReader(r['path'], r['index'], r['keys']) for r in self.runs], writer)
+                    index = writer.close()
+        finally:
+            for run in self.runs:
+                for name in [run['path'], run['keys']]:
+                    if name is not None and os.path.exists(name):
+                        os.remove(name)
+        names = sorted(self.chromosomes, key=self.chromosomes.get)
+        pair = index.pop('pair')
+        np.savez(self.path + INDEX_SUFFIX, chromosomes=np.array(names, dtype=str),
+                 chrom1=pair // MAX_CHROMOSOMES, chrom2=pair % MAX_CHROMOSOMES,
+                 order=np.array(list(self.order) if self.order else [], dtype=str),
+                 columns=np.array(self.header['columns'], dtype=str),
+                 chromsizes=np.array([[k, str(v)] for k, v in self.header['chromsizes'].items()],
+                                     dtype=str).reshape((-1, 2)),
+                 **index)
+
+
+def _matrices(pixels, n_bins, order, inter):
+    """Contact maps of one resolution (same as load_HiC_genome) from the pixels {(chrom1, chrom2): coo_matrix}."""
+    intra, inter_mats = {}, {}
+    for (c1, c2) in sorted(pixels, key=lambda k: (order(k[0]), order(k[1]))):
+        coo = pixels[(c1, c2)]
+        # Positions beyond the chromosome sizes are dropped
+        keep = (coo.row < n_bins[c1]) & (coo.col < n_bins[c2])
+        if c1 == c2:
+            out = COOAccumulator(size=n_bins[c1])
+            out.add(coo.row[keep], coo.col[keep], coo.data[keep])
+            intra[c1] = out.tocsr()
+        elif inter:
+            inter_mats[(c1, c2)] = sp.csr_matrix((coo.data[keep], (coo.row[keep], coo.col[keep])),
+                                                 shape=(n_bins[c1], n_bins[c2]))
+    for ch in n_bins:
+        if ch not in intra:
+            intra[ch] = COOAccumulator(size=n_bins[ch]).tocsr()
+    intra = {ch: intra[ch] for ch in sorted(intra, key=order)}
+    return (intra, inter_mats) if inter else intra
+
+
+def ingest_pairs(file, resolutions=(10000,), output=None, sorted_copy=None, chrom_sizes=None, inter=True,
+                 gzip=None, block_lines=100000, run_lines=2000000, n_workers=1, block_size=BLOCK_SIZE):
+    """
+    Read a .pairs file once: bin it at several resolutions together, and / or write an indexed sorted copy.
+
+    Args:
+        file (str): .pairs file (4DN format; the "#columns:" line gives the columns; positions are 1-based)
+        resolutions (list): resolutions to bin. Those that are multiples of a smaller one are coarsened
+            from it (see pyHiC.utils.coarsen) instead of binned again. Default: (10000,)
+        output (str or None): write the maps into pyHiC stores instead of returning them; "{resolution}"
+            in the name is replaced by each resolution (required for several resolutions). Default: None
+        sorted_copy (str or None): write a sorted, block-gzipped copy of the pairs and its index
+            (sorted_copy + ".index.npz") for fast region queries (see PairsFile). Default: None
+        chrom_sizes (str or dict or None): chromosome sizes (see read_chrom_sizes); only these chromosomes are kept.
+            Default: None (the "#chromsize:" lines of the header if any, otherwise all chromosomes,
+            sized by their largest positions)
+        inter (bool): whether also bin the inter-chromosomal pairs. Default: True
+        gzip (bool or None): Default: None (True if the file name ends with .gz)
+        block_lines (int): number of pairs in each block of the sorted copy. Default: 100000
+        run_lines (int): number of pairs sorted in memory at a time; an unsorted file is sorted by
+            merging these sorted runs, a sorted file is written directly. Default: 2000000
+        n_workers (int or None): number of processes for parsing (only without sorted_copy). Default: 1
+        block_size (int): number of bytes read at a time. Default: BLOCK_SIZE
+
+    Return:
+        {resolution: (intra, inter)} (or {resolution: intra} if not inter), same as load_HiC_genome;
+        {resolution: store} if output is given; None if there are no resolutions
+    """
+    from .loading import read_chrom_sizes
+    gzip = file.endswith('.gz') if gzip is None else gzip
+    resolutions = sorted(set(int(r) for r in (resolutions or [])))
+    if not resolutions and sorted_copy is None:
+        raise ValueError('Nothing to do: give resolutions and / or sorted_copy!')
+    if output is not None and len(resolutions) > 1 and '{resolution}' not in output:
+        raise ValueError('Please put "{resolution}" in the output name for several resolutions!')
+    header = read_pairs_header(file, gzip=gzip)
+    columns = _column_indices(header['columns'])
+    sizes = read_chrom_sizes(chrom_sizes) if chrom_sizes is not None else (header['chromsizes'] or None)
+    order = {ch: i for i, ch in enumerate(sizes)} if sizes else None
+
+    # Only the resolutions which are not multiples of another one are binned from the pairs
+    base = [r for r in resolutions if not any(r % b == 0 for b in resolutions if b < r)]
+    accs = {}
+
+    def _add(key, b1, b2, v):
+        if key not in accs:
+            accs[key] = COOAccumulator(symmetric=False)
+        accs[key].add(b1, b2, v)
+
+    with phase('ingest_pairs.bin', file=file, resolutions=resolutions):
+        if sorted_copy is None and n_workers != 1:
+            for result in map_file_blocks(file, _bin_pairs_blocks, args=(columns, order, base, inter), gzip=gzip,
+                                          n_workers=n_workers, block_size=block_size):
+                for key, (b1, b2, v) in result.items():
+                    _add(key, b1, b2, v)
+        else:
+            copy = _SortedCopy(sorted_copy, header, order, block_lines, run_lines) if sorted_copy else None
+            for lines in file_lines_generator(file, gzip=gzip, block_size=block_size):
+                names, code1, code2, pos1, pos2, index = _parse_pairs(lines, columns, order)
+                for key, (b1, b2, v) in _bin_pairs(names, code1, code2, pos1, pos2, base, inter).items():
+                    _add(key, b1, b2, v)
+                if copy is not None:
+                    copy.add([lines[i] for i in index], names, code1, code2, pos1, pos2)
+            if copy is not None:
+                copy.close()
+    if not resolutions:
+        return None
+
+    def _rank(ch):
+        return (order[ch], ch) if order else (0, ch)
+
+    # Pixels of each resolution: binned (base) or coarsened from the largest resolution it is a multiple of
+    levels = {res: {key[:2]: acc.tocoo() for key, acc in accs.items() if key[2] == res} for res in base}
+    results = {}
+    for res in resolutions:
+        if res not in levels:
+            src = max(r for r in levels if res % r == 0)
+            # Pairs are oriented (upper triangle), so every pixel is summed as it is
+            levels[res] = {key: coarsen(coo.tocsr(), res // src, symmetric=False).tocoo()
+                           for key, coo in levels[src].items()}
+        if sizes:
+            n_bins = {ch: int(np.ceil(length / res)) for ch, length in sizes.items()}
+        else:
+            n_bins = {}
+            for (c1, c2), coo in levels[res].items():
+                n_bins[c1] = max(n_bins.get(c1, 1), coo.shape[0 if c1 != c2 else 1])
+                n_bins[c2] = max(n_bins.get(c2, 1), coo.shape[1])
+        results[res] = _matrices(levels[res], n_bins, _rank, inter)
+
+    if output is None:
+        return results
+    stores = {}
+    for res, mats in results.items():
+        intra, inter_mats = mats if inter else (mats, None)
+        stores[res] = output.replace('{resolution}', str(res))
+        write_store(stores[res], intra, inter_mats, resolution=res)
+    return stores
+
+
+class PairsFile:
+    """
+    Region queries on a sorted copy written by ingest_pairs (sorted_copy=...).
+
+    Args:
+        path (str): the sorted copy (its index is path + ".index.npz")
+
+    Attributes:
+        chromosomes (list): chromosomes with pairs
+        chromsizes (dict): {chromosome: length} of the header
+    """
+    def __init__(self, path):
+        if not os.path.exists(path + INDEX_SUFFIX):
+            raise ValueError('No index of {0}. Write it with ingest_pairs(..., sorted_copy=...)'.format(path))
+        self.path = path
+        with np.load(path + INDEX_SUFFIX) as index:
+            self.index = {key: index[key] for key in index.files}
+        self.chromosomes = [str(ch) for ch in self.index.pop('chromosomes')]
+        self._codes = {ch: i for i, ch in enumerate(self.chromosomes)}
+        self._order = {str(ch): i for i, ch in enumerate(self.index.pop('order'))} or None
+        self._columns = _column_indices([str(c) for c in self.index.pop('columns')])
+        self.chromsizes = {str(k): int(v) for k, v in self.index.pop('chromsizes')}
+
+    def __repr__(self):
+        return 'PairsFile({0}, {1} chromosomes, {2} blocks)'.format(
+            self.path, len(self.chromosomes), len(self.index['offset']))
+
+    def _rank(self, ch):
+        return self._order[ch] if self._order else ch
+
+    def _read(self, c1, c2, rects):
+        """Oriented pairs (pos1, pos2) of the blocks of (c1, c2) overlapping any rectangle ((s1, e1), (s2, e2))."""
+        empty = np.zeros((0,), dtype=np.int64)
+        if c1 not in self._codes or c2 not in self._codes:
+            return empty, empty
+        idx = self.index
+        sel = (idx['chrom1'] == self._codes[c1]) & (idx['chrom2'] == self._codes[c2])
+        overlap = np.zeros_like(sel)
+        for (s1, e1), (s2, e2) in rects:
+            overlap |= (idx['pos1_max'] >= s1) & (idx['pos1_min'] < e1) & (idx['pos2_max'] >= s2) & \
+                (idx['pos2_min'] < e2)
+        pos1, pos2 = [empty], [empty]
+        with open(self.path, 'rb') as f:
+            for b in np.flatnonzero(sel & overlap):
+                f.seek(idx['offset'][b])
+                lines = gz.decompress(f.read(idx['size'][b])).splitlines(keepends=True)
+                _, _, _, p1, p2, _ = _parse_pairs(lines, self._columns, self._order)
+                pos1.append(p1)
+                pos2.append(p2)
+        return np.concatenate(pos1), np.concatenate(pos2)
+
+    def pairs(self, chrom, start=0, end=-1, chrom2=None, start2=None, end2=None):
+        """
+        Pairs between two regions (the second one is the same as the first one if not given), each pair once.
+
+        Return:
+            pos1 (on chrom), pos2 (on chrom2): numpy.array of 0-based positions (pos1 <= pos2 within one region)
+        """
+        chrom2 = chrom if chrom2 is None else chrom2
+        if start2 is None and end2 is None and chrom2 == chrom:
+            start2, end2 = start, end
+        r1 = (start, np.inf if end == -1 or end is None else end)
+        r2 = (0 if start2 is None else start2, np.inf if end2 == -1 or end2 is None else end2)
+
+        def _inside(p, r):
+            return (p >= r[0]) & (p < r[1])
+
+        if chrom == chrom2:
+            p1, p2 = self._read(chrom, chrom, [(r1, r2), (r2, r1)])
+            forward = _inside(p1, r1) & _inside(p2, r2)
+            backward = _inside(p2, r1) & _inside(p1, r2) & ~forward
+            return np.concatenate([p1[forward], p2[backward]]), np.concatenate([p2[forward], p1[backward]])
+        if self._rank(chrom) > self._rank(chrom2):
+            p2, p1 = self._read(chrom2, chrom, [(r2, r1)])
+        else:
+            p1, p2 = self._read(chrom, chrom2, [(r1, r2)])
+        keep = _inside(p1, r1) & _inside(p2, r2)
+        return p1[keep], p2[keep]
+
+    def query(self, chrom, start=0, end=-1, chrom2=None, start2=None, end2=None, resolution=10000, sparse=True):
+        """
+        Contact map of a region at any resolution (see ContactStore.query); bins start at multiples of the resolution.
+
+        Return:
+            HiC contact matrix (numpy.array or scipy.sparse.csr_matrix)
+        """
+        chrom2 = chrom if chrom2 is None else chrom2
+        if start2 is None and end2 is None and chrom2 == chrom:
+            start2, end2 = start, end
+        start2, end2 = 0 if start2 is None else start2, -1 if end2 is None else end2
+        bins = []
+        for ch, st, ed in [(chrom, start, end), (chrom2, start2, end2)]:
+            b0 = max(st // resolution, 0)
+            if ed == -1 or ed is None:
+                b1 = int(np.ceil(self.chromsizes[ch] / resolution)) if ch in self.chromsizes else None
+            else:
+                b1 = int(np.ceil(ed / resolution))
+            bins.append((b0, b1))
+        (r0, r1), (c0, c1) = bins
+        # Whole bins of the regions
+        p1, p2 = self.pairs(chrom, r0 * resolution, -1 if r1 is None else r1 * resolution,
+                            chrom2, c0 * resolution, -1 if c1 is None else c1 * resolution)
+        b1, b2 = p1 // resolution - r0, p2 // resolution - c0
+        if chrom == chrom2:
+            # Mirror the pixels: a pixel (i, j) off the diagonal is also (j, i) if both are in the regions
+            x, y = b1 + r0, b2 + c0
+            mirror = (x != y) & (y >= r0) & (x >= c0)
+            if r1 is not None:
+                mirror &= y < r1
+            if c1 is not None:
+                mirror &= x < c1
+            b1, b2 = np.concatenate([b1, y[mirror] - r0]), np.concatenate([b2, x[mirror] - c0])
+        shape = ((r1 if r1 is not None else int(b1.max(initial=-1)) + r0 + 1) - r0,
+                 (c1 if c1 is not None else int(b2.max(initial=-1)) + c0 + 1) - c0)
+        mat = sp.csr_matrix((np.ones((len(b1),)), (b1, b2)), shape=shape)
+        return mat if sparse else mat.toarray()
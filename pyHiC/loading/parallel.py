@@ -0,0 +1,159 @@
+"""
+Multi-process loading of large (zipped) contact files.
+
+Plain files are split into byte ranges on line boundaries and each worker parses its own range.
+Zipped files are decompressed by the main process (one gzip stream cannot be split),
+which sends blocks of lines ahead to the workers for parsing and binning.
+In both cases, each worker returns the distinct pixels it has seen and the main process sums them up.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from .parsing import BLOCK_SIZE, COOAccumulator, bin_contacts, file_lines_generator, _parse_block
+from ..utils.instrument import emit, enabled
+
+
+def split_file(file, n_chunks, offset=0):
+    """
+    Split a plain text file into byte ranges starting and ending on line boundaries.
+
+    Args:
+        file (str): file name
+        n_chunks (int): number of ranges
+        offset (int): the first byte to consider (e.g., after the header line)
+
+    Return:
+        list of (start, end)
+    """
+    size = os.path.getsize(file)
+    bounds = [offset]
+    with open(file, 'rb') as f:
+        for i in range(1, n_chunks):
+            pos = max(offset + (size - offset) * i // n_chunks, bounds[-1])
+            f.seek(pos)
+            if pos > 0:
+                # Move to the start of the next line
+                f.seek(pos - 1)
+                f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(st, ed) for st, ed in zip(bounds[:-1], bounds[1:]) if ed > st]
+
+
+def _range_lines(file, start, end, block_size=BLOCK_SIZE):
+    """Yield blocks of complete lines in the byte range [start, end) of a plain file."""
+    with open(file, 'rb') as f:
+        f.seek(start)
+        pos, rest = start, b''
+        while pos < end:
+            buf = rest + f.read(min(block_size, end - pos))
+            pos = f.tell()
+            cut = buf.rfind(b'\n') + 1 if pos < end else len(buf)
+            buf, rest = buf[:cut], buf[cut:]
+            if buf:
+                yield buf.splitlines(keepends=True)
+
+
+def _accumulate(blocks, columns, chrom, start_pos, end_pos, resolution, size, n_diagonals):
+    acc = COOAccumulator(size=size)
+    for lines in blocks:
+        acc.add(*bin_contacts(*_parse_block(lines, chrom=chrom, format=columns),
+                              start_pos=start_pos, end_pos=end_pos, resolution=resolution,
+                              n_diagonals=n_diagonals))
+    coo = acc.tocoo() if acc.max_col >= 0 else None
+    return None if coo is None else (coo.row, coo.col, coo.data)
+
+
+def _map_range(func, file, start, end, block_size, args):
+    return func(_range_lines(file, start, end, block_size), *args)
+
+
+def _map_lines(func, lines, args):
+    return func([lines], *args)
+
+
+def map_file_blocks(file, func, args=(), header=False, gzip=False, n_workers=None, block_size=BLOCK_SIZE):
+    """
+    Apply func to the parts of a text file in a process pool and yield the partial results (in any order).
+
+    Args:
+        file (str): file name
+        func (function): func(blocks, *args), blocks is an iterable of lists of lines (bytes).
+            Must be defined at the top level of a module (picklable).
+        args (tuple): other arguments of func
+        header (bool): whether the file has a header line
+        gzip (bool): whether zipped file
+        n_workers (int or None): number of processes. Default: None (number of CPUs)
+        block_size (int): approximate number of bytes parsed at a time by each worker.
+            The memory of the main process is bounded by about 2 * n_workers blocks.
+
+    Yield:
+        the results of func
+
+    Emit "parse.progress" events as the parts are done (bytes, seconds, bytes_per_second).
+    """
+    n_workers = n_workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        if not gzip:
+            offset = 0
+            if header:
+                with open(file, 'rb') as f:
+                    f.readline()
+                    offset = f.tell()
+            # More ranges than workers to balance the load
+            ranges = split_file(file, 4 * n_workers, offset=offset)
+            futures = [pool.submit(_map_range, func, file, st, ed, block_size, args) for st, ed in ranges]
+            t0, n_bytes = time.perf_counter(), 0
+            for future, (st, ed) in zip(futures, ranges):
+                result = future.result()
+                if enabled():
+                    n_bytes += ed - st
+                    seconds = max(time.perf_counter() - t0, 1e-9)
+                    emit('parse.progress', file=file, bytes=n_bytes, seconds=seconds,
+                         bytes_per_second=n_bytes / seconds, workers=n_workers)
+                yield result
+        else:
+            # Decompress ahead in the main process; keep at most 2 * n_workers blocks in flight
+            pending = set()
+            for lines in file_lines_generator(file, header=header, gzip=True, block_size=block_size):
+                if len(pending) >= 2 * n_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(pool.submit(_map_lines, func, lines, args))
+            for future in pending:
+                yield future.result()
+
+
+def parallel_load(file, columns, chrom=None, header=False, gzip=False,
+                  start_pos=0, end_pos=-1, resolution=10000, size=None, n_diagonals=None,
+                  n_workers=None, block_size=BLOCK_SIZE):
+    """
+    Parse and bin a contact file with multiple processes.
+
+    Args:
+        file (str): file name
+        columns (list): column indices (see pyHiC.loading.parsing.file_block_generator)
+        chrom (str): only keep intra-chromosomal contacts of this chromosome
+        header (bool): whether the file has a header line
+        gzip (bool): whether zipped file
+        start_pos & end_pos (int): the region to load
+        resolution (int): resolution
+        size (int or None): number of bins (None: decided by the largest bin)
+        n_diagonals (int or None): only keep the contacts on the first n_diagonals diagonals
+        n_workers (int or None): number of processes. Default: None (number of CPUs)
+        block_size (int): approximate number of bytes parsed at a time by each worker.
+            The memory of the main process is bounded by about 2 * n_workers blocks.
+
+    Return:
+        COOAccumulator with all contacts
+    """
+    chrom = chrom.encode() if isinstance(chrom, str) else chrom
+    args = (columns, chrom, start_pos, end_pos, resolution, size, n_diagonals)
+    result = COOAccumulator(size=size)
+    for partial in map_file_blocks(file, _accumulate, args, header=header, gzip=gzip,
+                                   n_workers=n_workers, block_size=block_size):
+        if partial is not None:
+            result.add(*partial)
+    return result
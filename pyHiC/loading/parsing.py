@@ -0,0 +1,311 @@
+"""
+Block parsing of contact files and accumulation of binned contacts.
+"""
+
+import time
+import warnings
+import numpy as np
+import scipy.sparse as sp
+import gzip as gz
+from ..utils.instrument import emit, enabled
+
+
+# Number of bytes read from the file at a time (approximately, lines are never split)
+BLOCK_SIZE = 1 << 24
+
+
+def _line_widths(lines):
+    """Number of whitespace-separated tokens on each line, without splitting the lines one by one."""
+    buf = np.frombuffer(b''.join(lines), dtype=np.uint8)
+    if len(buf) == 0:
+        return np.zeros((len(lines),), dtype=np.int64)
+    # Whitespace of bytes.split(): space, \t, \n, \v, \f, \r
+    space = (buf == 32) | ((buf >= 9) & (buf <= 13))
+    # A token starts at a non-space byte after a space (or at the start of the block)
+    starts = ~space
+    starts[1:] &= space[:-1]
+    offsets = np.zeros((len(lines),), dtype=np.int64)
+    offsets[1:] = np.cumsum(np.fromiter(map(len, lines[:-1]), dtype=np.int64, count=len(lines) - 1))
+    return np.add.reduceat(starts.astype(np.int64), offsets)
+
+
+def _read_table(lines, format):
+    """
+    Split a block of lines into a table of tokens.
+
+    Args:
+        lines (list): lines (bytes) read from the file
+        format (list): 5 column indices (start from 1, 0 means not available)
+
+    Return:
+        numpy.array of bytes with one row per (non-empty) line.
+        Lines with fewer columns than format needs are skipped with a warning.
+    """
+    widths = _line_widths(lines)
+    if len(widths) > 0 and widths[0] >= max(format) and np.all(widths == widths[0]):
+        return np.array(b''.join(lines).split()).reshape((len(lines), widths[0]))
+    # Ragged or blank lines: fall back to splitting line by line
+    n_cols = max(format)
+    short = int(np.sum((widths > 0) & (widths < n_cols)))
+    if short > 0:
+        warnings.warn('{0} line(s) with fewer than {1} columns skipped'.format(short, n_cols))
+    table = [line.split()[:n_cols] for line, w in zip(lines, widths) if w >= n_cols]
+    return np.array(table).reshape((-1, n_cols))
+
+
+def _table_values(table, format):
+    """Return the positions (int64) and scores (float64) in a table of tokens."""
+    p1 = table[:, format[1]-1].astype(np.int64)
+    p2 = table[:, format[3]-1].astype(np.int64)
+    if len(format) == 4 or format[4] == 0:
+        v = np.ones(len(table))
+    else:
+        v = table[:, format[4]-1].astype(np.float64)
+    return p1, p2, v
+
+
+def _parse_block(lines, chrom=None, format=None):
+    """
+    Parse a block of lines into numpy arrays.
+
+    Args:
+        lines (list): lines (bytes) read from the file
+        chrom (bytes or None): keep only contacts with both ends on this chromosome
+        format (list): 5 column indices (start from 1, 0 means not available)
+
+    Return:
+        p1, p2 (numpy.array of int64), v (numpy.array of float64)
+    """
+    table = _read_table(lines, format)
+    if format[0] != 0 and format[2] != 0:
+        if chrom is None:
+            table = table[:0]
+        else:
+            table = table[(table[:, format[0]-1] == chrom) & (table[:, format[2]-1] == chrom)]
+    return _table_values(table, format)
+
+
+def _standard_format(format):
+    if len(format) == 3:
+        format = [0, format[0], 0, format[1], format[2]]
+    if len(format) not in [4, 5]:
+        raise ValueError('Wrong custom format!')
+    return format
+
+
+def parse_format(format, custom_format=None, chromosome=None):
+    """
+    Column indices of a text format (see load_HiC).
+
+    Args:
+        format (str or None): "short", "long" or "noscore" (any case); None for custom_format
+        custom_format (str or list or None): indices (start from 1) like "2356". Default: None
+        chromosome (str or None): the chromosome to keep. Default: None
+
+    Return:
+        5 column indices (chromosome1, position1, chromosome2, position2, score; 0 means not available),
+        and the chromosome to keep (None for "short", which has no chromosome columns)
+    """
+    if format in ['short', 'Short']:
+        return _standard_format([0, 1, 0, 2, 3]), None
+    elif format in ['long', 'Long']:
+        return _standard_format([1, 2, 3, 4, 5]), chromosome
+    elif format in ['NoScore', 'noscore']:
+        return _standard_format([1, 2, 3, 4, 0]), chromosome
+    elif format is None:
+        if custom_format is None:
+            raise ValueError('Please provide file format!')
+        if isinstance(custom_format, (int, str)):
+            custom_format = [int(elm) for elm in str(custom_format)]
+        return _standard_format(list(custom_format)), chromosome
+    else:
+        raise ValueError('Unrecognized format: ' + format)
+
+
+def group_contacts(lines, format, intra_only=False):
+    """
+    Parse a block of lines and group the contacts by chromosome pair.
+
+    Args:
+        lines (list): lines (bytes) read from the file
+        format (list): 5 column indices (see parse_format)
+        intra_only (bool): only keep the intra-chromosomal contacts. Default: False
+
+    Yield:
+        chrom1, chrom2 (str; None if the format has no chromosome columns), p1, p2 (numpy.array of int64),
+        v (numpy.array of float64)
+    """
+    table = _read_table(lines, format)
+    if len(table) == 0:
+        return
+    if format[0] == 0 or format[2] == 0:
+        yield (None, None) + _table_values(table, format)
+        return
+    if intra_only:
+        table = table[table[:, format[0]-1] == table[:, format[2]-1]]
+    p1, p2, v = _table_values(table, format)
+    names, codes = np.unique(table[:, [format[0]-1, format[2]-1]], return_inverse=True)
+    codes = codes.reshape((-1, 2))
+    pair_codes = codes[:, 0] * len(names) + codes[:, 1]
+    idx = np.argsort(pair_codes, kind='stable')
+    pairs, starts = np.unique(pair_codes[idx], return_index=True)
+    ends = np.append(starts[1:], len(idx))
+    for pair, st, ed in zip(pairs, starts, ends):
+        sel = idx[st:ed]
+        yield names[pair // len(names)].decode(), names[pair % len(names)].decode(), p1[sel], p2[sel], v[sel]
+
+
+def _emit_progress(event, file, lines, n_bytes, t0):
+    seconds = max(time.perf_counter() - t0, 1e-9)
+    emit(event, file=file, lines=lines, bytes=n_bytes, seconds=seconds, lines_per_second=lines / seconds,
+         bytes_per_second=n_bytes / seconds)
+
+
+def file_lines_generator(file, header=False, gzip=False, block_size=BLOCK_SIZE):
+    """
+    Read a (zipped) text file in blocks of lines.
+
+    Yield:
+        list of lines (bytes)
+
+    Emit "parse.progress" after each block and "parse.done" at the end (see pyHiC.utils.instrument):
+    lines, bytes (uncompressed), seconds, lines_per_second, bytes_per_second.
+    """
+    count, n_bytes, t0 = 0, 0, time.perf_counter()
+    with (gz.open(file) if gzip else open(file, 'rb')) as f:
+        if header:
+            next(f)
+        while True:
+            lines = f.readlines(block_size)
+            if not lines:
+                break
+            count += len(lines)
+            if enabled():
+                n_bytes = f.tell()
+                _emit_progress('parse.progress', file, count, n_bytes, t0)
+            yield lines
+    if enabled():
+        _emit_progress('parse.done', file, count, n_bytes, t0)
+
+
+def file_block_generator(file, chrom=None, header=False, format=None, gzip=False, block_size=BLOCK_SIZE):
+    """
+    Read a contact file block by block.
+
+    Args:
+        file (str): file name
+        chrom (str): for formats with chromosome columns, only keep intra-chromosomal contacts of this chromosome
+        header (bool): whether the file has a header line
+        format (list): column indices (start from 1) of "chromosome1 - position1 - chromosome2 - position2 - score",
+            "chromosome1 - position1 - chromosome2 - position2" or "position1 - position2 - score"
+        gzip (bool): whether zipped file
+        block_size (int): approximate number of bytes parsed at a time
+
+    Yield:
+        p1, p2, v (numpy.array): positions and scores of the contacts in each block
+    """
+    format = _standard_format(format)
+    chrom = chrom.encode() if isinstance(chrom, str) else chrom
+    for lines in file_lines_generator(file, header=header, gzip=gzip, block_size=block_size):
+        yield _parse_block(lines, chrom=chrom, format=format)
+
+
+def file_line_generator(file, chrom=None, header=False, format=None, gzip=False):
+    for p1, p2, v in file_block_generator(file, chrom=chrom, header=header, format=format, gzip=gzip):
+        for elm in zip(p1.tolist(), p2.tolist(), v.tolist()):
+            yield elm
+
+
+class COOAccumulator:
+    """
+    Accumulate binned contacts and sum the duplicated ones.
+    Symmetric (intra-chromosomal) contacts are folded into the upper triangle.
+    Pending entries are compacted once there are more than max_pending of them,
+    so the memory is bounded by the number of distinct pixels instead of the number of contacts.
+
+    Args:
+        size (int or tuple or None): shape of the matrix (one int for square matrices).
+            If None, decided by the largest bin seen.
+        symmetric (bool): whether (i, j) and (j, i) are the same pixel. Default: True
+        max_pending (int): number of entries kept before compacting
+    """
+    def __init__(self, size=None, symmetric=True, max_pending=1 << 24):
+        self.shape = (size, size) if isinstance(size, (int, np.integer)) else size
+        self.symmetric = symmetric
+        self.max_pending = max_pending
+        self.max_row, self.max_col = -1, -1
+        self._rows, self._cols, self._vals = [], [], []
+        self._n_pending = 0
+
+    def add(self, b1, b2, v):
+        if len(v) == 0:
+            return
+        if self.symmetric:
+            b1, b2 = np.minimum(b1, b2), np.maximum(b1, b2)
+        self._rows.append(b1)
+        self._cols.append(b2)
+        self._vals.append(v)
+        self.max_row = max(self.max_row, int(b1.max()))
+        self.max_col = max(self.max_col, int(b2.max()))
+        self._n_pending += len(v)
+        if self._n_pending > self.max_pending:
+            self._compact()
+
+    def _compact(self):
+        mat = sp.coo_matrix(
+            (np.concatenate(self._vals), (np.concatenate(self._rows), np.concatenate(self._cols))),
+            shape=(self.max_row + 1, self.max_col + 1)
+        ).tocsr().tocoo()
+        self._rows, self._cols, self._vals = [mat.row.astype(np.int64)], [mat.col.astype(np.int64)], [mat.data]
+        self._n_pending = len(mat.data)
+
+    def _shape(self):
+        if self.shape is not None:
+            return self.shape
+        if self.symmetric:
+            n = max(self.max_col + 1, 1)
+            return n, n
+        return max(self.max_row + 1, 1), max(self.max_col + 1, 1)
+
+    def tocoo(self):
+        """Return the accumulated pixels (upper triangle only if symmetric) as a scipy.sparse.coo_matrix."""
+        if self._vals:
+            self._compact()
+            rows, cols, vals = self._rows[0], self._cols[0], self._vals[0]
+        else:
+            rows, cols, vals = np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64), np.zeros((0,))
+        return sp.coo_matrix((vals, (rows, cols)), shape=self._shape())
+
+    def tocsr(self):
+        """Return the (symmetric) contact matrix as a scipy.sparse.csr_matrix."""
+        coo = self.tocoo()
+        if not self.symmetric:
+            return coo.tocsr()
+        size = coo.shape[0]
+        # Keep an explicit (epsilon) diagonal, as the graph-based loader did
+        diag = np.arange(size)
+        off = coo.row != coo.col
+        rows = np.concatenate([diag, coo.row, coo.col[off]])
+        cols = np.concatenate([diag, coo.col, coo.row[off]])
+        vals = np.concatenate([np.full((size,), np.finfo(float).eps), coo.data, coo.data[off]])
+        return sp.csr_matrix((vals, (rows, cols)), shape=(size, size))
+
+
+def bin_contacts(p1, p2, v, start_pos=0, end_pos=-1, resolution=10000, n_diagonals=None):
+    """
+    Select the contacts within [start_pos, end_pos) and convert positions to bin indices.
+    If n_diagonals is given, only keep the contacts on the first n_diagonals diagonals.
+
+    Return:
+        b1, b2 (numpy.array of int64), v (numpy.array)
+    """
+    keep = (p1 >= start_pos) & (p2 >= start_pos)
+    if end_pos != -1:
+        keep &= (p1 < end_pos) & (p2 < end_pos)
+    if not np.all(keep):
+        p1, p2, v = p1[keep], p2[keep], v[keep]
+    b1, b2 = (p1 - start_pos) // resolution, (p2 - start_pos) // resolution
+    if n_diagonals is not None:
+        keep = np.abs(b1 - b2) < n_diagonals
+        b1, b2, v = b1[keep], b2[keep], v[keep]
+    return b1, b2, v
@@ -0,0 +1,235 @@
+"""
+pyHiC-native on-disk contact store.
+
+A store is a directory:
+    meta.json                  resolution and number of bins of each chromosome
+    <chrom1>/<chrom2>/         one folder for each (intra- or inter-chromosomal) block
+        bin1.npy, bin2.npy     pixels sorted by (bin1, bin2)
+        count.npy              contact values
+        index.npy              offsets of the pixels of each bin1 (length: n_bins1 + 1)
+Intra-chromosomal blocks only keep the upper triangle (bin1 <= bin2).
+All arrays are memory-mapped, so a region query only reads the pages it needs.
+"""
+
+import os
+import json
+import numpy as np
+import scipy.sparse as sp
+
+
+META_FILE = 'meta.json'
+ARRAYS = ['bin1', 'bin2', 'count', 'index']
+
+
+def _read_meta(path):
+    meta_file = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    tmp = os.path.join(path, META_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(path, META_FILE))
+
+
+def save_to_store(path, mat, chrom, chrom2=None, resolution=10000):
+    """
+    Save one contact map into a store (the store is created if not existing).
+    An existing block of the same chromosome(s) is overwritten.
+
+    Args:
+        path (str): the folder of the store
+        mat (numpy.array or scipy.sparse matrix): contact map
+        chrom (str): chromosome (of the rows)
+        chrom2 (str or None): chromosome of the columns for inter-chromosomal maps. Default: None (intra-chromosomal)
+        resolution (int): must be the same as the resolution of the store. Default: 10000
+    """
+    chrom2 = chrom if chrom2 is None else chrom2
+    os.makedirs(path, exist_ok=True)
+    meta = _read_meta(path)
+    if meta is None:
+        meta = {'format': 'pyHiC-store', 'version': 1, 'resolution': int(resolution), 'chromosomes': {}, 'blocks': []}
+    elif meta['resolution'] != resolution:
+        raise ValueError('Resolution {0} does not match the store ({1})!'.format(resolution, meta['resolution']))
+
+    for ch, n in [(chrom, mat.shape[0]), (chrom2, mat.shape[1])]:
+        if meta['chromosomes'].get(ch, n) != n:
+            raise ValueError('Shape of {0} does not match the store!'.format(ch))
+        meta['chromosomes'][ch] = int(n)
+
+    mat = sp.csr_matrix(mat)
+    if chrom == chrom2:
+        mat = sp.triu(mat, format='csr')
+    mat.sum_duplicates()
+    mat.sort_indices()
+    n_bins = max(mat.shape)
+    idx_type = np.int32 if n_bins < np.iinfo(np.int32).max else np.int64
+
+    folder = os.path.join(path, chrom, chrom2)
+    os.makedirs(folder, exist_ok=True)
+    bin1 = np.repeat(np.arange(mat.shape[0], dtype=idx_type), np.diff(mat.indptr))
+    np.save(os.path.join(folder, 'bin1.npy'), bin1)
+    np.save(os.path.join(folder, 'bin2.npy'), mat.indices.astype(idx_type))
+    np.save(os.path.join(folder, 'count.npy'), mat.data.astype(np.float64))
+    np.save(os.path.join(folder, 'index.npy'), mat.indptr.astype(np.int64))
+
+    if [chrom, chrom2] not in meta['blocks']:
+        meta['blocks'].append([chrom, chrom2])
+    _write_meta(path, meta)
+
+
+def write_store(path, intra, inter=None, resolution=10000):
+    """
+    Save contact maps into a store.
+
+    Args:
+        path (str): the folder of the store
+        intra (dict): {chromosome: contact map}
+        inter (dict or None): {(chromosome1, chromosome2): contact map}. Default: None
+        resolution (int): Default: 10000
+    """
+    for ch, mat in intra.items():
+        save_to_store(path, mat, ch, resolution=resolution)
+    if inter:
+        for (c1, c2), mat in inter.items():
+            save_to_store(path, mat, c1, c2, resolution=resolution)
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+class ContactStore:
+    """
+    Read-only access to a pyHiC store.
+
+    Args:
+        path (str): the folder of the store
+    """
+    def __init__(self, path):
+        meta = _read_meta(path)
+        if meta is None:
+            raise ValueError('Not a pyHiC store: ' + path)
+        self.path = path
+        self.resolution = meta['resolution']
+        self.chromosomes = meta['chromosomes']
+        self.blocks = [tuple(b) for b in meta['blocks']]
+        self._arrays = {}
+
+    def __repr__(self):
+        return 'ContactStore({0}, resolution={1}, {2} chromosomes)'.format(
+            self.path, self.resolution, len(self.chromosomes))
+
+    def block(self, chrom, chrom2=None):
+        """
+        Memory-mapped arrays of one block.
+
+        Return:
+            dict {'bin1', 'bin2', 'count', 'index': numpy.memmap}
+        """
+        key = (chrom, chrom if chrom2 is None else chrom2)
+        if key not in self._arrays:
+            if key not in self.blocks:
+                raise KeyError('Block not in the store: {0}'.format(key))
+            folder = os.path.join(self.path, *key)
+            self._arrays[key] = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+                                 for name in ARRAYS}
+        return self._arrays[key]
+
+    def bin_range(self, chrom, start=0, end=-1):
+        """
+        Convert a region [start, end) in base pairs (-1 or None: the end of the chromosome)
+        into bins [bin_start, bin_end), clipped to the chromosome.
+
+        Return:
+            bin_start, bin_end (int)
+        """
+        n = self.chromosomes[chrom]
+        b0 = max(start // self.resolution, 0)
+        b1 = n if end == -1 or end is None else min(int(np.ceil(end / self.resolution)), n)
+        return b0, max(b1, b0)
+
+    def _fetch(self, arrays, r0, r1, c0, c1, upper=False):
+        """
+        Pixels of stored rows [r0, r1) and columns [c0, c1), found by the bin-offset index.
+        c0 and c1 are ints, or arrays with the column range of each row.
+        In an upper-triangle block (upper=True), bin2 >= bin1: only the first c1 - bin1 pixels of a row are read.
+        """
+        index, bin2 = arrays['index'], arrays['bin2']
+        c0, c1 = np.broadcast_to(c0, (r1 - r0,)), np.broadcast_to(c1, (r1 - r0,))
+        lo, hi = np.asarray(index[r0:r1], dtype=np.int64), np.asarray(index[r0 + 1:r1 + 1], dtype=np.int64)
+        lengths = hi - lo
+        if upper:
+            lengths = np.clip(c1 - np.arange(r0, r1), 0, lengths)
+        # Gather the candidate pixels of all rows, then keep those in the column range of their row
+        ends = np.cumsum(lengths)
+        rows = np.repeat(np.arange(r1 - r0), lengths)
+        sel = np.repeat(lo - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+        b2 = np.asarray(bin2[sel], dtype=np.int64)
+        keep = (b2 >= c0[rows]) & (b2 < c1[rows])
+        return r0 + rows[keep], b2[keep], np.asarray(arrays['count'][sel[keep]])
+
+    def pixels(self, chrom, start=0, end=-1, chrom2=None, start2=None, end2=None):
+        """
+        Pixels of a region, as bin indices relative to the start of the region.
+        If chrom2 / start2 / end2 are not given, they are the same as chrom / start / end.
+
+        Return:
+            bin1, bin2, count (numpy.array), shape (tuple)
+        """
+        chrom2 = chrom if chrom2 is None else chrom2
+        if start2 is None and end2 is None and chrom2 == chrom:
+            start2, end2 = start, end
+        start2 = 0 if start2 is None else start2
+        end2 = -1 if end2 is None else end2
+        r0, r1 = self.bin_range(chrom, start, end)
+        c0, c1 = self.bin_range(chrom2, start2, end2)
+        shape = (r1 - r0, c1 - c0)
+
+        if chrom == chrom2:
+            arrays = self.block(chrom)
+            # Upper-triangle pixels in rows [r0, r1) and columns [c0, c1)
+            b1, b2, v = self._fetch(arrays, r0, r1, c0, c1, upper=True)
+            # Mirrored pixels: stored rows [c0, c1) and columns [r0, r1), skipping the diagonal
+            t2, t1, tv = self._fetch(arrays, c0, c1, r0, r1, upper=True)
+            off = t1 != t2
+            b1, b2, v = np.concatenate([b1, t1[off]]), np.concatenate([b2, t2[off]]), np.concatenate([v, tv[off]])
+        elif (chrom, chrom2) in self.blocks:
+            b1, b2, v = self._fetch(self.block(chrom, chrom2), r0, r1, c0, c1)
+        else:
+            b2, b1, v = self._fetch(self.block(chrom2, chrom), c0, c1, r0, r1)
+        return b1 - r0, b2 - c0, v, shape
+
+    def band(self, chrom, start=0, end=-1, n_diagonals=1):
+        """
+        Upper-triangle pixels of a region on its first n_diagonals diagonals (e.g., for BandMatrix.from_upper).
+        Only these pixels are read: O((end - start) / resolution * n_diagonals) memory.
+
+        Return:
+            bin1, bin2, count (numpy.array, bin indices relative to the start of the region), number of bins
+        """
+        r0, r1 = self.bin_range(chrom, start, end)
+        rows = np.arange(r0, r1)
+        b1, b2, v = self._fetch(self.block(chrom), r0, r1, rows, np.minimum(rows + n_diagonals, r1), upper=True)
+        return b1 - r0, b2 - r0, v, r1 - r0
+
+    def query(self, chrom, start=0, end=-1, chrom2=None, start2=None, end2=None, sparse=True):
+        """
+        Contact map of a region (chrom, start, end[, chrom2, start2, end2]).
+
+        Args:
+            chrom (str): chromosome
+            start & end (int): region in base pairs. Default: 0 and -1. (0: start, -1: end).
+            chrom2, start2, end2: the second region. Default: the same as the first region
+            sparse (bool): If True, return scipy.sparse.csr_matrix; if false, numpy.array. Default: True
+
+        Return:
+            HiC contact matrix (numpy.array or scipy.sparse.csr_matrix)
+        """
+        b1, b2, v, shape = self.pixels(chrom, start, end, chrom2, start2, end2)
+        mat = sp.csr_matrix((v, (b1, b2)), shape=shape)
+        return mat if sparse else mat.toarray()
@@ -1 +1,4 @@
-from .normalization import normalization
+from .normalization import normalization, normalization_vector, expected_vector, apply_expected, apply_bias, \
+    KR_bias, KR_balancing, ICE_bias, iterativeCorrection, filter_bins, NormalizationError
+from .cache import NormalizationCache
+from .genome import genome_bias, split_bias
@@ -0,0 +1,186 @@
+"""
+Cache of bias vectors and expected vectors, in memory (LRU) and on disk.
+
+Entries are keyed by a hash of the input (a file or a matrix) together with the chromosome,
+resolution, normalization method and parameters (and, for a file, the region and shape of the loaded matrix).
+Disk entries are written to a temporary file and then renamed, so concurrent readers
+and writers (e.g., in a process pool) never see partial files.
+"""
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+from ..utils import BandMatrix
+
+
+def _file_digest(file, sample_size=1 << 16):
+    """
+    Identify a file by its absolute path, size, modification time and the content of its first and last bytes.
+    Reading the whole file would cost as much as loading it.
+    """
+    h = hashlib.sha1()
+    st = os.stat(file)
+    h.update(os.path.abspath(file).encode())
+    h.update(str((st.st_size, st.st_mtime_ns)).encode())
+    with open(file, 'rb') as f:
+        h.update(f.read(sample_size))
+        if st.st_size > sample_size:
+            f.seek(max(st.st_size - sample_size, sample_size))
+            h.update(f.read(sample_size))
+    return h.hexdigest()
+
+
+def _matrix_digest(mat):
+    """Hash the content of a numpy.array, scipy.sparse matrix or BandMatrix."""
+    h = hashlib.sha1()
+    h.update(str(mat.shape).encode())
+    if isinstance(mat, BandMatrix):
+        arrays = [mat.data]
+    elif sp.issparse(mat):
+        mat = sp.csr_matrix(mat)
+        arrays = [mat.indptr, mat.indices, mat.data]
+    else:
+        arrays = [np.asarray(mat)]
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str(arr.dtype).encode())
+        h.update(memoryview(arr).cast('B'))
+    return h.hexdigest()
+
+
+class NormalizationCache:
+    """
+    In-memory LRU cache plus an on-disk store of normalization vectors (numpy.array).
+
+    Args:
+        cache_dir (str or None): folder of the disk store. Default: None (memory only)
+        max_items (int): max number of vectors kept in memory. Default: 64
+        max_disk_bytes (int or None): max total size of the disk store; the least recently used files
+            are removed first. Default: None (no limit)
+    """
+    def __init__(self, cache_dir=None, max_items=64, max_disk_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return 'NormalizationCache({0}, {1})'.format(self.cache_dir, self.stats())
+
+    @staticmethod
+    def make_key(file=None, mat=None, chromosome=None, resolution=None, method=None, params=None,
+                 region=None, shape=None):
+        """
+        Key of one normalization vector.
+
+        Args:
+            file (str or None): the input file
+            mat (matrix or None): the input matrix (hashed if file is None)
+            chromosome (str or None), resolution (int or None), method (str or None): identify the input
+            params (dict or None): parameters of the normalization method
+            region (tuple or None): (start, end) of the region loaded from the file. Default: None
+            shape (tuple or None): shape of the matrix loaded from the file (and the number of diagonals of a band).
+                Default: None
+
+        Return:
+            str
+        """
+        if file is None and mat is None:
+            raise ValueError('Please provide the input file or matrix!')
+        source = _file_digest(file) if file is not None else _matrix_digest(mat)
+        desc = json.dumps([source, chromosome, resolution, None if method is None else method.lower(),
+                           {k: str(v) for k, v in sorted((params or {}).items())},
+                           None if region is None else [int(x) for x in region],
+                           None if shape is None else [int(x) for x in shape]])
+        return hashlib.sha1(desc.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached vector or None."""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+        if self.cache_dir is not None:
+            path = self._path(key)
+            try:
+                value = np.load(path)
+                os.utime(path)
+            except (OSError, ValueError, EOFError):
+                # Missing, or removed / replaced by another process while reading
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self._remember(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = np.asarray(value)
+        self._remember(key, value)
+        if self.cache_dir is None:
+            return
+        tmp = os.path.join(self.cache_dir, '{0}.{1}.tmp.npy'.format(key, os.getpid()))
+        np.save(tmp, value)
+        os.replace(tmp, self._path(key))
+        if self.max_disk_bytes is not None:
+            self._evict()
+
+    def get_or_compute(self, key, func):
+        """Return the cached vector, or compute it with func() and cache it."""
+        value = self.get(key)
+        if value is None:
+            value = func()
+            self.put(key, value)
+        return value
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy') or '.tmp.' in name:
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self, disk=False):
+        """Empty the memory cache (and the disk store if disk=True)."""
+        self._memory.clear()
+        if disk and self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npy'):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        """Hit / miss counters of this process."""
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'items': len(self._memory)}
@@ -0,0 +1,227 @@
+"""
+Genome-wide balancing (ICE or KR) of a pyHiC store, including the inter-chromosomal blocks.
+
+The genome-wide map is never built: every iteration streams the memory-mapped pixels of the store in chunks
+and only accumulates vectors of the length of the genome (in bins). Each stored pixel (i, j) of the genome
+adds to bins i and j, so the upper-triangle intra blocks and the one-sided inter blocks make a symmetric map.
+Chunks are split across worker processes; each worker returns one vector per pass,
+so the memory is O(number of bins * number of workers + chunk_size) and does not depend on the number of pixels.
+"""
+
+import os
+import time
+import logging
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .normalization import _kr_scaling, _select_bins, NormalizationError
+from ..utils.instrument import emit, enabled, phase
+
+
+GENOME_METHODS = ['ice', 'kr']
+
+# Stores opened by each process
+_STORES = {}
+
+
+def _open_store(path):
+    from ..loading import ContactStore
+    if path not in _STORES:
+        _STORES[path] = ContactStore(path)
+    return _STORES[path]
+
+
+def _offsets(store, chromosomes):
+    """Position of the first bin of each chromosome in the genome-wide vector, and the number of bins."""
+    offsets, n = {}, 0
+    for ch in chromosomes:
+        offsets[ch] = n
+        n += store.chromosomes[ch]
+    return offsets, n
+
+
+def _chunks(store, chromosomes, trans, chunk_size):
+    """(chrom1, chrom2, first pixel, last pixel) of the blocks between the chromosomes."""
+    selected = set(chromosomes)
+    chunks = []
+    for c1, c2 in store.blocks:
+        if c1 not in selected or c2 not in selected or (c1 != c2 and not trans):
+            continue
+        n_pixels = len(store.block(c1, c2)['count'])
+        chunks.extend((c1, c2, lo, min(lo + chunk_size, n_pixels)) for lo in range(0, n_pixels, chunk_size))
+    return chunks
+
+
+def _product(path, chunks, offsets, index, x, ignore_diags=0, nnz=False):
+    """
+    Product of the genome-wide map (restricted to the bins with index >= 0) and x, over some chunks.
+
+    Args:
+        index (numpy.array): position of each genome bin in x (-1 for removed bins)
+        nnz (bool): count the non-zero pixels instead (every value is 1)
+    """
+    store = _open_store(path)
+    y = np.zeros((len(x),))
+    for c1, c2, lo, hi in chunks:
+        arrays = store.block(c1, c2)
+        b1 = np.asarray(arrays['bin1'][lo:hi], dtype=np.int64)
+        b2 = np.asarray(arrays['bin2'][lo:hi], dtype=np.int64)
+        v = np.asarray(arrays['count'][lo:hi], dtype=np.float64)
+        keep = v > np.finfo(float).eps
+        if c1 == c2 and ignore_diags > 0:
+            keep &= (b2 - b1) >= ignore_diags
+        r, c = index[b1 + offsets[c1]], index[b2 + offsets[c2]]
+        keep &= (r >= 0) & (c >= 0)
+        r, c, v = r[keep], c[keep], np.ones((keep.sum(),)) if nnz else v[keep]
+        off = r != c
+        y += np.bincount(r, weights=v * x[c], minlength=len(x))
+        y += np.bincount(c[off], weights=v[off] * x[r[off]], minlength=len(x))
+    return y
+
+
+def _product_task(args):
+    return _product(*args)
+
+
+def _group_mean(values, groups):
+    """Mean of the values in each group, for each value."""
+    return (np.bincount(groups, weights=values) / np.bincount(groups))[groups]
+
+
+def _ice(dot, groups, max_iteration, tolerance, level):
+    """
+    Iterative correction of a matrix given by its product dot(vector). Return the bias (mean: 1 in each group).
+    The marginals are scaled by the mean of their group: independent blocks (e.g., chromosomes without
+    inter-chromosomal contacts) must be balanced separately.
+    """
+    n = len(groups)
+    bias = np.ones((n,))
+    report = enabled(level)
+    start_time = time.perf_counter()
+    deviation, iternum = np.inf, 0
+    for iternum in range(1, max_iteration + 1):
+        # Marginals of the corrected map: sum_j mat[i, j] / (bias[i] * bias[j])
+        s = dot(1 / bias) / bias
+        s = s / _group_mean(s, groups) if n > 0 else s
+        deviation = np.abs(s - 1).max() if n > 0 else 0
+        bias *= s
+        if report:
+            seconds = time.perf_counter() - start_time
+            emit('ice.iteration', level=level, iteration=iternum, deviation=deviation, seconds=seconds,
+                 eta_seconds=seconds / iternum * (max_iteration - iternum))
+        if deviation < tolerance:
+            break
+    else:
+        warnings.warn("[iterative correction] Max {} iterations reached (max delta - 1 = {}).".format(
+            max_iteration, deviation))
+    if report:
+        emit('ice.done', level=level, iterations=iternum, deviation=deviation, converged=bool(deviation < tolerance),
+             n_bins=n, seconds=time.perf_counter() - start_time)
+    return bias / _group_mean(bias, groups) if n > 0 else bias
+
+
+def genome_bias(store, method='ICE', chromosomes=None, trans=True, max_iteration=50, tolerance=1e-5,
+                min_nnz=0, min_count=0, mad_max=0, ignore_diags=0, chunk_size=2000000, n_workers=1, verbose=1):
+    """
+    One bias vector of the whole genome, balancing the intra- and inter-chromosomal contacts of a store together.
+
+    Args:
+        store (str or pyHiC.loading.ContactStore): the store
+        method (str): "ICE" (iterative correction) or "KR". Default: "ICE"
+        chromosomes (list or None): chromosomes to balance, in this order. Default: None (all in the store)
+        trans (bool): whether include the inter-chromosomal blocks; if False, each chromosome is balanced
+            on its own (the same as balancing each one with ICE_bias / KR_bias), but still in one vector. Default: True
+        max_iteration (int): Default: 50
+        tolerance (float): ICE: max relative deviation of the marginals; KR: norm of (row sums - 1). Default: 1e-5
+        min_nnz, min_count, mad_max (see pyHiC.normalization.filter_bins): filtering of low-coverage bins.
+            Default: no filtering
+        ignore_diags (int): ignore the first n diagonals of the intra-chromosomal blocks. Default: 0
+        chunk_size (int): number of pixels read at a time by each worker. Default: 2000000
+        n_workers (int or None): number of processes (None: number of CPUs). Default: 1
+        verbose (int, 1 or 0): log the iteration events at INFO (1) or DEBUG (0) level. Default: 1
+
+    Return:
+        numpy.array: bias of all bins of the chromosomes, one after another (see split_bias);
+        balanced = mat / (bias[i] * bias[j]), NaN for removed bins
+
+    Raise:
+        NormalizationError: if the correction produces extremely large values
+    """
+    method = method.lower()
+    if method not in GENOME_METHODS:
+        raise ValueError('Unrecognized method: {0}. Choose from {1}'.format(method, GENOME_METHODS))
+    store = _open_store(store) if isinstance(store, str) else store
+    chromosomes = list(store.chromosomes) if chromosomes is None else list(chromosomes)
+    for ch in chromosomes:
+        if ch not in store.chromosomes:
+            raise ValueError('Chromosome not in the store: ' + ch)
+    offsets, n = _offsets(store, chromosomes)
+    chunks = _chunks(store, chromosomes, trans, chunk_size)
+    n_workers = min(n_workers or os.cpu_count(), max(len(chunks), 1))
+    worker_chunks = [chunks[i::n_workers] for i in range(n_workers)]
+    level = logging.INFO if verbose else logging.DEBUG
+
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        def product(index, x, ignore=0, nnz=False):
+            if pool is None:
+                return _product(store.path, chunks, offsets, index, x, ignore, nnz)
+            tasks = [(store.path, part, offsets, index, x, ignore, nnz) for part in worker_chunks]
+            return sum(pool.map(_product_task, tasks))
+
+        with phase('genome_bias.filter', n_bins=n, chunks=len(chunks)):
+            everything, ones = np.arange(n), np.ones((n,))
+            coverage = product(everything, ones)
+            nnz = product(everything, ones, nnz=True) if min_nnz > 1 else (coverage > 0).astype(float)
+            valid = _select_bins(coverage, nnz, min_nnz, min_count, mad_max)
+            if ignore_diags > 0:
+                valid &= product(everything, ones, ignore=ignore_diags) > 0
+
+        index = np.full((n,), -1, dtype=np.int64)
+        index[valid] = np.arange(valid.sum())
+        with phase('genome_bias.' + method, n_bins=int(valid.sum()), chunks=len(chunks)):
+            if method == 'kr':
+                x = _kr_scaling(lambda vec: product(index, vec, ignore_diags), np.ones((valid.sum(),)) /
+                                np.sqrt(np.mean(coverage[valid])), max_iteration, tolerance, 0.1, 3, level)
+                bias = 1 / x
+            else:
+                # Without inter-chromosomal contacts, the chromosomes are independent
+                groups = np.zeros((n,), dtype=np.int64) if trans else \
+                    np.repeat(np.arange(len(chromosomes)), [store.chromosomes[ch] for ch in chromosomes])
+                bias = _ice(lambda vec: product(index, vec, ignore_diags), groups[valid], max_iteration, tolerance,
+                            level)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if not np.all(np.isfinite(bias)) or np.any(bias <= 0):
+        raise NormalizationError("Matrix correction produced invalid values. "
+                                 "This is often caused by bins of low counts. Use a more stringent "
+                                 "filtering of bins.")
+    total_bias = np.full((n,), np.nan)
+    total_bias[valid] = bias
+    return total_bias
+
+
+def split_bias(bias, store, chromosomes=None):
+    """
+    Split a genome-wide bias vector (from genome_bias) by chromosome.
+
+    Args:
+        bias (numpy.array): genome-wide bias
+        store (str or pyHiC.loading.ContactStore or dict): the store, or {chromosome: number of bins}
+        chromosomes (list or None): the chromosomes given to genome_bias. Default: None (all, in the order of the store)
+
+    Return:
+        dict {chromosome: numpy.array}
+    """
+    store = _open_store(store) if isinstance(store, str) else store
+    sizes = store if isinstance(store, dict) else store.chromosomes
+    chromosomes = list(sizes) if chromosomes is None else list(chromosomes)
+    parts, start = {}, 0
+    for ch in chromosomes:
+        parts[ch] = bias[start:start + sizes[ch]]
+        start += sizes[ch]
+    if start != len(bias):
+        raise ValueError('The bias has {0} bins but the chromosomes have {1}!'.format(len(bias), start))
+    return parts
@@ -1,205 +1,572 @@
 import numpy as np
 import scipy.sparse as sp
 import time
+import logging
 import warnings
+from ..utils import BandMatrix
+from ..utils.instrument import emit, enabled, phase
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 
 
-def normalization(mat, method, **kwargs):
-    if method.lower() not in ['oe', 'kr', 'vc', 'vc_sqrt', 'ic']:
-        print("Normalization operation not in ['OE', 'KR', 'VC', 'VC_SQRT', 'IC']. Normalization omitted.")
-
-    sparse = isinstance(mat, sp.csr_matrix)
-
-    if method.lower() == 'oe':
-        if sparse:
-            l = mat.shape[0]
-            sm_strata = np.zeros((l,))
-            new_mat = mat.tocoo()
-            for r, c, v in zip(new_mat.row, new_mat.col, new_mat.data):
-                sm_strata[abs(r - c)] += v
-            mean_strata = sm_strata / np.arange(l, 0, -1)
-            vs = []
-            for r, c, v in zip(new_mat.row, new_mat.col, new_mat.data):
-                vs.append(v / mean_strata[abs(r - c)])
-            mat = sp.csr_matrix((vs, (new_mat.row, new_mat.col)), shape=mat.shape)
+METHODS = ['oe', 'kr', 'vc', 'vc_sqrt', 'ic']
+# Fields of the cache_key argument of normalization, and the parameters which do not change the result
+CACHE_KEY_FIELDS = ['file', 'chromosome', 'resolution', 'start', 'end']
+NON_SEMANTIC_PARAMS = ['verbose']
 
-        else:
-            averages = np.array([np.mean(np.diag(mat[i:, :len(mat)-i])) for i in range(len(mat))])
-            averages = np.where(averages == 0, 1, averages)
-            for i in range(len(mat)):
-                for j in range(i, len(mat)):
-                    val = mat[i, j] / averages[abs(i - j)]
-                    mat[i, j] = val
-                    mat[j, i] = val
-
-    if method.lower() == 'vc':
-        if sparse:
-            sm = 1 / mat.sum(axis=0).toarray().flatten()
-            sm_ = sp.diags(np.where(sm == 0, 1, sm), 0)
-            mat = sm_ * mat * sm_
-        else:
-            sm = np.sum(mat, axis=0)
-            sm_ = np.diag(1 / np.where(sm == 0, 1, sm))
-            mat = sm_.dot(mat).dot(sm_)
-
-    if method.lower() == 'vc_sqrt':
-        if sparse:
-            sm = 1 / np.sqrt(mat.sum(axis=0).toarray().flatten())
-            sm_ = sp.diags(np.where(sm == 0, 1, sm), 0)
-            mat = sm_ * mat * sm_
-        else:
-            sm = np.sqrt(np.sum(mat, axis=0))
-            sm_ = np.diag(1 / np.where(sm == 0, 1, sm))
-            mat = sm_.dot(mat).dot(sm_)
-
-    if method.lower() == 'kr':
-        if sparse:
-            mat = mat.toarray()
-
-        tolerance = kwargs.pop('tolerance', 1e-5)
-        verbose = kwargs.pop('verbose', 1)
-        max_iteration = kwargs.pop('max_iteration', 50)
-        # Remove all-zero rows and columns
-        sm = mat.sum(axis=0).toarray().flatten() if sparse else np.sum(mat, axis=0)
-        zeros = []
-        for i in range(len(sm)):
-            if sm[i] == 0:
-                zeros.append(i)
-
-        mat = np.delete(mat, zeros, axis=0)
-        mat = np.delete(mat, zeros, axis=1)
-
-        # Iteration
-        x = np.random.random(size=len(mat))
-        new_x = None
-        if verbose:
-            print("[KR Norm] starting iterative correction")
-        start_time = time.time()
-        for _iter in range(max_iteration):
-            aa = np.diag(x).dot(mat) + np.diag(mat.dot(x))
-            aa = np.linalg.inv(aa)
-            bb = np.diag(x).dot(mat).dot(x) - np.ones(x.shape)
-            delta = aa.dot(bb)
-            new_x = x - aa.dot(bb)
-
-            max_error = np.sum(np.abs(delta))
-            # print(f'Iteration: {k}, Max Error: {max_error}')
-            if verbose:
-                if _iter % 2 == 1:
-                    end_time = time.time()
-                    estimated = (float(max_iteration - _iter - 1) * (end_time - start_time)) / (_iter + 1)
-                    m, sec = divmod(estimated, 60)
-                    h, m = divmod(m, 60)
-                    print("[KR Norm] pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(_iter, h, m, sec))
-                    # print("max delta - 1 = {} ".format(deviation))
-
-            if max_error < tolerance:
-                if verbose:
-                    print("[KR Norm] {} iterations used\n".format(_iter + 1))
-                break
+
+def normalization(mat, method, **kwargs):
+    """
+    Normalize a Hi-C contact map.
+
+    Args:
+        mat (numpy.array or scipy.sparse.csr_matrix or pyHiC.utils.BandMatrix): contact map
+        method (str): "OE", "VC", "VC_SQRT", "KR" or "IC"
+        kwargs: for OE, expected (numpy.array): a precomputed expected vector (see expected_vector);
+            for KR and IC, max_iteration (int), tolerance (float) and verbose (int, see KR_bias);
+            for IC, also the other arguments of iterativeCorrection (e.g., min_nnz, mad_max, ignore_diags, dtype);
+            return_bias (bool): whether also return the bias vector (None for OE). Default: False
+            cache (pyHiC.normalization.NormalizationCache): reuse the bias / expected vector computed before. Default: None
+            cache_key (dict): identify the input with dict(file=..., chromosome=..., resolution=...,
+                start=..., end=...) instead of hashing the matrix; start and end (in base pairs, default: 0 and -1)
+                are the region loaded from the file. The shape of the matrix (and the number of diagonals of
+                a BandMatrix) is always part of the key. Other fields raise ValueError. Default: None
+
+    Return:
+        normalized contact map (same type as the input), and the bias vector if return_bias.
+        The balanced map is mat[i, j] / (bias[i] * bias[j]); removed (all-zero) bins have a bias of NaN.
+        Row sums of a BandMatrix (VC, VC_SQRT) are taken over the stored band.
+    """
+    return_bias = kwargs.pop('return_bias', False)
+    cache = kwargs.pop('cache', None)
+    cache_key = kwargs.pop('cache_key', None)
+    method = method.lower()
+    if method not in METHODS:
+        warnings.warn("Normalization operation not in ['OE', 'KR', 'VC', 'VC_SQRT', 'IC']. Normalization omitted.")
+        return (mat, None) if return_bias else mat
+
+    with phase('normalization.' + method, n_bins=mat.shape[0]):
+        if method == 'oe' and kwargs.get('expected') is not None:
+            vector = kwargs.pop('expected')
+        elif cache is not None:
+            cache_key = dict(cache_key or {})
+            if set(cache_key) - set(CACHE_KEY_FIELDS):
+                raise ValueError('cache_key can only have {0}, got {1}'.format(CACHE_KEY_FIELDS, sorted(cache_key)))
+            # Only the parameters which change the result are part of the key
+            params = {k: v for k, v in kwargs.items() if k not in NON_SEMANTIC_PARAMS}
+            region = (cache_key.pop('start', 0), cache_key.pop('end', -1))
+            if 'file' in cache_key:
+                # Regions, bands and coarsened copies of the same file are different inputs
+                shape = list(mat.shape) + ([mat.n_diagonals] if isinstance(mat, BandMatrix) else [])
+                key = cache.make_key(method=method, params=params, region=region, shape=shape, **cache_key)
             else:
-                x = new_x
+                key = cache.make_key(mat=mat, method=method, params=params, **cache_key)
+            vector = cache.get_or_compute(key, lambda: normalization_vector(mat, method, **kwargs))
+            _check_vector(mat, method, vector)
         else:
-            print("[KR Norm] Max {} iterations reached. Iteration stopped.\n".format(max_iteration + 1))
+            vector = normalization_vector(mat, method, **kwargs)
 
-        # Normalization
-        dg = np.diag(new_x)
-        mat = dg.dot(mat).dot(dg)
+        if method == 'oe':
+            return (apply_expected(mat, vector), None) if return_bias else apply_expected(mat, vector)
+        mat = apply_bias(mat, vector)
+        if method == 'ic' and 'dtype' in kwargs:
+            mat = mat.astype(kwargs['dtype'])
+    return (mat, vector) if return_bias else mat
 
-        # Put all-zero rows and columns back
-        for zero in zeros:
-            mat = np.insert(mat, zero, 0, axis=0)
-            mat = np.insert(mat, zero, 0, axis=1)
 
-        if sparse:
-            mat = sp.csr_matrix(mat)
+def _check_vector(mat, method, vector):
+    """A cached vector must have the length of the one normalization_vector would compute for mat."""
+    if method == 'oe':
+        n = mat.n_diagonals if isinstance(mat, BandMatrix) else mat.shape[0]
+    else:
+        n = mat.shape[0]
+    if np.ndim(vector) != 1 or len(vector) != n:
+        raise ValueError('Size not matched! The cached {0} vector has {1} values, the matrix needs {2}.'.format(
+            method, len(vector), n))
 
-    if method.lower() == 'ic':
-        mat = iterativeCorrection(mat, kwargs.pop('max_iteration', 50),
-                                  kwargs.pop('tolerance=1e-5', kwargs.pop('verbose', 1)))
 
-    return mat
+def normalization_vector(mat, method, **kwargs):
+    """
+    The vector behind a normalization method, without normalizing the map:
+    the expected vector for OE (see expected_vector),
+    or the bias vector for VC, VC_SQRT, KR and IC (normalized map: mat[i, j] / (bias[i] * bias[j])).
 
+    Args:
+        mat (numpy.array or scipy.sparse.csr_matrix or pyHiC.utils.BandMatrix): contact map
+        method (str): "OE", "VC", "VC_SQRT", "KR" or "IC"
+        kwargs: see normalization
 
-def iterativeCorrection(matrix, max_iteration=50, tolerance=1e-5, verbose=1):
+    Return:
+        numpy.array
     """
-    adapted from cytonised version in mirnylab
-    original code from: ultracorrectSymmetricWithVector
-    https://bitbucket.org/mirnylab/mirnylib/src/924bfdf5ed344df32743f4c03157b0ce49c675e6/mirnylib/numutils_new.pyx?at=default
-    Main method for correcting DS and SS read data.
-    Possibly excludes diagonal.
-    By default does iterative correction, but can perform an M-time correction
-    :param matrix: a scipy sparse matrix
-    :param tolerance: Tolerance is the maximum allowed relative
-                      deviation of the marginals.
+    method = method.lower()
+    kwargs.pop('expected', None)
+    if method == 'oe':
+        return expected_vector(mat)
+
+    if method in ['vc', 'vc_sqrt']:
+        sm = mat.sum(axis=0) if isinstance(mat, BandMatrix) else np.asarray(mat.sum(axis=0)).flatten()
+        sm = np.where(sm == 0, np.nan, sm.astype(float))
+        return np.sqrt(sm) if method == 'vc_sqrt' else sm
+
+    if isinstance(mat, BandMatrix):
+        # Balance the band as a sparse matrix (O(N * k) memory)
+        mat = mat.tocsr()
+    if method == 'kr':
+        return KR_bias(mat, max_iteration=kwargs.pop('max_iteration', 50),
+                       tolerance=kwargs.pop('tolerance', 1e-5),
+                       verbose=kwargs.pop('verbose', 1))
+    if method == 'ic':
+        return ICE_bias(mat, max_iteration=kwargs.pop('max_iteration', 50),
+                        tolerance=kwargs.pop('tolerance', 1e-5),
+                        verbose=kwargs.pop('verbose', 1), **kwargs)
+    raise ValueError('Unrecognized normalization method: ' + method)
+
+
+def expected_vector(mat, n_strata=None):
+    """
+    Expected contact value at each distance: the average of each stratum (diagonal).
+    Compute it once per chromosome and reuse it for any region or band of this chromosome (see apply_expected).
+    Each diagonal is counted once (only the upper triangle of a sparse map is read), so dense, sparse and band maps
+    give the same vector. (The former OE normalization of sparse maps summed both triangles: its expected values
+    were doubled off the diagonal, and its OE values half those of the same dense map.)
+
+    Args:
+        mat (numpy.array or scipy.sparse matrix or pyHiC.utils.BandMatrix): symmetric contact map
+        n_strata (int or None): only compute the first n strata. Default: None (all strata)
+
+    Return:
+        numpy.array: expected[d] = mean of the d-th diagonal
+    """
+    N = mat.shape[0]
+    if isinstance(mat, BandMatrix):
+        sums = mat.data.sum(axis=1)
+    elif sp.issparse(mat):
+        coo = sp.triu(mat).tocoo()
+        sums = np.bincount(coo.col - coo.row, weights=coo.data, minlength=N)
+    else:
+        mat = np.asarray(mat)
+        sums = np.array([np.trace(mat, d) for d in range(N)])
+    n_strata = len(sums) if n_strata is None else min(n_strata, len(sums))
+    return sums[:n_strata] / (N - np.arange(n_strata))
+
+
+def apply_expected(mat, expected, start=0, start2=None):
+    """
+    Divide each contact by the expected value at its distance (observed / expected).
+    Strata beyond the length of the expected vector become zero; for a BandMatrix, the expected vector must cover
+    all its diagonals (ValueError otherwise).
+    Strata with an expected value of zero keep the observed values.
+
+    Args:
+        mat (numpy.array or scipy.sparse matrix or pyHiC.utils.BandMatrix): contact map of a region
+        expected (numpy.array): expected vector of the chromosome (see expected_vector)
+        start (int): the first bin of the rows in the chromosome. Default: 0
+        start2 (int or None): the first bin of the columns in the chromosome. Default: None (same as start)
+
+    Return:
+        observed / expected contact map (same type as the input)
+    """
+    start2 = start if start2 is None else start2
+    expected = np.asarray(expected, dtype=float)
+    if expected.ndim != 1 or len(expected) == 0:
+        raise ValueError('The expected vector must be a non-empty 1-D array!')
+    if isinstance(mat, BandMatrix) and len(expected) < min(mat.n_diagonals, mat.shape[0]):
+        raise ValueError('Size not matched! The expected vector has {0} strata, the band has {1}.'.format(
+            len(expected), min(mat.n_diagonals, mat.shape[0])))
+    expected = np.where(expected == 0, 1, expected)
+    inv = np.append(1 / expected, 0)
+    n = len(expected)
+
+    if isinstance(mat, BandMatrix):
+        if start != start2:
+            raise ValueError('A BandMatrix must be on the diagonal!')
+        return BandMatrix(mat.data * inv[np.minimum(np.arange(mat.n_diagonals), n)][:, np.newaxis], copy=False)
+    if sp.issparse(mat):
+        coo = sp.coo_matrix(mat)
+        dist = np.minimum(np.abs((coo.row + start) - (coo.col + start2)), n)
+        return sp.csr_matrix((coo.data * inv[dist], (coo.row, coo.col)), shape=mat.shape)
+    mat = np.asarray(mat)
+    dist = np.abs(np.arange(start, start + mat.shape[0])[:, np.newaxis] -
+                  np.arange(start2, start2 + mat.shape[1])[np.newaxis, :])
+    return mat * inv[np.minimum(dist, n)]
+
+
+def apply_bias(mat, bias, bias2=None):
+    """
+    Balance a contact map with a precomputed bias vector: mat[i, j] / (bias[i] * bias2[j]).
+    Bins with a bias of NaN (or 0) become all-zero.
+    To balance a region (e.g., queried from a pyHiC store), slice the bias of the chromosome with the bins of the region.
+
+    Args:
+        mat (numpy.array or scipy.sparse matrix or pyHiC.utils.BandMatrix): contact map
+        bias (numpy.array): bias of the rows
+        bias2 (numpy.array or None): bias of the columns, for non-square regions. Default: None (same as bias)
+
+    Return:
+        balanced contact map (same type as the input)
+    """
+    def _scale(_bias):
+        _valid = np.isfinite(_bias) & (_bias != 0)
+        _scale = np.zeros(len(_bias))
+        _scale[_valid] = 1 / _bias[_valid]
+        return _scale
+
+    scale = _scale(np.asarray(bias, dtype=float))
+    scale2 = scale if bias2 is None else _scale(np.asarray(bias2, dtype=float))
+    if len(scale) != mat.shape[0] or len(scale2) != mat.shape[1]:
+        raise ValueError('Size not matched!')
+    if isinstance(mat, BandMatrix):
+        if bias2 is not None:
+            raise ValueError('A BandMatrix can only be balanced with one bias vector!')
+        return mat.scale(scale)
+    if sp.issparse(mat):
+        coo = sp.coo_matrix(mat)
+        data = coo.data * scale[coo.row] * scale2[coo.col]
+        return sp.csr_matrix((data, (coo.row, coo.col)), shape=mat.shape)
+    return mat * scale[:, np.newaxis] * scale2[np.newaxis, :]
+
+
+def _kr_scaling(dot, x, max_iteration, tolerance, delta, Delta, level):
+    """
+    Inner-outer iteration of KR balancing on a matrix given by its product dot(vector),
+    starting from the scaling x. Return the scaling (balanced = x[i] * mat[i, j] * x[j]).
+    """
+    n = len(x)
+    e = np.ones(n)
+    g, eta_max = 0.9, 0.1
+    eta = eta_max
+    stop_tol = tolerance * 0.5
+    rt = tolerance ** 2
+    v = x * dot(x)
+    rk = 1 - v
+    rho_km1 = rk.dot(rk)
+    rout = rold = rho_km1
+    n_iter = 0
+    report = enabled(level)
+    start_time = time.perf_counter()
+    while rout > rt and n_iter < max_iteration:
+        n_iter += 1
+        y = e.copy()
+        inner_tol = max(eta ** 2 * rout, rt)
+        k, rho_km2, p, Z = 0, None, None, None
+        # Inner iteration: conjugate gradient
+        while rho_km1 > inner_tol:
+            k += 1
+            if k == 1:
+                Z = rk / v
+                p = Z
+                rho_km1 = rk.dot(Z)
+            else:
+                p = Z + (rho_km1 / rho_km2) * p
+            w = x * dot(x * p) + v * p
+            alpha = rho_km1 / p.dot(w)
+            ap = alpha * p
+            y_new = y + ap
+            if np.min(y_new) <= delta:
+                if delta == 0:
+                    break
+                ind = ap < 0
+                y = y + np.min((delta - y[ind]) / ap[ind]) * ap
+                break
+            if np.max(y_new) >= Delta:
+                ind = y_new > Delta
+                y = y + np.min((Delta - y[ind]) / ap[ind]) * ap
+                break
+            y = y_new
+            rk = rk - alpha * w
+            rho_km2 = rho_km1
+            Z = rk / v
+            rho_km1 = rk.dot(Z)
+
+        x = x * y
+        v = x * dot(x)
+        rk = 1 - v
+        rho_km1 = rk.dot(rk)
+        rout = rho_km1
+        rat = rout / rold
+        rold = rout
+        eta_o = eta
+        eta = g * rat
+        if g * eta_o ** 2 > 0.1:
+            eta = max(eta, g * eta_o ** 2)
+        eta = max(min(eta, eta_max), stop_tol / np.sqrt(rout))
+
+        if report:
+            seconds = time.perf_counter() - start_time
+            emit('kr.iteration', level=level, iteration=n_iter, residual=np.sqrt(rout), inner_iterations=k,
+                 seconds=seconds, eta_seconds=seconds / n_iter * (max_iteration - n_iter))
+
+    if rout > rt:
+        warnings.warn("[KR Norm] Max {} iterations reached (residual = {}).".format(max_iteration, np.sqrt(rout)))
+    if report:
+        emit('kr.done', level=level, iterations=n_iter, residual=np.sqrt(rout), converged=bool(rout <= rt),
+             n_bins=n, seconds=time.perf_counter() - start_time)
+    return x
+
+
+def KR_bias(mat, max_iteration=50, tolerance=1e-5, verbose=1, delta=0.1, Delta=3):
+    """
+    Bias vector of Knight-Ruiz matrix balancing with the inner-outer (Newton - conjugate gradient) iteration from
+    Knight & Ruiz (2013), "A fast algorithm for matrix balancing", IMA J. Numer. Anal.
+    Only uses matrix-vector products, so sparse input stays sparse.
+
+    Args:
+        mat (numpy.array or scipy.sparse.csr_matrix): symmetric contact map
+        max_iteration (int): max number of outer (Newton) iterations. Default: 50
+        tolerance (float): stop when the norm of (row sums - 1) is below it. Default: 1e-5
+        verbose (int, 1 or 0): log the "kr.iteration" / "kr.done" events at INFO (1) or DEBUG (0) level
+            (see pyHiC.utils.instrument). Default: 1
+        delta, Delta (float): lower and upper bounds of the step in the inner iteration
+
+    Return:
+        bias vector (balanced = mat / (bias[i] * bias[j]), NaN for all-zero bins)
+    """
+    sparse = sp.issparse(mat)
+    if sparse:
+        mat = sp.csr_matrix(mat, dtype=float)
+    sm = np.asarray(mat.sum(axis=0)).flatten()
+    # Remove all-zero rows and columns with an index mask
+    # (bins only holding the epsilon diagonal added by load_HiC are empty as well)
+    valid = np.flatnonzero(sm > np.finfo(float).eps)
+    A = mat[valid][:, valid] if sparse else np.asarray(mat, dtype=float)[np.ix_(valid, valid)]
+
+    # Start from a uniform scaling with average row sums of one
+    x = _kr_scaling(A.dot, np.ones(A.shape[0]) / np.sqrt(np.mean(sm[valid])), max_iteration, tolerance,
+                    delta, Delta, logging.INFO if verbose else logging.DEBUG)
+
+    bias = np.full(mat.shape[0], np.nan)
+    bias[valid] = 1 / x
+    return bias
+
+
+def KR_balancing(mat, max_iteration=50, tolerance=1e-5, verbose=1, delta=0.1, Delta=3):
+    """
+    Knight-Ruiz matrix balancing (see KR_bias).
+
+    Return:
+        balanced contact map (same type as the input), bias vector
+    """
+    bias = KR_bias(mat, max_iteration=max_iteration, tolerance=tolerance, verbose=verbose, delta=delta, Delta=Delta)
+    return apply_bias(mat, bias), bias
+
+
+class NormalizationError(RuntimeError):
+    """Raised when balancing fails (e.g., produces extremely large values)."""
+    pass
+
+
+def _marginals(row, col, data, n):
+    """Row sums of a symmetric matrix given by its upper triangle (data=None: number of pixels)."""
+    # The diagonal is counted twice and removed once (no copies of the off-diagonal pixels)
+    diag = np.flatnonzero(row == col)
+    return np.bincount(row, weights=data, minlength=n) + np.bincount(col, weights=data, minlength=n) - \
+        np.bincount(row[diag], weights=None if data is None else data[diag], minlength=n)
+
+
+def filter_bins(matrix, min_nnz=0, min_count=0, mad_max=0):
+    """
+    Select the bins to balance.
+
+    Args:
+        matrix (numpy.array or scipy.sparse matrix): symmetric contact map
+        min_nnz (int): remove bins with fewer non-zero pixels. Default: 0
+        min_count (float): remove bins with a lower coverage (row sum). Default: 0
+        mad_max (float): remove bins whose log-coverage is more than mad_max median absolute deviations
+            below the median. 0 to disable. Default: 0
+
+    Return:
+        numpy.array (bool): whether each bin is kept. All-zero bins are always removed.
+    """
+    coo = sp.coo_matrix(matrix)
+    upper = coo.row <= coo.col
+    return _filter_upper(coo.row[upper], coo.col[upper], coo.data[upper], matrix.shape[0], min_nnz, min_count,
+                         mad_max)
+
+
+def _filter_upper(row, col, data, n, min_nnz=0, min_count=0, mad_max=0):
+    """filter_bins of a symmetric matrix given by its upper triangle."""
+    nz = data > np.finfo(float).eps
+    if not np.all(nz):
+        row, col, data = row[nz], col[nz], data[nz]
+    coverage = _marginals(row, col, data, n)
+    nnz = _marginals(row, col, None, n)
+    return _select_bins(coverage, nnz, min_nnz, min_count, mad_max)
+
+
+def _asymmetry(csr, chunk_size=1 << 20):
+    """Sum of |mat[i, j] - mat[j, i]| and of |mat[i, j]| over i < j, for a csr matrix in canonical format."""
+    t = csr.T.tocsr()
+    if np.array_equal(csr.indptr, t.indptr):
+        # Compared in chunks to avoid temporary arrays of the size of the matrix
+        diff = 0
+        for lo in range(0, csr.nnz, chunk_size):
+            hi = min(lo + chunk_size, csr.nnz)
+            if not np.array_equal(csr.indices[lo:hi], t.indices[lo:hi]):
+                break
+            diff += np.abs(csr.data[lo:hi] - t.data[lo:hi]).sum() / 2
+        else:
+            t = None
+    if t is not None:
+        diff = abs(csr - t).sum() / 2
+    return diff, (np.abs(csr.data).sum() - np.abs(csr.diagonal()).sum()) / 2
+
+
+def _select_bins(coverage, nnz, min_nnz=0, min_count=0, mad_max=0):
+    """The filters of filter_bins, given the coverage and the number of non-zero pixels of each bin."""
+    valid = (coverage > 0) & (nnz >= max(min_nnz, 1)) & (coverage >= min_count)
+    if mad_max > 0 and np.any(valid):
+        log_cov = np.log(coverage[valid])
+        med = np.median(log_cov)
+        mad = np.median(np.abs(log_cov - med))
+        valid[valid] = log_cov >= med - mad_max * mad
+    return valid
+
+
+def ICE_bias(matrix, max_iteration=50, tolerance=1e-5, verbose=1,
+             min_nnz=0, min_count=0, mad_max=0, ignore_diags=0, dtype=np.float64):
     """
-    sparse = isinstance(matrix, sp.csr_matrix)
-    total_bias = np.ones(matrix.shape[0], 'float64')
+    Bias vector of iterative correction (see iterativeCorrection for the arguments).
+    Only the pixels of the upper triangle are kept and corrected in place, so sparse input is never densified.
 
-    if np.isnan(np.sum(matrix)):
-        print("[iterative correction] the matrix contains nans, they will be replaced by zeros.")
-        matrix.data[np.isnan(matrix.data)] = 0
+    Return:
+        bias vector (balanced = matrix / (bias[i] * bias[j]), NaN for removed bins)
 
-    matrix = matrix.astype(float)
-    W = matrix.tocoo()
+    Raise:
+        ValueError: if the matrix is not symmetric
+        NormalizationError: if the correction produces extremely large values
+    """
+    return _ice_upper(matrix, max_iteration, tolerance, verbose, min_nnz, min_count, mad_max, ignore_diags, dtype)[0]
 
-    if np.abs(matrix - matrix.T).mean() / (1. * np.abs(matrix.mean())) > 1e-10:
+
+def _ice_upper(matrix, max_iteration, tolerance, verbose, min_nnz, min_count, mad_max, ignore_diags, dtype):
+    """
+    Iterative correction of the upper triangle of a symmetric matrix.
+    Besides the pixel indices (int32 if possible), only one array of dtype is kept during the iterations.
+
+    Return:
+        bias vector, and the balanced pixels of the upper triangle (row, col, data of dtype)
+    """
+    n = matrix.shape[0]
+    csr = sp.csr_matrix(matrix)
+    if not csr.has_canonical_format:
+        csr = csr.copy()
+        csr.sum_duplicates()
+    if np.any(np.isnan(csr.data)):
+        warnings.warn("[iterative correction] the matrix contains nans, they will be replaced by zeros.")
+        csr = csr.copy()
+        csr.data[np.isnan(csr.data)] = 0
+
+    diff, total = _asymmetry(csr)
+    if diff / max(total, np.finfo(float).tiny) > 1e-10:
         raise ValueError("Please provide symmetric matrix!")
 
-    start_time = time.time()
-    if verbose:
-        print("starting iterative correction")
-    for iternum in range(max_iteration):
-        iternum += 1
-        s = np.array(W.sum(axis=1)).flatten()
-        mask = (s == 0)
-        s = s / np.mean(s[~mask])
+    index = np.int32 if n < np.iinfo(np.int32).max else np.int64
+    row = np.repeat(np.arange(n, dtype=index), np.diff(csr.indptr))
+    upper = row <= csr.indices
+    row, col, data = row[upper], csr.indices[upper].astype(index), csr.data[upper].astype(dtype)
+    del csr, upper
+
+    valid = _filter_upper(row, col, data, n, min_nnz=min_nnz, min_count=min_count, mad_max=mad_max)
+    data[~(valid[row] & valid[col])] = 0
+    if ignore_diags > 0:
+        # The ignored diagonals are set aside and only balanced at the end
+        ignored = (col - row) < ignore_diags
+        ignored_pixels = row[ignored], col[ignored], data[ignored]
+        row, col, data = row[~ignored], col[~ignored], data[~ignored]
+        valid &= _marginals(row, col, data, n) > 0
+        del ignored
+
+    total_bias = np.ones(n, 'float64')
+    level = logging.INFO if verbose else logging.DEBUG
+    report = enabled(level)
+    start_time = time.perf_counter()
+    deviation, iternum = np.inf, 0
+    for iternum in range(1, max_iteration + 1):
+        s = _marginals(row, col, data, n)
+        s = s / np.mean(s[valid])
+        s[~valid] = 1
+        deviation = np.abs(s[valid] - 1).max() if np.any(valid) else 0
 
         total_bias *= s
-        deviation = np.abs(s - 1).max()
-
-        s = 1.0 / s
-
-        # The following code  is an optimization of this
-        # for i in range(N):
-        #     for j in range(N):
-        #         W[i,j] = W[i,j] / (s[i] * s[j])
-
-        W.data *= np.take(s, W.row)
-        W.data *= np.take(s, W.col)
-        if np.any(W.data > 1e100):
-            print("*Error* matrix correction is producing extremely large values. "
-                      "This is often caused by bins of low counts. Use a more stringent "
-                      "filtering of bins.")
-            exit(1)
-        if verbose:
-            if iternum % 5 == 0:
-                end_time = time.time()
-                estimated = (float(max_iteration - iternum - 1) * (end_time - start_time)) / (iternum + 1)
-                m, sec = divmod(estimated, 60)
-                h, m = divmod(m, 60)
-                print("pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(iternum + 1, h, m, sec))
-                print("max delta - 1 = {} ".format(deviation))
+        s = (1.0 / s).astype(dtype)
+        # In place: W[i, j] = W[i, j] / (s[i] * s[j])
+        data *= np.take(s, row)
+        data *= np.take(s, col)
+        if np.any(data > 1e100):
+            raise NormalizationError("Matrix correction is producing extremely large values. "
+                                     "This is often caused by bins of low counts. Use a more stringent "
+                                     "filtering of bins.")
+        if report:
+            seconds = time.perf_counter() - start_time
+            emit('ice.iteration', level=level, iteration=iternum, deviation=deviation, seconds=seconds,
+                 eta_seconds=seconds / iternum * (max_iteration - iternum))
 
         if deviation < tolerance:
-            print("[iterative correction] {} iterations used\n".format(iternum + 1))
             break
-
-    # scale the total bias such that the sum is 1.0
-    corr = total_bias[total_bias != 0].mean()
-    total_bias /= corr
-    W.data = W.data * corr * corr
-    if np.any(W.data > 1e10):
-        print("*Error* matrix correction produced extremely large values. "
-                  "This is often caused by bins of low counts. Use a more stringent "
-                  "filtering of bins.")
-        exit(1)
-
-    if sparse:
-        return W.tocsr()
     else:
-        return W.toarray()
-
+        warnings.warn("[iterative correction] Max {} iterations reached (max delta - 1 = {}).".format(
+            max_iteration, deviation))
+    if report:
+        emit('ice.done', level=level, iterations=iternum, deviation=deviation, converged=bool(deviation < tolerance),
+             n_bins=int(valid.sum()), seconds=time.perf_counter() - start_time)
+
+    # scale the total bias such that the mean is 1.0
+    corr = total_bias[valid].mean() if np.any(valid) else 1
+    total_bias /= corr
+    total_bias[~valid] = np.nan
+    if len(data) > 0 and (not np.all(np.isfinite(data)) or data.max() * corr * corr > 1e10):
+        raise NormalizationError("Matrix correction produced extremely large values. "
+                                 "This is often caused by bins of low counts. Use a more stringent "
+                                 "filtering of bins.")
+    data *= corr * corr
+    if ignore_diags > 0:
+        # mat[i, j] / (bias[i] * bias[j]), zero for removed bins
+        scale = np.where(valid, 1 / np.where(valid, total_bias, 1), 0)
+        i_row, i_col, i_data = ignored_pixels
+        row, col = np.concatenate([row, i_row]), np.concatenate([col, i_col])
+        data = np.concatenate([data, (i_data * scale[i_row] * scale[i_col]).astype(dtype)])
+    return total_bias, row, col, data
+
+
+def iterativeCorrection(matrix, max_iteration=50, tolerance=1e-5, verbose=1,
+                        min_nnz=0, min_count=0, mad_max=0, ignore_diags=0,
+                        dtype=np.float64, return_bias=False):
+    """
+    Iterative correction (ICE) of a symmetric contact map.
+    adapted from cytonised version in mirnylab
+    original code from: ultracorrectSymmetricWithVector
+    https://bitbucket.org/mirnylab/mirnylib/src/924bfdf5ed344df32743f4c03157b0ce49c675e6/mirnylib/numutils_new.pyx?at=default
 
+    Args:
+        matrix (numpy.array or scipy.sparse matrix): symmetric contact map
+        max_iteration (int): Default: 50
+        tolerance (float): the maximum allowed relative deviation of the marginals. Default: 1e-5
+        verbose (int, 1 or 0): log the "ice.iteration" / "ice.done" events at INFO (1) or DEBUG (0) level
+            (see pyHiC.utils.instrument). Default: 1
+        min_nnz, min_count, mad_max (see filter_bins): filtering of low-coverage bins. Default: no filtering
+        ignore_diags (int): ignore the first n diagonals when computing the marginals
+            (e.g., 2 ignores the main diagonal and the first off-diagonal). Default: 0
+        dtype (numpy.dtype): np.float64 or np.float32 (the corrected pixels and the output in single precision). Default: np.float64
+        return_bias (bool): whether also return the bias vector. Default: False
+
+    Return:
+        balanced contact map (same type as the input), and the bias vector if return_bias
+        (balanced = matrix / (bias[i] * bias[j]), NaN for removed bins)
+
+    Raise:
+        ValueError: if the matrix is not symmetric
+        NormalizationError: if the correction produces extremely large values
+    """
+    total_bias, row, col, data = _ice_upper(matrix, max_iteration, tolerance, verbose, min_nnz, min_count, mad_max,
+                                            ignore_diags, dtype)
+    # The balanced map is built from the corrected pixels (the input is not read again)
+    off = row != col
+    rows, cols = np.concatenate([row, col[off]]), np.concatenate([col, row[off]])
+    data = np.concatenate([data, data[off]])
+    del row, col, off
+    balanced = sp.coo_matrix((data, (rows, cols)), shape=matrix.shape).tocsr()
+    del rows, cols, data
+    if not sp.issparse(matrix):
+        balanced = balanced.toarray()
+    return (balanced, total_bias) if return_bias else balanced
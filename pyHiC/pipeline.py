@@ -0,0 +1,318 @@
+"""
+The "pyhic" command: run a declarative pipeline over many samples and chromosomes.
+
+    pyhic run config.json [--n-workers 8] [--force] [--dry-run] [--verbose]
+
+The config (JSON, or YAML if PyYAML is installed) lists the samples and the stages to run
+(relative paths are relative to the folder of the config):
+
+    {
+        "output": "results",
+        "resolution": 100000,
+        "chrom_sizes": "hg38.chrom.sizes",          (optional)
+        "chromosomes": ["chr1", "chr2"],            (optional, default: all in the store)
+        "n_workers": 8,
+        "samples": {
+            "ESC": {"file": "ESC.txt.gz", "format": "long", "gzip": true},
+            "NPC": {"store": "NPC.store"}
+        },
+        "normalize": {"method": "KR"},
+        "compartments": {"method": "laplacian"},
+        "insulation": {"windows": [10, 20]},
+        "stats": {"cutoff": 20000},
+        "plot": {"log": true, "vmax": null}
+    }
+
+Stages (a stage is run only if its section is in the config, except "load"):
+    load          (per sample)      file -> <output>/<sample>/contacts.store
+    stats         (per sample)      -> <output>/<sample>/stats.json
+    normalize     (per chromosome)  -> <output>/<sample>/<chrom>/normalized.npz, bias.npy
+    compartments  (per chromosome)  -> <output>/<sample>/<chrom>/compartments.npy
+    insulation    (per chromosome)  -> <output>/<sample>/<chrom>/insulation.npz
+    plot          (per chromosome)  -> <output>/<sample>/<chrom>/triangle.png
+Each output has a stamp (".<name>.json") with the parameters of its stage.
+A stage is skipped if its outputs are newer than its inputs and were made with the same parameters.
+Chromosomes are scheduled across worker processes, largest first.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from .utils.instrument import emit
+
+
+def read_config(file):
+    """Read a pipeline config from a JSON or YAML (.yaml / .yml, needs PyYAML) file."""
+    with open(file) as f:
+        if file.endswith(('.yaml', '.yml')):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    for key in ['output', 'resolution', 'samples']:
+        if key not in config:
+            raise ValueError('"{0}" is missing in the config!'.format(key))
+    # Relative paths are relative to the folder of the config
+    folder = os.path.dirname(os.path.abspath(file))
+
+    def _path(p):
+        return p if not isinstance(p, str) or os.path.isabs(p) else os.path.join(folder, p)
+    config['output'] = _path(config['output'])
+    config['chrom_sizes'] = _path(config.get('chrom_sizes'))
+    for spec in config['samples'].values():
+        for key in ['file', 'store']:
+            if key in spec:
+                spec[key] = _path(spec[key])
+    return config
+
+
+def _jsonable(obj):
+    if isinstance(obj, dict):
+        return {str(k): _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _mtime(path):
+    """Modification time of a file, or of the meta file of a store folder."""
+    if os.path.isdir(path):
+        path = os.path.join(path, 'meta.json')
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def _stamp_file(output):
+    folder, name = os.path.split(output)
+    return os.path.join(folder, '.{0}.json'.format(name))
+
+
+def _up_to_date(outputs, inputs, params):
+    """Whether all outputs exist, are newer than all inputs, and were made with the same parameters."""
+    for output in outputs:
+        stamp = _stamp_file(output)
+        if _mtime(output) is None or not os.path.exists(stamp):
+            return False
+        with open(stamp) as f:
+            if json.load(f) != _jsonable(params):
+                return False
+    newest_input = max([_mtime(i) or 0 for i in inputs] + [0])
+    return min(_mtime(o) for o in outputs) >= newest_input
+
+
+def _stamp(outputs, params):
+    for output in outputs:
+        with open(_stamp_file(output), 'w') as f:
+            json.dump(_jsonable(params), f)
+
+
+def _run_stage(label, stage, outputs, inputs, params, func, force=False, dry_run=False):
+    """Run func() unless the outputs are up to date. Return (label, stage, status, seconds)."""
+    if not force and _up_to_date(outputs, inputs, params):
+        return label, stage, 'up to date', 0.0
+    if dry_run:
+        return label, stage, 'to run', 0.0
+    t0 = time.time()
+    for output in outputs:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    func()
+    _stamp(outputs, params)
+    return label, stage, 'done', time.time() - t0
+
+
+def _sample_store(config, sample):
+    spec = config['samples'][sample]
+    if 'store' in spec:
+        return spec['store']
+    return os.path.join(config['output'], sample, 'contacts.store')
+
+
+def _load_task(config, sample, force, dry_run):
+    from .loading import convert_to_store
+    spec = dict(config['samples'][sample])
+    if 'store' in spec:
+        return sample, 'load', 'store given', 0.0
+    file = spec.pop('file')
+    store = _sample_store(config, sample)
+    params = dict(spec, resolution=config['resolution'], chrom_sizes=config.get('chrom_sizes'))
+
+    def _load():
+        if os.path.isdir(store):
+            import shutil
+            shutil.rmtree(store)
+        convert_to_store(file, store, resolution=config['resolution'], chrom_sizes=config.get('chrom_sizes'), **spec)
+
+    # A new chromosome sizes file changes the bins of the store
+    inputs = [file] + ([config['chrom_sizes']] if isinstance(config.get('chrom_sizes'), str) else [])
+    return _run_stage(sample, 'load', [store], inputs, params, _load, force, dry_run)
+
+
+def _stats_task(config, sample, force, dry_run):
+    from .stats import contact_statistics
+    store = _sample_store(config, sample)
+    output = os.path.join(config['output'], sample, 'stats.json')
+    params = dict(config['stats'], resolution=config['resolution'])
+
+    def _stats():
+        report = contact_statistics(store, format='store', resolution=config['resolution'],
+                                    cutoff=config['stats'].get('cutoff', 20000))
+        with open(output, 'w') as f:
+            json.dump(_jsonable(report), f, indent=1)
+
+    return [_run_stage(sample, 'stats', [output], [store], params, _stats, force, dry_run)]
+
+
+def _chromosome_task(config, sample, chrom, force, dry_run):
+    """normalize -> compartments / insulation -> plot for one chromosome of one sample."""
+    from .loading import ContactStore
+    store = _sample_store(config, sample)
+    folder = os.path.join(config['output'], sample, chrom)
+    label = '{0} {1}'.format(sample, chrom)
+    results, cache = [], {}
+
+    def raw():
+        if 'raw' not in cache:
+            cache['raw'] = ContactStore(store).query(chrom)
+        return cache['raw']
+
+    def balanced():
+        if 'normalize' not in config:
+            return raw()
+        if 'balanced' not in cache:
+            cache['balanced'] = sp.load_npz(normalized)
+        return cache['balanced']
+
+    normalized = os.path.join(folder, 'normalized.npz')
+    bias_file = os.path.join(folder, 'bias.npy')
+    balanced_input = normalized if 'normalize' in config else store
+    if 'normalize' in config:
+        def _normalize():
+            from .normalization import normalization
+            params = dict(config['normalize'])
+            mat, bias = normalization(raw(), params.pop('method'), return_bias=True, **params)
+            sp.save_npz(normalized, sp.csr_matrix(mat))
+            np.save(bias_file, bias if bias is not None else np.ones((mat.shape[0],)))
+            cache['balanced'] = mat
+        results.append(_run_stage(label, 'normalize', [normalized, bias_file], [store], config['normalize'],
+                                  _normalize, force, dry_run))
+
+    if 'compartments' in config:
+        output = os.path.join(folder, 'compartments.npy')
+
+        def _compartments():
+            from .structures import AB_compartment
+            np.save(output, AB_compartment(raw(), **config['compartments']))
+        results.append(_run_stage(label, 'compartments', [output], [store], config['compartments'],
+                                  _compartments, force, dry_run))
+
+    if 'insulation' in config:
+        output = os.path.join(folder, 'insulation.npz')
+
+        def _insulation():
+            from .structures import insulation_score
+            params = dict(config['insulation'])
+            windows = params.pop('windows', 10)
+            scores = insulation_score(balanced(), windows=windows, **params)
+            scores = scores if isinstance(scores, dict) else {windows: scores}
+            np.savez(output, **{'window_{0}'.format(w): s for w, s in scores.items()})
+        results.append(_run_stage(label, 'insulation', [output], [balanced_input], config['insulation'],
+                                  _insulation, force, dry_run))
+
+    if 'plot' in config:
+        output = os.path.join(folder, 'triangle.png')
+
+        def _plot():
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+            from .visualization import visualize_HiC_triangle
+            params = dict(config['plot'])
+            mat = balanced()
+            if params.pop('log', True):
+                mat = mat.copy()
+                mat.data = np.log1p(mat.data)
+            visualize_HiC_triangle(mat, output, colorbar=params.pop('colorbar', False), **params)
+            plt.close('all')
+        results.append(_run_stage(label, 'plot', [output], [balanced_input], config['plot'],
+                                  _plot, force, dry_run))
+    return results
+
+
+def run_pipeline(config, n_workers=None, force=False, dry_run=False):
+    """
+    Run a pipeline (see the top of pyHiC.pipeline for the config).
+
+    Args:
+        config (dict or str): the config or its file
+        n_workers (int or None): number of processes. Default: None (config["n_workers"], or number of CPUs)
+        force (bool): run all stages even if up to date. Default: False
+        dry_run (bool): only report which stages would run. Default: False
+
+    Return:
+        list of (sample / chromosome, stage, status, seconds); each is also sent as a "pipeline.stage" event
+    """
+    from .loading import ContactStore
+    if isinstance(config, str):
+        config = read_config(config)
+    n_workers = n_workers or config.get('n_workers') or os.cpu_count()
+    samples = list(config['samples'].keys())
+    report = []
+
+    def _log(results):
+        for label, stage, status, seconds in results:
+            emit('pipeline.stage', label=label, stage=stage, status=status, seconds=seconds)
+        report.extend(results)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        # Loading is one pass over each file; samples are loaded in parallel
+        futures = [pool.submit(_load_task, config, s, force, dry_run) for s in samples]
+        _log([f.result() for f in futures])
+        if dry_run and not all(os.path.exists(_sample_store(config, s)) for s in samples):
+            return report
+
+        tasks = []
+        for sample in samples:
+            store = ContactStore(_sample_store(config, sample))
+            chroms = config.get('chromosomes') or [ch for ch in store.chromosomes if (ch, ch) in store.blocks]
+            tasks.extend((store.chromosomes[ch], sample, ch) for ch in chroms)
+        futures = [pool.submit(_chromosome_task, config, sample, ch, force, dry_run)
+                   for _, sample, ch in sorted(tasks, key=lambda t: -t[0])]
+        if 'stats' in config:
+            futures += [pool.submit(_stats_task, config, s, force, dry_run) for s in samples]
+        for f in futures:
+            _log(f.result())
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pyhic', description='pyHiC pipelines')
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run', help='run a pipeline config (JSON or YAML)')
+    run.add_argument('config')
+    run.add_argument('-n', '--n-workers', type=int, default=None, help='number of processes')
+    run.add_argument('-f', '--force', action='store_true', help='run all stages even if up to date')
+    run.add_argument('--dry-run', action='store_true', help='only show the stages to run')
+    run.add_argument('-v', '--verbose', action='store_true', help='log the progress events of each stage')
+    args = parser.parse_args(argv)
+    if args.command != 'run':
+        parser.print_help()
+        return 1
+    if args.verbose:
+        import logging
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(message)s')
+    report = run_pipeline(args.config, n_workers=args.n_workers, force=args.force, dry_run=args.dry_run)
+    for label, stage, status, seconds in report:
+        print('[{0}] {1}: {2}{3}'.format(label, stage, status, ' ({0:.1f} s)'.format(seconds) if seconds else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,2 @@
 from .reproducibility import *
+from .batch import HiCRepMatrix, HiCRep_all_vs_all
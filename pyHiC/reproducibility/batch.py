@@ -0,0 +1,262 @@
+"""
+All-vs-all HiCRep scores of many samples.
+
+The smoothed strata of each sample are computed once per chromosome and kept in memory
+(and, optionally, cached on disk), then standardized so that the Pearson correlations
+of all pairs on one stratum come from a single matrix product.
+Chromosomes are smoothed in parallel.
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .reproducibility import smoothed_strata, vstran_transform, train_h
+from ..loading import load_HiC, ContactStore
+from ..normalization import NormalizationCache
+from ..utils import BandMatrix
+from ..utils.instrument import phase
+
+
+def _load_sample(source, chromosome, n_diagonals, resolution, load_kwargs):
+    """The band of one sample on one chromosome. source is a file name or a matrix."""
+    if isinstance(source, str):
+        return load_HiC(source, chromosome=chromosome, resolution=resolution,
+                        max_distance=(n_diagonals - 1) * resolution, **load_kwargs)
+    return BandMatrix.from_matrix(source, n_diagonals)
+
+
+def _smoothed(source, chromosome, n_strata, h, resolution, load_kwargs, cache):
+    """Smoothed strata of one sample as an n_strata x N array, taken from the cache if possible."""
+    def _compute():
+        band = _load_sample(source, chromosome, n_strata + h, resolution, load_kwargs)
+        strata = smoothed_strata(band, n_strata, h)
+        out = np.zeros((n_strata, len(strata[0])))
+        for d, stratum in enumerate(strata):
+            out[d, :len(stratum)] = stratum
+        return out
+
+    if cache is None:
+        return _compute()
+    key = NormalizationCache.make_key(
+        file=source if isinstance(source, str) else None, mat=None if isinstance(source, str) else source,
+        chromosome=chromosome, resolution=resolution, method='hicrep_strata',
+        params=dict(load_kwargs, n_strata=n_strata, h=h))
+    return cache.get_or_compute(key, _compute)
+
+
+def _standardize(smoothed, N, use_vstran=False):
+    """
+    Z-scores and standard deviations of the strata (padded with zeros to N bins).
+    The Pearson correlation of two strata of length L is then dot(z1, z2) / L.
+    """
+    n_strata = smoothed.shape[0]
+    z, std = np.zeros((n_strata, N)), np.zeros((n_strata,))
+    for d in range(min(n_strata, N)):
+        stratum = np.zeros((N - d,))
+        length = min(smoothed.shape[1] - d, N - d)
+        if length > 0:
+            stratum[:length] = smoothed[d, :length]
+        if use_vstran:
+            stratum = vstran_transform(stratum)
+        std[d] = np.std(stratum)
+        if std[d] > 0:
+            z[d, :N - d] = (stratum - np.mean(stratum)) / std[d]
+    return z, std
+
+
+def _smooth_samples(sources, chromosome, n_strata, h, resolution, load_kwargs, cache=None, cache_dir=None):
+    """Smoothed strata (see _smoothed) of several samples on one chromosome."""
+    if cache is None and cache_dir is not None:
+        cache = NormalizationCache(cache_dir)
+    with phase('HiCRepMatrix.smooth', chromosome=chromosome, samples=len(sources)):
+        return [_smoothed(src, chromosome, n_strata, h, resolution, load_kwargs, cache) for src in sources]
+
+
+def _similarity(zs, stds, n_done, n_strata):
+    """
+    Scores of samples [n_done:] against all samples, from their standardized strata (see _standardize).
+
+    Return:
+        numpy.array of shape (len(zs) - n_done) x len(zs)
+    """
+    N = zs.shape[2]
+    numerator = np.zeros((len(zs) - n_done, len(zs)))
+    denominator = np.zeros_like(numerator)
+    for d in range(min(n_strata, N)):
+        length = N - d
+        z = zs[:, d, :length]
+        corrs = z[n_done:] @ z.T / length
+        weights = np.outer(stds[n_done:, d], stds[:, d]) * length
+        numerator += weights * corrs
+        denominator += weights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+class HiCRepMatrix:
+    """
+    Symmetric matrices of HiCRep scores between all pairs of samples, one per chromosome.
+    Samples can be added later; only the scores of the new pairs are then computed.
+
+    Args:
+        chromosomes (list or None): chromosomes to score. Default: None (the keys of the first dict sample,
+            the chromosomes of the first "store" sample, or a single unnamed chromosome for matrices)
+        n_strata (int): Use first n strata (closest to the diagonal). Default: 10
+        h (int or None): size of smoothing window. Default: None (selected by train_h with the first two samples)
+        vstran (bool): whether apply the variance-stabilizing (rank) transformation. Default: False
+        resolution (int): resolution for loading the file samples. Default: 10000
+        n_workers (int or None): number of processes (chromosomes in parallel). Default: 1
+        cache (pyHiC.normalization.NormalizationCache or None): on-disk cache of the smoothed strata, shared by
+            the worker processes (cache_dir) and by other runs. The strata of the samples already added are
+            always kept in memory between calls of compute(). Default: None
+        train_chromosome (str or None): chromosome used to select h. Default: None (the first one)
+        **load_kwargs: other arguments of pyHiC.loading.load_HiC for the file samples (e.g., format="store")
+    """
+    def __init__(self, chromosomes=None, n_strata=10, h=None, vstran=False, resolution=10000, n_workers=1,
+                 cache=None, train_chromosome=None, **load_kwargs):
+        self.chromosomes = chromosomes
+        self.n_strata = n_strata
+        self.h = h
+        self.vstran = vstran
+        self.resolution = resolution
+        self.n_workers = n_workers
+        self.cache = cache
+        self.train_chromosome = train_chromosome
+        self.load_kwargs = load_kwargs
+        self.samples = OrderedDict()
+        self.scores = {}
+        # {(name, chromosome): {"smoothed", "key", "z", "std"}}, "key" being what "z" and "std" were computed for
+        self._strata, self._strata_params = {}, None
+
+    def __repr__(self):
+        return 'HiCRepMatrix(n_samples={0}, chromosomes={1})'.format(len(self.samples), self.chromosomes)
+
+    @property
+    def names(self):
+        return list(self.samples.keys())
+
+    def add_sample(self, name, sample):
+        """
+        Args:
+            name (str): name of the sample
+            sample (str or dict or matrix): a file loadable by load_HiC, a dict {chromosome: matrix},
+                or one matrix (numpy.array, scipy.sparse matrix or BandMatrix)
+        """
+        if name in self.samples:
+            raise ValueError('Sample {0} already exists!'.format(name))
+        self.samples[name] = sample
+
+    def add_samples(self, samples, names=None):
+        """Add a list of samples (named "0", "1", ... if names is None) or a dict {name: sample}."""
+        if isinstance(samples, dict):
+            names, samples = list(samples.keys()), list(samples.values())
+        if names is None:
+            names = [str(len(self.samples) + i) for i in range(len(samples))]
+        for name, sample in zip(names, samples):
+            self.add_sample(name, sample)
+
+    def _chromosomes(self):
+        if self.chromosomes is not None:
+            return list(self.chromosomes)
+        first = next(iter(self.samples.values()))
+        if isinstance(first, dict):
+            return list(first.keys())
+        if isinstance(first, str) and self.load_kwargs.get('format') == 'store':
+            return list(ContactStore(first).chromosomes.keys())
+        return [None]
+
+    def _source(self, sample, chromosome):
+        return sample[chromosome] if isinstance(sample, dict) else sample
+
+    def select_h(self, h_max=10, min_gain=0.01):
+        """Select h with the first two samples on the training chromosome (see train_h)."""
+        if len(self.samples) < 2:
+            raise ValueError('At least two samples are needed to select h!')
+        chromosome = self.train_chromosome if self.train_chromosome is not None else self._chromosomes()[0]
+        bands = [_load_sample(self._source(sample, chromosome), chromosome, self.n_strata + h_max,
+                              self.resolution, self.load_kwargs)
+                 for sample in list(self.samples.values())[:2]]
+        N = max(band.shape[0] for band in bands)
+        bands = [BandMatrix(np.pad(band.data, ((0, 0), (0, N - band.shape[0]))), copy=False) for band in bands]
+        self.h = train_h(bands[0], bands[1], self.n_strata, h_max=h_max, min_gain=min_gain)
+        return self.h
+
+    def _standardized(self, name, chromosome, N):
+        """Z-scores and standard deviations of one sample's strata, kept until N (or vstran) changes."""
+        entry = self._strata[(name, chromosome)]
+        if entry.get('key') != (N, self.vstran):
+            entry['z'], entry['std'] = _standardize(entry['smoothed'], N, self.vstran)
+            entry['key'] = (N, self.vstran)
+        return entry['z'], entry['std']
+
+    def compute(self):
+        """
+        Score all pairs not scored yet.
+        Only the samples added since the last call are loaded and smoothed.
+
+        Return:
+            dict {chromosome: numpy.array of scores (n_samples x n_samples)}
+        """
+        if self.h is None:
+            self.select_h()
+        # The strata kept in memory are only valid for the same smoothing
+        params = (self.n_strata, self.h, self.resolution, self.load_kwargs)
+        if self._strata_params != params:
+            self._strata, self._strata_params = {}, params
+        chromosomes, names = self._chromosomes(), self.names
+        tasks, n_done = {}, {}
+        for ch in chromosomes:
+            n_done[ch] = len(self.scores[ch]) if ch in self.scores else 0
+            if n_done[ch] < len(names):
+                missing = [name for name in names if (name, ch) not in self._strata]
+                if missing:
+                    tasks[ch] = (missing, [self._source(self.samples[name], ch) for name in missing])
+
+        if self.n_workers == 1 or len(tasks) == 0:
+            results = {ch: _smooth_samples(sources, ch, *params, cache=self.cache)
+                       for ch, (_, sources) in tasks.items()}
+        else:
+            cache_dir = self.cache.cache_dir if self.cache is not None else None
+            with ProcessPoolExecutor(max_workers=self.n_workers or os.cpu_count()) as pool:
+                futures = {ch: pool.submit(_smooth_samples, sources, ch, *params, cache_dir=cache_dir)
+                           for ch, (_, sources) in tasks.items()}
+                results = {ch: future.result() for ch, future in futures.items()}
+        for ch, smoothed in results.items():
+            for name, strata in zip(tasks[ch][0], smoothed):
+                self._strata[(name, ch)] = {'smoothed': strata}
+
+        for ch in chromosomes:
+            done = n_done[ch]
+            if done == len(names):
+                continue
+            N = max(self._strata[(name, ch)]['smoothed'].shape[1] for name in names)
+            with phase('HiCRepMatrix.similarity', chromosome=ch, pairs=(len(names) - done) * len(names)):
+                zs, stds = zip(*[self._standardized(name, ch, N) for name in names])
+                rows = _similarity(np.stack(zs), np.stack(stds), done, self.n_strata)
+            mat = np.zeros((len(names), len(names)))
+            if done > 0:
+                mat[:done, :done] = self.scores[ch]
+            mat[done:] = rows
+            mat[:, done:] = rows.T
+            self.scores[ch] = mat
+        return {ch: self.scores[ch] for ch in chromosomes}
+
+def HiCRep_all_vs_all(samples, names=None, chromosomes=None, n_strata=10, h=None, vstran=False,
+                      resolution=10000, n_workers=1, cache=None, **load_kwargs):
+    """
+    HiCRep scores between all pairs of samples.
+    Each sample is loaded and smoothed only once per chromosome.
+
+    Args:
+        samples (list or dict): files loadable by load_HiC, dicts {chromosome: matrix} or matrices
+        names (list or None): names of the samples
+        Others: see HiCRepMatrix
+
+    Return:
+        dict {chromosome: numpy.array of scores (n_samples x n_samples)}
+    """
+    engine = HiCRepMatrix(chromosomes=chromosomes, n_strata=n_strata, h=h, vstran=vstran, resolution=resolution,
+                          n_workers=n_workers, cache=cache, **load_kwargs)
+    engine.add_samples(samples, names)
+    return engine.compute()
@@ -1,43 +1,105 @@
 import numpy as np
-import scipy.sparse as sp
-from ..utils import smooothing
+from ..utils import BandMatrix
+from ..utils.instrument import phase
 
 
-def HiCRep(HiC1, HiC2, n_strata=10, h=1):
+def smoothed_strata(HiC, n_strata=10, h=1):
     """
-    Calculate the similarity of two contact maps with HiCRep score
+    The first n_strata strata of a contact map after the 2-D mean filter of HiCRep.
+    Only the first n_strata + h diagonals are used, so the full matrix is never densified.
+
     Args:
-        HiC1, HiC2 (numpy.array or sp.csr_matrix): two Hi-C contact maps
+        HiC (numpy.array or sp.csr_matrix or pyHiC.utils.BandMatrix): Hi-C contact map.
+            A BandMatrix needs at least n_strata + h diagonals.
         n_strata (int): Use first n strata (closest to the diagonal)
         h (int): size of smoothing window
 
     Return:
-         HiCRep score (float)
+        list of numpy.array (the d-th one has length N - d)
     """
-    assert HiC1.shape == HiC2.shape
-    sparse1, sparse2 = isinstance(HiC1, sp.csr_matrix), isinstance(HiC2, sp.csr_matrix)
+    band = BandMatrix.from_matrix(HiC, n_strata + h) if not isinstance(HiC, BandMatrix) else HiC
+    if band.n_diagonals < n_strata + h:
+        raise ValueError('HiCRep needs at least n_strata + h = {0} diagonals!'.format(n_strata + h))
     if h != 0:
-        HiC1, HiC2 = smooothing(HiC1, h), smooothing(HiC2, h)
-
-    def _strata(_mat, _n_strata, _sparse):
-        _l = _mat.shape[0]
-        _str = [np.zeros((_l - i,)) for i in range(_n_strata)]
-        if _sparse:
-            _mat = _mat.tocoo()
-            for r, c, v in zip(_mat.row, _mat.col, _mat.data):
-                if abs(r - c) < _n_strata and r <= c:
-                    _str[abs(r - c)][r] = v
-        else:
-            for i in range(_n_strata):
-                _str[i] = np.diag(_mat[i:, :_l-i])
-        return _str
-
-    strata1, strata2 = _strata(HiC1, n_strata, sparse1), _strata(HiC2, n_strata, sparse2)
-    print(strata1[0], strata2[0])
+        band = band.smooth(h, n_diagonals=n_strata)
+    return band.strata(n_strata)
+
+
+def vstran_transform(stratum):
+    """Variance-stabilizing transformation of HiCRep: the ranks of the values, scaled into (0, 1]."""
+    from scipy.stats import rankdata
+    return rankdata(stratum) / len(stratum)
+
+
+def strata_similarity(strata1, strata2, use_vstran=False):
+    """
+    HiCRep score between two lists of (smoothed) strata.
+
+    Return:
+        score (float), Pearson correlations (numpy.array), weights (numpy.array) of each stratum
+    """
+    if use_vstran:
+        strata1, strata2 = [vstran_transform(_s) for _s in strata1], [vstran_transform(_s) for _s in strata2]
     std1, std2 = np.array([np.std(_s1) for _s1 in strata1]), np.array([np.std(_s2) for _s2 in strata2])
-    lengths = np.arange(HiC1.shape[0], HiC1.shape[0] - n_strata, -1)
+    lengths = np.array([len(_s1) for _s1 in strata1])
     weights = std1 * std2 * lengths
-    Pearson_corrs = np.array([np.corrcoef(_s1, _s2)[0][1] for _s1, _s2 in zip(strata1, strata2)])
-    score = np.sum(weights * Pearson_corrs / np.sum(weights))
+    Pearson_corrs = np.zeros((len(strata1),))
+    # Strata without variance have a weight of 0
+    informative = weights > 0
+    for i in np.flatnonzero(informative):
+        Pearson_corrs[i] = np.corrcoef(strata1[i], strata2[i])[0][1]
+    if not np.any(informative):
+        return np.nan, Pearson_corrs, weights
+    score = np.sum(weights * Pearson_corrs) / np.sum(weights)
+    return score, Pearson_corrs, weights
+
+
+def HiCRep(HiC1, HiC2, n_strata=10, h=1, vstran=False, return_details=False):
+    """
+    Calculate the similarity of two contact maps with HiCRep score
+    Args:
+        HiC1, HiC2 (numpy.array or sp.csr_matrix or pyHiC.utils.BandMatrix): two Hi-C contact maps.
+            A BandMatrix needs at least n_strata + h diagonals.
+        n_strata (int): Use first n strata (closest to the diagonal)
+        h (int): size of smoothing window
+        vstran (bool): whether apply the variance-stabilizing (rank) transformation to each stratum. Default: False
+        return_details (bool): whether also return the correlations and weights of each stratum. Default: False
+
+    Return:
+         HiCRep score (float), and if return_details, Pearson correlations and weights (numpy.array) of each stratum
+    """
+    assert HiC1.shape == HiC2.shape
+    with phase('HiCRep.smooth', n_strata=n_strata, h=h):
+        strata1, strata2 = smoothed_strata(HiC1, n_strata, h), smoothed_strata(HiC2, n_strata, h)
+    with phase('HiCRep.similarity', n_strata=n_strata):
+        score, Pearson_corrs, weights = strata_similarity(strata1, strata2, use_vstran=vstran)
+    if return_details:
+        return score, Pearson_corrs, weights
     return score
 
+
+def train_h(HiC1, HiC2, n_strata=10, h_max=10, min_gain=0.01):
+    """
+    Select the smoothing window size by the training procedure of HiCRep:
+    increase h from 0 until the score of two replicates improves by less than min_gain.
+
+    Args:
+        HiC1, HiC2 (numpy.array or sp.csr_matrix or pyHiC.utils.BandMatrix): two replicates of the same sample.
+            A BandMatrix needs at least n_strata + h_max diagonals.
+        n_strata (int): Use first n strata (closest to the diagonal)
+        h_max (int): the largest window size to try. Default: 10
+        min_gain (float): stop when the score increases by less than this value. Default: 0.01
+
+    Return:
+        h (int)
+    """
+    assert HiC1.shape == HiC2.shape
+    # Convert once, then smooth with each window size
+    band1, band2 = BandMatrix.from_matrix(HiC1, n_strata + h_max), BandMatrix.from_matrix(HiC2, n_strata + h_max)
+    previous = None
+    for h in range(h_max + 1):
+        score, _, _ = strata_similarity(smoothed_strata(band1, n_strata, h), smoothed_strata(band2, n_strata, h))
+        if previous is not None and score - previous < min_gain:
+            return h - 1
+        previous = score
+    return h_max
@@ -0,0 +1,2 @@
+from .stats import calculate_cis_ratio, contact_statistics, ContactStats
+from .contact_probability import contact_probability, probability_curve, diagonal_sums, diagonal_pixels, log_bins
@@ -0,0 +1,245 @@
+"""
+Contact probability P(s): the average contact at genomic distance s, in log-spaced distance bins.
+
+Contacts are first summed on each diagonal (distance in bins). These per-diagonal sums are
+partial histograms: the ones of different chunks of a file or of different processes are simply added.
+They are then divided by the number of (valid) pixels on the diagonals of each log bin.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from ..loading import ContactStore, read_chrom_sizes
+from ..loading.parsing import file_lines_generator, parse_format, group_contacts
+from ..loading.parallel import map_file_blocks
+from ..utils import BandMatrix
+
+
+def _inverse_bias(bias, n=None):
+    """1 / bias with 0 for removed (NaN or 0) bins, padded to n bins."""
+    bias = np.asarray(bias, dtype=float)
+    inv = np.zeros((max(len(bias), n or 0),))
+    ok = np.isfinite(bias) & (bias != 0)
+    inv[np.flatnonzero(ok)] = 1 / bias[ok]
+    return inv
+
+
+def _add(total, partial):
+    """Sum two per-diagonal vectors of different lengths."""
+    if len(partial) > len(total):
+        total, partial = partial, total
+    total = total.copy()
+    total[:len(partial)] += partial
+    return total
+
+
+def diagonal_sums(mat, bias=None):
+    """
+    Sum of contacts on each diagonal of a contact map.
+
+    Args:
+        mat (numpy.array or scipy.sparse matrix or pyHiC.utils.BandMatrix): contact map of one chromosome
+        bias (numpy.array or None): bias vector (balanced contact: mat[i, j] / (bias[i] * bias[j])). Default: None
+
+    Return:
+        numpy.array: sums[d]
+    """
+    N = mat.shape[0]
+    if isinstance(mat, BandMatrix):
+        band = mat.scale(_inverse_bias(bias, N)[:N]) if bias is not None else mat
+        return band.data.sum(axis=1)
+    coo = sp.triu(sp.coo_matrix(mat)).tocoo()
+    v = coo.data
+    if bias is not None:
+        inv = _inverse_bias(bias, N)
+        v = v * inv[coo.row] * inv[coo.col]
+    return np.bincount(coo.col - coo.row, weights=v, minlength=N)
+
+
+def diagonal_pixels(n_bins, bias=None):
+    """
+    Number of (valid) pixels on each diagonal: N - d, or the number of pairs of bins with a finite bias.
+
+    Return:
+        numpy.array: counts[d]
+    """
+    from scipy.signal import fftconvolve
+    if bias is None:
+        return np.arange(n_bins, 0, -1).astype(float)
+    valid = (_inverse_bias(bias, n_bins)[:n_bins] != 0).astype(float)
+    counts = np.round(fftconvolve(valid, valid[::-1])[n_bins - 1:])
+    return np.maximum(counts, 0)
+
+
+def log_bins(n_diagonals, bins_per_decade=10):
+    """Edges (in diagonals) of log-spaced bins: [0, 1), [1, 2), ..., up to n_diagonals."""
+    if n_diagonals <= 1:
+        return np.array([0, max(n_diagonals, 1)])
+    edges = np.unique(np.round(np.logspace(0, np.log10(n_diagonals), int(np.ceil(
+        np.log10(n_diagonals) * bins_per_decade)) + 1)).astype(int))
+    return np.concatenate([[0], edges[edges < n_diagonals], [n_diagonals]])
+
+
+def probability_curve(sums, counts, resolution=10000, bins_per_decade=10, smooth_expected=True):
+    """
+    Log-binned P(s) from per-diagonal sums and pixel counts.
+
+    Args:
+        sums, counts (numpy.array): see diagonal_sums and diagonal_pixels
+        resolution (int): bin size. Default: 10000
+        bins_per_decade (int): number of log bins per 10-fold distance. Default: 10
+        smooth_expected (bool): If True, the expected vector is P(s) of the log bin of each diagonal;
+            if False, the average of each diagonal. Default: True
+
+    Return:
+        dict: "edges" (bp), "s" (average distance (bp) of the pixels in each bin), "P" (average contact),
+        "slope" (d log P / d log s), "expected" (numpy.array, one value per diagonal,
+        for pyHiC.normalization.apply_expected or normalization(..., 'OE', expected=...))
+    """
+    n = min(len(sums), len(counts))
+    sums, counts = np.asarray(sums[:n], dtype=float), np.asarray(counts[:n], dtype=float)
+    edges = log_bins(n, bins_per_decade)
+    d = np.arange(n)
+    bin_sums, bin_counts = np.add.reduceat(sums, edges[:-1]), np.add.reduceat(counts, edges[:-1])
+    bin_dist = np.add.reduceat(d * counts, edges[:-1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        P = bin_sums / bin_counts
+        s = bin_dist / bin_counts * resolution
+        slope = np.full(P.shape, np.nan)
+        ok = (P > 0) & (s > 0)
+        if ok.sum() > 1:
+            slope[ok] = np.gradient(np.log(P[ok]), np.log(s[ok]))
+        if smooth_expected:
+            expected = np.repeat(P, np.diff(edges))
+        else:
+            expected = sums / counts
+    expected = np.where(np.isfinite(expected), expected, 0)
+    return {'edges': edges * resolution, 's': s, 'P': P, 'slope': slope, 'expected': expected}
+
+
+def _histogram_blocks(blocks, columns, chromosome, resolution, bias):
+    """Per-diagonal sums of each chromosome in some blocks of lines of a file."""
+    sums, max_bin = {}, {}
+
+    def _add_contacts(ch, p1, p2, v):
+        b1, b2 = p1 // resolution, p2 // resolution
+        if bias is not None:
+            if ch not in bias:
+                return
+            inv = _inverse_bias(bias[ch])
+            keep = (b1 < len(inv)) & (b2 < len(inv))
+            b1, b2, v = b1[keep], b2[keep], v[keep] * inv[b1[keep]] * inv[b2[keep]]
+        if len(b1) == 0:
+            return
+        sums[ch] = _add(sums.get(ch, np.zeros((0,))), np.bincount(np.abs(b2 - b1), weights=v))
+        max_bin[ch] = max(max_bin.get(ch, -1), int(max(b1.max(), b2.max())))
+
+    for lines in blocks:
+        for ch, _, p1, p2, v in group_contacts(lines, columns, intra_only=True):
+            _add_contacts(ch or chromosome, p1, p2, v)
+    return sums, max_bin
+
+
+def _store_sums(store_path, chromosome, bias):
+    store = ContactStore(store_path)
+    arrays = store.block(chromosome)
+    N = store.chromosomes[chromosome]
+    inv = _inverse_bias(bias, N) if bias is not None else None
+    sums, chunk = np.zeros((N,)), 1 << 22
+    for st in range(0, len(arrays['count']), chunk):
+        b1 = np.asarray(arrays['bin1'][st:st + chunk], dtype=np.int64)
+        b2 = np.asarray(arrays['bin2'][st:st + chunk], dtype=np.int64)
+        v = np.asarray(arrays['count'][st:st + chunk])
+        if inv is not None:
+            v = v * inv[b1] * inv[b2]
+        sums += np.bincount(b2 - b1, weights=v, minlength=N)
+    return sums
+
+
+def contact_probability(data, format=None, custom_format=None, header=False, chromosome=None,
+                        resolution=10000, gzip=False, bias=None, chrom_sizes=None,
+                        bins_per_decade=10, smooth_expected=True, n_workers=1):
+    """
+    Log-binned P(s) curves and their log-derivatives, one for each chromosome.
+
+    Args:
+        data: a contact map (numpy.array, scipy.sparse matrix or BandMatrix) of one chromosome,
+            a dict {chromosome: contact map}, or a file loadable by pyHiC.loading.load_HiC
+            (text files are read in chunks by n_workers processes; "store" is read chromosome by chromosome)
+        format, custom_format, header, gzip: same as pyHiC.loading.load_HiC
+        chromosome (str or None): name of the chromosome of a single map or of a file without chromosome columns;
+            for a store, only use this chromosome. Default: None ("chr" / all chromosomes)
+        resolution (int): bin size. Default: 10000
+        bias (numpy.array or dict or None): bias vector(s) (dict {chromosome: vector} for several chromosomes)
+            at this resolution, to compute P(s) of the balanced map. Default: None
+        chrom_sizes (str or dict or None): chromosome sizes, to decide the number of bins of file inputs.
+            Default: None (the largest bin seen)
+        bins_per_decade (int): Default: 10
+        smooth_expected (bool): see probability_curve. Default: True
+        n_workers (int or None): number of processes (None: number of CPUs). Default: 1
+
+    Return:
+        dict {chromosome: dict (see probability_curve)}; the "expected" vector of a chromosome can be passed to
+        normalization(mat, 'OE', expected=...)
+    """
+    if not isinstance(data, (str, dict)):
+        data = {chromosome or 'chr': data}
+    if bias is not None and not isinstance(bias, dict):
+        bias = {chromosome or 'chr': bias}
+
+    sums, sizes = {}, {}
+    if isinstance(data, dict):
+        names = list(data.keys())
+        args = [(data[ch], None if bias is None else bias.get(ch)) for ch in names]
+        if n_workers == 1 or len(names) == 1:
+            results = [diagonal_sums(*arg) for arg in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+                results = list(pool.map(diagonal_sums, *zip(*args)))
+        sums = dict(zip(names, results))
+        sizes = {ch: data[ch].shape[0] for ch in names}
+
+    elif format == 'store':
+        store = ContactStore(data)
+        if resolution != store.resolution:
+            raise ValueError('Resolution {0} does not match the store ({1})!'.format(resolution, store.resolution))
+        names = [chromosome] if chromosome is not None else \
+            [ch for ch in store.chromosomes if (ch, ch) in store.blocks]
+        args = [(data, ch, None if bias is None else bias.get(ch)) for ch in names]
+        if n_workers == 1 or len(names) == 1:
+            results = [_store_sums(*arg) for arg in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+                results = list(pool.map(_store_sums, *zip(*args)))
+        sums = dict(zip(names, results))
+        sizes = {ch: store.chromosomes[ch] for ch in names}
+
+    else:
+        columns, _ = parse_format(format, custom_format)
+        header = header if format is None else False
+        args = (columns, chromosome or 'chr', resolution, bias)
+        if n_workers == 1:
+            partials = [_histogram_blocks(file_lines_generator(data, header=header, gzip=gzip), *args)]
+        else:
+            partials = map_file_blocks(data, _histogram_blocks, args, header=header, gzip=gzip, n_workers=n_workers)
+        # Merge the partial histograms
+        max_bin = {}
+        for part_sums, part_max in partials:
+            for ch, s in part_sums.items():
+                sums[ch] = _add(sums.get(ch, np.zeros((0,))), s)
+                max_bin[ch] = max(max_bin.get(ch, -1), part_max[ch])
+        if chrom_sizes is not None:
+            lengths = read_chrom_sizes(chrom_sizes)
+            sizes = {ch: int(np.ceil(lengths[ch] / resolution)) for ch in sums if ch in lengths}
+        for ch in sums:
+            sizes.setdefault(ch, max_bin[ch] + 1)
+
+    curves = {}
+    for ch in sums:
+        N = sizes[ch]
+        s = np.zeros((N,))
+        s[:min(N, len(sums[ch]))] = sums[ch][:N]
+        counts = diagonal_pixels(N, None if bias is None else bias.get(ch))
+        curves[ch] = probability_curve(s, counts, resolution, bins_per_decade, smooth_expected)
+    return curves
@@ -1,7 +1,211 @@
+"""
+Library statistics (cis / trans ratio, short / long-range cis contacts, distance decay and per-bin coverage),
+computed in one streaming pass over a contact file or directly from a loaded contact map.
+"""
+
 import numpy as np
 import scipy.sparse as sp
+from ..loading import load_HiC, ContactStore
+from ..loading.parsing import file_lines_generator, parse_format, group_contacts
+from ..utils import BandMatrix
+
+
+# Edges (bp) of the distance-decay histogram: [0, 1) and then 10 bins per decade up to 10 Gb
+DECAY_EDGES = np.concatenate([[0], np.logspace(0, 10, 101)])
+
+
+def _add_bincount(arr, idx, weights):
+    """arr + bincount(idx, weights), growing arr if needed."""
+    counts = np.bincount(idx, weights=weights)
+    if len(counts) > len(arr):
+        arr = np.concatenate([arr, np.zeros((len(counts) - len(arr),))])
+    arr[:len(counts)] += counts
+    return arr
+
+
+class ContactStats:
+    """
+    Accumulator of library statistics. Memory only depends on the number of bins, not on the number of contacts.
+
+    Args:
+        resolution (int): bin size of the coverage vectors. Default: 10000
+        cutoff (int): cis contacts closer than cutoff (bp) are short-range. Default: 20000
+    """
+    def __init__(self, resolution=10000, cutoff=20000):
+        self.resolution = resolution
+        self.cutoff = cutoff
+        self.cis, self.trans, self.short_range = 0.0, 0.0, 0.0
+        self.decay = np.zeros((len(DECAY_EDGES) - 1,))
+        self.chromosomes = {}
+        self.coverage = {}
+
+    def _chrom(self, chrom):
+        if chrom not in self.chromosomes:
+            self.chromosomes[chrom] = {'cis': 0.0, 'trans': 0.0}
+            self.coverage[chrom] = np.zeros((0,))
+        return self.chromosomes[chrom]
+
+    def add_bins(self, chrom1, chrom2, b1, b2, v, dist=None):
+        """
+        Add binned contacts between two chromosomes.
+
+        Args:
+            chrom1, chrom2 (str): chromosomes
+            b1, b2 (numpy.array): bins of the two ends
+            v (numpy.array): contact values
+            dist (numpy.array or None): distances (bp) of cis contacts. Default: None (from the bins)
+        """
+        b1, b2, v = np.asarray(b1, dtype=np.int64), np.asarray(b2, dtype=np.int64), np.asarray(v, dtype=float)
+        total = v.sum()
+        if chrom1 == chrom2:
+            stats = self._chrom(chrom1)
+            stats['cis'] += total
+            self.cis += total
+            dist = np.abs(b2 - b1) * self.resolution if dist is None else dist
+            self.short_range += v[dist < self.cutoff].sum()
+            self.decay += np.histogram(dist, bins=DECAY_EDGES, weights=v)[0]
+            # Row sums of the symmetric map: the diagonal is counted once
+            off = b1 != b2
+            self.coverage[chrom1] = _add_bincount(self.coverage[chrom1], np.concatenate([b1, b2[off]]),
+                                                  np.concatenate([v, v[off]]))
+        else:
+            for ch, b in [(chrom1, b1), (chrom2, b2)]:
+                self._chrom(ch)['trans'] += total
+                self.coverage[ch] = _add_bincount(self.coverage[ch], b, v)
+            self.trans += total
+
+    def add_contacts(self, chrom1, chrom2, p1, p2, v):
+        """Add contacts given by positions (bp)."""
+        p1, p2 = np.asarray(p1, dtype=np.int64), np.asarray(p2, dtype=np.int64)
+        dist = np.abs(p2 - p1) if chrom1 == chrom2 else None
+        self.add_bins(chrom1, chrom2, p1 // self.resolution, p2 // self.resolution, v, dist=dist)
+
+    def report(self):
+        """
+        Return:
+            dict: total, cis, trans, cis_ratio (cis / total), short_range, long_range (cis contacts),
+            long_range_ratio (long_range / cis), cutoff, resolution,
+            chromosomes {chromosome: {'cis', 'trans'}}, coverage {chromosome: numpy.array},
+            decay (edges (bp), contacts in each distance bin)
+        """
+        total = self.cis + self.trans
+        return {
+            'total': total, 'cis': self.cis, 'trans': self.trans,
+            'cis_ratio': self.cis / total if total > 0 else np.nan,
+            'short_range': self.short_range, 'long_range': self.cis - self.short_range,
+            'long_range_ratio': (self.cis - self.short_range) / self.cis if self.cis > 0 else np.nan,
+            'cutoff': self.cutoff, 'resolution': self.resolution,
+            'chromosomes': {ch: dict(st) for ch, st in self.chromosomes.items()},
+            'coverage': {ch: cov.copy() for ch, cov in self.coverage.items()},
+            'decay': (DECAY_EDGES.copy(), self.decay.copy())
+        }
 
 
 def calculate_cis_ratio(mat, n_bins=None, resolution=None, cutoff=None):
-    pass
+    """
+    Library statistics of a loaded contact map.
+
+    Args:
+        mat (numpy.array or scipy.sparse matrix or pyHiC.utils.BandMatrix): symmetric contact map,
+            of one chromosome or of several chromosomes one after another (genome-wide)
+        n_bins (list or dict or None): number of bins of each chromosome in the map (a dict keeps the names).
+            Default: None (one chromosome)
+        resolution (int or None): bin size, used for the distances. Default: None (distances in bins)
+        cutoff (int or None): cis contacts closer than cutoff (in bp, or bins if resolution is None)
+            are short-range. Default: None (20000 bp, or 2 bins if resolution is None)
+
+    Return:
+        dict (see ContactStats.report)
+    """
+    resolution = 1 if resolution is None else resolution
+    cutoff = (20000 if resolution > 1 else 2) if cutoff is None else cutoff
+    acc = ContactStats(resolution=resolution, cutoff=cutoff)
+    if n_bins is None:
+        n_bins = {'chr': mat.shape[0]}
+    elif not isinstance(n_bins, dict):
+        n_bins = {str(i): n for i, n in enumerate(n_bins)}
+    names, sizes = list(n_bins.keys()), np.array(list(n_bins.values()), dtype=np.int64)
+    if sizes.sum() != mat.shape[0]:
+        raise ValueError('Size not matched!')
+    offsets = np.append(0, np.cumsum(sizes))
+
+    if isinstance(mat, BandMatrix):
+        if len(names) > 1:
+            raise ValueError('A BandMatrix only contains one chromosome!')
+        N = mat.shape[0]
+        for d in range(min(mat.n_diagonals, N)):
+            v = mat.stratum(d)
+            nz = np.flatnonzero(v)
+            acc.add_bins(names[0], names[0], nz, nz + d, v[nz])
+        return acc.report()
+
+    # Each contact once: the upper triangle
+    coo = sp.triu(sp.coo_matrix(mat)).tocoo()
+    row, col, val = coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data
+    c1, c2 = np.searchsorted(offsets, row, side='right') - 1, np.searchsorted(offsets, col, side='right') - 1
+    pair = c1 * len(names) + c2
+    order = np.argsort(pair, kind='stable')
+    pairs, starts = np.unique(pair[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for p, st, ed in zip(pairs, starts, ends):
+        i, j = p // len(names), p % len(names)
+        sel = order[st:ed]
+        acc.add_bins(names[i], names[j], row[sel] - offsets[i], col[sel] - offsets[j], val[sel])
+    for name, size in zip(names, sizes):
+        acc._chrom(name)
+        acc.coverage[name] = np.concatenate([acc.coverage[name], np.zeros((size - len(acc.coverage[name]),))])
+    return acc.report()
+
+
+def contact_statistics(file, format=None, custom_format=None, header=False, chromosome=None,
+                       resolution=10000, cutoff=20000, gzip=False):
+    """
+    Library statistics with one streaming pass over a contact file, without building a matrix.
+    Memory does not grow with the file size.
+
+    Args:
+        file (str): file name
+        format, custom_format, header, gzip: same as pyHiC.loading.load_HiC.
+            For "npy" / "npz", the map is loaded and passed to calculate_cis_ratio;
+            for "store", the blocks of the store are streamed.
+        chromosome (str or None): name of the chromosome for formats without chromosome columns (e.g., "short").
+            Default: None ("chr")
+        resolution (int): bin size of the coverage vectors. Default: 10000
+        cutoff (int): cis contacts closer than cutoff (bp) are short-range. Default: 20000
+
+    Return:
+        dict (see ContactStats.report)
+    """
+    if format in ['npy', 'npz']:
+        mat = load_HiC(file, format=format)
+        return calculate_cis_ratio(mat, {chromosome or 'chr': mat.shape[0]}, resolution, cutoff)
+
+    if format == 'store':
+        store = ContactStore(file)
+        if store.resolution > resolution or resolution % store.resolution:
+            raise ValueError('Resolution must be a multiple of the resolution of the store!')
+        factor = resolution // store.resolution
+        # Distances are measured between the bins of the store
+        acc = ContactStats(resolution=store.resolution, cutoff=cutoff)
+        chunk = 1 << 22
+        for c1, c2 in store.blocks:
+            arrays = store.block(c1, c2)
+            for st in range(0, len(arrays['count']), chunk):
+                acc.add_bins(c1, c2, arrays['bin1'][st:st + chunk], arrays['bin2'][st:st + chunk],
+                             arrays['count'][st:st + chunk])
+        report = acc.report()
+        # Coverage at the requested resolution
+        report['coverage'] = {ch: np.add.reduceat(cov, np.arange(0, len(cov), factor)) if len(cov) else cov
+                              for ch, cov in report['coverage'].items()}
+        report['resolution'] = resolution
+        return report
 
+    acc = ContactStats(resolution=resolution, cutoff=cutoff)
+    columns, _ = parse_format(format, custom_format)
+    header = header if format is None else False
+    name = chromosome or 'chr'
+    for lines in file_lines_generator(file, header=header, gzip=gzip):
+        for c1, c2, p1, p2, v in group_contacts(lines, columns):
+            # Files without chromosome columns hold one chromosome
+            acc.add_contacts(c1 or name, c2 or name, p1, p2, v)
+    return acc.report()
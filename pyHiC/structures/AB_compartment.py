@@ -1,36 +1,196 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from copy import deepcopy
-from scipy.linalg import eigh
 import scipy.sparse as sp
 from ..normalization import normalization
+from ..utils import BandMatrix
+from ..utils.instrument import phase
 
 
-def AB_compartment(mat, n_th_eigenvector=1):
-    assert n_th_eigenvector in [1, 2]
+METHODS = ['laplacian', 'pca']
+SOLVERS = ['eigsh', 'lobpcg', 'dense']
+
+
+def _restricted(mat, valid):
+    """Matrix-vector product of mat restricted to the valid bins, without densifying."""
+    if isinstance(mat, BandMatrix):
+        N = mat.shape[0]
+
+        def _dot(x):
+            full = np.zeros((N,))
+            full[valid] = x
+            return mat.dot(full)[valid]
+        return _dot
+    if sp.issparse(mat):
+        return sp.csr_matrix(mat)[valid][:, valid].dot
+    return np.asarray(mat)[np.ix_(valid, valid)].dot
+
+
+def _squared(mat):
+    if isinstance(mat, BandMatrix):
+        return mat.apply(np.square)
+    if sp.issparse(mat):
+        return sp.csr_matrix(mat).multiply(mat)
+    return np.asarray(mat) ** 2
+
+
+def _row_sums(mat):
+    if isinstance(mat, BandMatrix):
+        return mat.sum(axis=0)
+    return np.asarray(mat.sum(axis=1)).flatten()
+
+
+def _leading_eigenvectors(dot, n, k, solver='eigsh', seed=0):
+    """
+    The k eigenvectors with the largest eigenvalues of a symmetric n x n operator (x -> dot(x)),
+    in descending order of eigenvalues.
+    """
+    from scipy.linalg import eigh
+    from scipy.sparse.linalg import LinearOperator, eigsh, lobpcg
+    op = LinearOperator((n, n), matvec=lambda x: dot(np.ravel(x)),
+                        matmat=lambda X: np.column_stack([dot(x) for x in X.T]), dtype=np.float64)
+    if solver == 'dense' or n <= max(5 * k, 20):
+        # Small matrices: iterative solvers are not reliable
+        _, vectors = eigh(op.matmat(np.eye(n)), subset_by_index=[n - k, n - 1])
+    elif solver == 'eigsh':
+        v0 = np.random.RandomState(seed).rand(n)
+        _, vectors = eigsh(op, k=k, which='LA', v0=v0)
+    elif solver == 'lobpcg':
+        X = np.random.RandomState(seed).rand(n, k)
+        values, vectors = lobpcg(op, X, largest=True, tol=1e-8, maxiter=1000)
+        vectors = vectors[:, np.argsort(values)]
+    else:
+        raise ValueError('Unrecognized solver: ' + solver)
+    return vectors[:, ::-1]
+
+
+def _laplacian_vector(oe, valid, n_th_eigenvector, solver):
+    """
+    The n-th smallest eigenvector (n = 0: the trivial one) of the normalized Laplacian I - D^-1/2 A D^-1/2,
+    i.e., the n-th largest eigenvector of D^-1/2 A D^-1/2.
+    """
+    # Empty bins are removed; the row sums of the others are unchanged since the map is symmetric
+    dot = _restricted(oe, valid)
+    d_inv_sqrt = 1 / np.sqrt(_row_sums(oe)[valid])
+    vectors = _leading_eigenvectors(lambda x: d_inv_sqrt * dot(d_inv_sqrt * x),
+                                    int(valid.sum()), n_th_eigenvector + 1, solver)
+    return vectors[:, n_th_eigenvector]
+
 
-    new_mat = mat.toarray() if isinstance(mat, sp.csr_matrix) else deepcopy(mat)
+def _pca_vector(oe, valid, n_th_eigenvector, solver):
+    """
+    The n-th principal component of the Pearson correlation matrix of the OE map.
+    The correlation matrix (1/n) Z Z^T, Z = diag(1/std) (A - mean 1^T), is never formed:
+    each product takes two products with the sparse OE map.
+    """
+    n = int(valid.sum())
+    dot = _restricted(oe, valid)
+    mean = _row_sums(oe)[valid] / n
+    std = np.sqrt(np.maximum(_row_sums(_squared(oe))[valid] / n - mean ** 2, 0))
+    # Constant rows are not correlated with anything
+    std[std == 0] = np.inf
 
-    norm_mat = normalization(new_mat, 'OE')
-    # Remove zeros
-    sm = np.sum(norm_mat, axis=1)
-    zeros = []
-    for i in range(len(sm)):
-        if sm[i] == 0:
-            zeros.append(i)
-    if len(zeros) != 0:
-        norm_mat = np.delete(norm_mat, zeros, axis=0)
-        norm_mat = np.delete(norm_mat, zeros, axis=1)
+    def _corr_dot(x):
+        x = x / std
+        y = dot(x) - np.dot(mean, x)
+        return (dot(y) - mean * np.sum(y)) / std / n
 
-    degree_ = np.diag(1 / np.sqrt(np.sum(norm_mat, axis=0)))
-    # print(degree_.shape, norm_mat.shape)
+    vectors = _leading_eigenvectors(_corr_dot, n, n_th_eigenvector, solver)
+    return vectors[:, n_th_eigenvector - 1]
 
-    norm_laplacian = np.eye(len(norm_mat)) - degree_.dot(norm_mat).dot(degree_)
-    eigen_val, eigen_vec = eigh(norm_laplacian, eigvals=(0, 2))
-    # print(eigen_val)
 
-    ab_comp = eigen_vec[:, n_th_eigenvector]
-    for zero in zeros:
-        ab_comp = np.insert(ab_comp, zero, 0)
+def _orient(vec, track):
+    """Flip the sign to make the vector positively correlated with the track (e.g., GC content)."""
+    track = np.asarray(track, dtype=float)
+    if len(track) != len(vec):
+        raise ValueError('Size not matched!')
+    used = np.isfinite(track) & (vec != 0)
+    if used.sum() > 1 and np.corrcoef(vec[used], track[used])[0][1] < 0:
+        return -vec
+    return vec
 
+
+def AB_compartment(mat, n_th_eigenvector=1, expected=None, method='laplacian', track=None, solver='eigsh'):
+    """
+    Find A/B compartments with the leading eigenvectors of the observed / expected map.
+    Only the needed eigenvectors are computed, with an iterative solver on the sparse (or band) map.
+
+    Args:
+        mat (numpy.array or scipy.sparse.csr_matrix or pyHiC.utils.BandMatrix): contact map of one chromosome
+        n_th_eigenvector (int): 1 or 2. Default: 1
+        expected (numpy.array or None): precomputed expected vector for OE normalization. Default: None
+        method (str): "laplacian": the non-trivial eigenvectors of the normalized Laplacian of the OE map;
+            "pca": the principal components of the Pearson correlation matrix of the OE map. Default: "laplacian"
+        track (numpy.array or None): a track of the bins (e.g., GC content or gene density);
+            the sign is flipped to make the result positively correlated with it. Default: None
+        solver (str): "eigsh" (Lanczos), "lobpcg" or "dense". Default: "eigsh"
+
+    Return:
+        numpy.array: same length as the input map, sign (+ / -) indicates A or B compartment.
+        Bins without contacts are 0.
+    """
+    assert n_th_eigenvector in [1, 2]
+    method = method.lower()
+    if method not in METHODS:
+        raise ValueError('Unrecognized method: ' + method)
+
+    # Bins without contacts (or with only the epsilon diagonal added when loading) are removed
+    valid = _row_sums(mat) > np.finfo(float).eps
+    if valid.sum() <= n_th_eigenvector:
+        return np.zeros((mat.shape[0],))
+    oe = normalization(mat, 'OE', expected=expected)
+    with phase('AB_compartment.' + method, solver=solver, n_bins=int(valid.sum())):
+        if method == 'laplacian':
+            vec = _laplacian_vector(oe, valid, n_th_eigenvector, solver)
+        else:
+            vec = _pca_vector(oe, valid, n_th_eigenvector, solver)
+
+    ab_comp = np.zeros((mat.shape[0],))
+    ab_comp[valid] = vec
+    if track is not None:
+        ab_comp = _orient(ab_comp, track)
     return ab_comp
 
+
+def _chromosome_compartment(source, chromosome, track, kwargs):
+    if isinstance(source, str):
+        from ..loading import load_HiC, ContactStore
+        source = load_HiC(source, format='store', chromosome=chromosome,
+                          resolution=ContactStore(source).resolution)
+    return AB_compartment(source, track=track, **kwargs)
+
+
+def AB_compartment_genome(mats, n_th_eigenvector=1, method='laplacian', tracks=None, solver='eigsh',
+                          chromosomes=None, n_workers=None):
+    """
+    A/B compartments of all chromosomes, in parallel.
+
+    Args:
+        mats (dict or str): {chromosome: contact map} or the path of a pyHiC store
+            (each process then loads its own chromosome)
+        n_th_eigenvector, method, solver: see AB_compartment
+        tracks (dict or None): {chromosome: track} for orienting the signs. Default: None
+        chromosomes (list or None): chromosomes to process. Default: None (all)
+        n_workers (int or None): number of processes. Default: None (number of CPUs)
+
+    Return:
+        dict {chromosome: numpy.array}
+    """
+    if chromosomes is None:
+        if isinstance(mats, str):
+            from ..loading import ContactStore
+            chromosomes = list(ContactStore(mats).chromosomes.keys())
+        else:
+            chromosomes = list(mats.keys())
+    kwargs = dict(n_th_eigenvector=n_th_eigenvector, method=method, solver=solver)
+    tracks = tracks or {}
+
+    def _source(_ch):
+        return mats if isinstance(mats, str) else mats[_ch]
+
+    if n_workers == 1:
+        return {ch: _chromosome_compartment(_source(ch), ch, tracks.get(ch), kwargs) for ch in chromosomes}
+    with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+        futures = {ch: pool.submit(_chromosome_compartment, _source(ch), ch, tracks.get(ch), kwargs)
+                   for ch in chromosomes}
+        return {ch: future.result() for ch, future in futures.items()}
@@ -1 +1,3 @@
-from .AB_compartment import AB_compartment
+from .AB_compartment import AB_compartment, AB_compartment_genome
+from .insulation_score import insulation_score, insulation_score_store, insulation_delta, call_boundaries, \
+    normalize_insulation
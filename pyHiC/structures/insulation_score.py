@@ -0,0 +1,177 @@
+"""
+Insulation score and TAD boundaries.
+
+The insulation score of bin i with a window of w bins is the mean contact in the diamond
+between the w bins upstream and the w bins downstream of i (rows [i - w + 1, i], columns [i, i + w - 1]).
+In band coordinates (row r, distance d), the diamond covers a contiguous range of r on each of the first
+2w - 1 diagonals, so its sum is a difference of prefix sums along each diagonal: O(N * w) for all bins.
+"""
+
+import numpy as np
+from ..utils import BandMatrix
+from ..utils.instrument import phase
+
+
+def _as_list(windows):
+    return [int(windows)] if np.isscalar(windows) else [int(w) for w in windows]
+
+
+def _diamond_sums(band, windows, ignore_diags=1, valid=None):
+    """
+    Sums and numbers of valid pixels in the diamond of each bin, for each window size.
+
+    Return:
+        dict {w: (sums, counts)}
+    """
+    N = band.shape[0]
+    if valid is None:
+        valid = band.sum(axis=0) > np.finfo(float).eps
+    n_diagonals = min(2 * max(windows) - 1, band.n_diagonals, N)
+    idx = np.arange(N)
+
+    # Prefix sums of the values and of the valid pixels along each diagonal
+    values = np.zeros((n_diagonals, N + 1))
+    counts = np.zeros((n_diagonals, N + 1))
+    for d in range(ignore_diags, n_diagonals):
+        mask = valid[:N - d] & valid[d:]
+        np.cumsum(np.where(mask, band.data[d, :N - d], 0), out=values[d, 1:N - d + 1])
+        np.cumsum(mask, out=counts[d, 1:N - d + 1])
+        values[d, N - d + 1:] = values[d, N - d]
+        counts[d, N - d + 1:] = counts[d, N - d]
+
+    results = {}
+    for w in windows:
+        sums, cnts = np.zeros((N,)), np.zeros((N,))
+        for d in range(ignore_diags, min(2 * w - 1, n_diagonals)):
+            # Rows of the diamond of bin i on the d-th diagonal: [i - min(w - 1, d), i + min(0, w - 1 - d)]
+            lo = np.maximum(idx - min(w - 1, d), 0)
+            hi = np.minimum(idx + min(0, w - 1 - d), N - d - 1) + 1
+            hi = np.maximum(hi, lo)
+            sums += values[d, hi] - values[d, lo]
+            cnts += counts[d, hi] - counts[d, lo]
+        results[w] = (sums, cnts)
+    return results
+
+
+def _scores(sums, counts, valid):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = sums / counts
+    score[(counts == 0) | ~valid] = np.nan
+    return score
+
+
+def normalize_insulation(score):
+    """log2(score / median score), ignoring NaNs; bins with a score of 0 become NaN."""
+    score = np.where(score > 0, score, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log2(score / np.nanmedian(score))
+
+
+def insulation_score(mat, windows=10, ignore_diags=1, normalize=True):
+    """
+    Insulation score of every bin, for one or several window sizes in one pass.
+
+    Args:
+        mat (numpy.array or scipy.sparse.csr_matrix or pyHiC.utils.BandMatrix): contact map of one chromosome.
+            A BandMatrix needs 2 * max(windows) - 1 diagonals.
+        windows (int or list): window size(s) in bins. Default: 10
+        ignore_diags (int): ignore the first n diagonals. Default: 1 (the main diagonal)
+        normalize (bool): whether return log2(score / median score). Default: True
+
+    Return:
+        numpy.array (if windows is an int) or dict {window: numpy.array}; bins without contacts are NaN
+    """
+    ws = _as_list(windows)
+    band = BandMatrix.from_matrix(mat, 2 * max(ws) - 1) if not isinstance(mat, BandMatrix) else mat
+    valid = band.sum(axis=0) > np.finfo(float).eps
+    results = {}
+    with phase('insulation_score', windows=ws, n_bins=band.shape[0]):
+        for w, (sums, counts) in _diamond_sums(band, ws, ignore_diags, valid).items():
+            score = _scores(sums, counts, valid)
+            results[w] = normalize_insulation(score) if normalize else score
+    return results[ws[0]] if np.isscalar(windows) else results
+
+
+def insulation_score_store(store, chromosome, windows=10, ignore_diags=1, normalize=True, chunk_size=5000):
+    """
+    Insulation score of a whole chromosome, streaming chunks of bins from a pyHiC store.
+    Memory is O(chunk_size * max(windows)).
+
+    Args:
+        store (str or pyHiC.loading.ContactStore): the store
+        chromosome (str): chromosome
+        windows, ignore_diags, normalize: see insulation_score
+        chunk_size (int): number of bins scored at a time. Default: 5000
+
+    Return:
+        numpy.array (if windows is an int) or dict {window: numpy.array}
+    """
+    from ..loading import ContactStore
+    store = ContactStore(store) if isinstance(store, str) else store
+    ws = _as_list(windows)
+    N, resolution = store.chromosomes[chromosome], store.resolution
+    k = 2 * max(ws) - 1
+    # Bins within k of a chunk enter its diamonds; their validity needs another k bins around
+    margin = 2 * k
+    raw = {w: np.full((N,), np.nan) for w in ws}
+
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        r0, r1 = max(start - margin, 0), min(end + margin, N)
+        with phase('insulation_score_store.read', chromosome=chromosome):
+            b1, b2, v, size = store.band(chromosome, r0 * resolution, r1 * resolution, n_diagonals=k)
+        band = BandMatrix.from_upper(b1, b2, v, size, k)
+        valid = band.sum(axis=0) > np.finfo(float).eps
+        for w, (sums, counts) in _diamond_sums(band, ws, ignore_diags, valid).items():
+            raw[w][start:end] = _scores(sums, counts, valid)[start - r0:end - r0]
+
+    results = {w: normalize_insulation(score) if normalize else score for w, score in raw.items()}
+    return results[ws[0]] if np.isscalar(windows) else results
+
+
+def insulation_delta(score, delta=5):
+    """
+    Delta vector: mean score of the delta bins downstream minus that of the delta bins upstream.
+    Boundaries are where it crosses zero from negative to positive.
+
+    Args:
+        score (numpy.array): insulation score
+        delta (int): number of bins on each side. Default: 5
+
+    Return:
+        numpy.array
+    """
+    N = len(score)
+    filled = np.where(np.isfinite(score), score, 0)
+    finite = np.isfinite(score).astype(float)
+    cs, cn = np.append(0, np.cumsum(filled)), np.append(0, np.cumsum(finite))
+    idx = np.arange(N)
+    up0, down1 = np.maximum(idx - delta, 0), np.minimum(idx + delta + 1, N)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        upstream = (cs[idx] - cs[up0]) / (cn[idx] - cn[up0])
+        downstream = (cs[down1] - cs[idx + 1]) / (cn[down1] - cn[idx + 1])
+    return downstream - upstream
+
+
+def call_boundaries(score, min_strength=0.1):
+    """
+    TAD boundaries: local minima of the insulation score.
+    The strength of a boundary is the prominence of the minimum (how deep it is compared with the
+    highest scores on both sides before reaching a lower minimum).
+
+    Args:
+        score (numpy.array): (normalized) insulation score
+        min_strength (float): only keep boundaries at least this strong. Default: 0.1
+
+    Return:
+        bins (numpy.array of int), strengths (numpy.array)
+    """
+    from scipy.signal import find_peaks
+    finite = np.isfinite(score)
+    if not np.any(finite):
+        return np.zeros((0,), dtype=int), np.zeros((0,))
+    # NaN bins (e.g., gaps) should not create minima
+    filled = np.where(finite, score, np.nanmax(score))
+    peaks, props = find_peaks(-filled, prominence=min_strength)
+    keep = finite[peaks]
+    return peaks[keep], props['prominences'][keep]
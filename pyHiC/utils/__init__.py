@@ -1 +1,3 @@
 from .contact_map_utils import *
+from .band_matrix import BandMatrix
+from .instrument import add_callback, remove_callback, profile, Profile
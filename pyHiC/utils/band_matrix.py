@@ -0,0 +1,274 @@
+"""
+Symmetric contact map which only keeps the contacts within a maximum distance.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class BandMatrix:
+    """
+    Symmetric N x N contact map storing only the first k diagonals (strata) as a k x N array:
+    data[d, i] = mat[i, i + d] (= mat[i + d, i]) for i < N - d. The rest of data[d] is zero.
+    Memory is O(N * k) instead of O(N ** 2).
+    Values beyond the k-th diagonal are not stored and regarded as zero.
+
+    Args:
+        data (numpy.array): k x N array of the strata
+        copy (bool): whether copy data. If False, data is used (and its unused tails zeroed) in place. Default: True
+    """
+    def __init__(self, data, copy=True):
+        data = np.array(data) if copy else np.asarray(data)
+        if data.ndim != 2:
+            raise ValueError('Band data must be a 2-D (k x N) array!')
+        self.data = data
+        n_diagonals, N = data.shape
+        for d in range(1, min(n_diagonals, N + 1)):
+            self.data[d, N - d:] = 0
+        self.data[N:] = 0
+
+    @classmethod
+    def from_upper(cls, row, col, val, size, n_diagonals, dtype=np.float64):
+        """
+        Build from the pixels of the upper triangle (row <= col). Duplicated pixels are summed.
+        Pixels farther than n_diagonals from the diagonal are dropped.
+        """
+        row, col = np.asarray(row, dtype=np.int64), np.asarray(col, dtype=np.int64)
+        dist = col - row
+        keep = (dist >= 0) & (dist < n_diagonals)
+        data = np.bincount(dist[keep] * size + row[keep], weights=np.asarray(val, dtype=np.float64)[keep],
+                           minlength=n_diagonals * size)
+        return cls(data.reshape((n_diagonals, size)).astype(dtype), copy=False)
+
+    @classmethod
+    def from_csr(cls, mat, n_diagonals):
+        """Build from a (symmetric) scipy.sparse matrix. Only its upper triangle is used."""
+        mat = sp.coo_matrix(mat)
+        return cls.from_upper(mat.row, mat.col, mat.data, mat.shape[0], n_diagonals,
+                              dtype=np.result_type(mat.dtype, np.float64))
+
+    @classmethod
+    def from_array(cls, mat, n_diagonals):
+        """Build from a (symmetric) numpy.array. Only its upper triangle is used."""
+        N = mat.shape[0]
+        data = np.zeros((n_diagonals, N), dtype=np.result_type(mat.dtype, np.float64))
+        for d in range(min(n_diagonals, N)):
+            data[d, :N - d] = np.diagonal(mat, d)
+        return cls(data, copy=False)
+
+    @classmethod
+    def from_matrix(cls, mat, n_diagonals):
+        """Build from a BandMatrix, a scipy.sparse matrix or a numpy.array."""
+        if isinstance(mat, BandMatrix):
+            return mat if mat.n_diagonals == n_diagonals else mat.truncate(n_diagonals)
+        if sp.issparse(mat):
+            return cls.from_csr(mat, n_diagonals)
+        return cls.from_array(np.asarray(mat), n_diagonals)
+
+    @property
+    def n_diagonals(self):
+        return self.data.shape[0]
+
+    @property
+    def shape(self):
+        return self.data.shape[1], self.data.shape[1]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def T(self):
+        return self
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __repr__(self):
+        return 'BandMatrix(shape={0}, n_diagonals={1}, dtype={2})'.format(self.shape, self.n_diagonals, self.dtype)
+
+    def copy(self):
+        return BandMatrix(self.data)
+
+    def astype(self, dtype):
+        return BandMatrix(self.data.astype(dtype), copy=False)
+
+    def stratum(self, d):
+        """The d-th diagonal (length N - d), as a view."""
+        return self.data[d, :self.shape[0] - d]
+
+    def strata(self, n_strata=None):
+        """List of the first n_strata diagonals."""
+        n_strata = self.n_diagonals if n_strata is None else n_strata
+        if n_strata > self.n_diagonals:
+            raise ValueError('Only {0} strata are stored!'.format(self.n_diagonals))
+        return [self.stratum(d) for d in range(min(n_strata, self.shape[0]))]
+
+    def truncate(self, n_diagonals):
+        """Keep the first n_diagonals diagonals."""
+        if n_diagonals > self.n_diagonals:
+            raise ValueError('Only {0} strata are stored!'.format(self.n_diagonals))
+        return BandMatrix(self.data[:n_diagonals])
+
+    def submatrix(self, start, end):
+        """The band of bins [start, end)."""
+        k = min(self.n_diagonals, end - start)
+        return BandMatrix(self.data[:k, start:end])
+
+    def tocoo(self, upper=False):
+        """
+        Convert to scipy.sparse.coo_matrix.
+
+        Args:
+            upper (bool): If True, only return the upper triangle. Default: False
+        """
+        N = self.shape[0]
+        rows, cols, vals = [], [], []
+        for d in range(min(self.n_diagonals, N)):
+            r = np.arange(N - d)
+            v = self.data[d, :N - d]
+            nz = v != 0
+            rows.append(r[nz])
+            cols.append(r[nz] + d)
+            vals.append(v[nz])
+        row, col, val = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+        if not upper:
+            off = row != col
+            row, col, val = np.concatenate([row, col[off]]), np.concatenate([col, row[off]]), \
+                np.concatenate([val, val[off]])
+        return sp.coo_matrix((val, (row, col)), shape=self.shape)
+
+    def tocsr(self):
+        return self.tocoo().tocsr()
+
+    def toarray(self):
+        return self.tocoo().toarray()
+
+    def sum(self, axis=None):
+        """
+        Sum of all stored values of the symmetric matrix (axis=None) or of each row / column (axis=0 or 1).
+        """
+        if axis is None:
+            return self.data[0].sum() + 2 * self.data[1:].sum()
+        N = self.shape[0]
+        sm = self.data.sum(axis=0)
+        for d in range(1, min(self.n_diagonals, N)):
+            sm[d:] += self.data[d, :N - d]
+        return sm
+
+    def dot(self, x):
+        """Symmetric matrix - vector product."""
+        N = self.shape[0]
+        y = self.data[0] * x
+        for d in range(1, min(self.n_diagonals, N)):
+            v = self.data[d, :N - d]
+            y[:N - d] += v * x[d:]
+            y[d:] += v * x[:N - d]
+        return y
+
+    def scale(self, bias):
+        """
+        Return diag(bias) * mat * diag(bias).
+
+        Args:
+            bias (numpy.array): length N
+        """
+        N = self.shape[0]
+        data = self.data * bias[np.newaxis, :]
+        for d in range(min(self.n_diagonals, N)):
+            data[d, :N - d] *= bias[d:]
+        return BandMatrix(data, copy=False)
+
+    def apply(self, func):
+        """Apply an element-wise function (e.g., np.log1p) to the stored values."""
+        return BandMatrix(func(self.data))
+
+    def offsets(self):
+        """
+        Full rows within the band: N x (2k - 1) array, column k - 1 + o holds mat[i, i + o] for o in (-k, k).
+        """
+        N, k = self.shape[0], self.n_diagonals
+        full = np.zeros((N, 2 * k - 1), dtype=self.data.dtype)
+        for o in range(min(k, N)):
+            full[:, k - 1 + o] = self.data[o]
+            if o > 0:
+                full[o:, k - 1 - o] = self.data[o, :N - o]
+        return full
+
+    def smooth(self, h=1, n_diagonals=None):
+        """
+        2-D mean filter with a (h+1) x (h+1) window, same as pyHiC.utils.smooothing on the full matrix.
+        The box filter is separable: moving sums (differences of prefix sums) along the rows,
+        then along the columns in sheared (column, offset) coordinates. Cost is O(N * k) for any h.
+
+        Args:
+            h (int): size of the smoothing window. Default: 1
+            n_diagonals (int or None): number of diagonals to return. The first (k - h) are exact;
+                the following ones are underestimated since the values beyond the band are not stored.
+                Default: None (k)
+
+        Return:
+            BandMatrix
+        """
+        N, k, K = self.shape[0], self.n_diagonals, h + 1
+        n_diagonals = k if n_diagonals is None else n_diagonals
+        if n_diagonals > k:
+            raise ValueError('Only {0} strata are stored!'.format(k))
+        c = (K - 1) // 2
+        a = K - 1 - c
+        # out[r, s] = sum of mat[r - a: r + c + 1, s - a: s + c + 1] / K^2
+        full = self.offsets().astype(np.float64)
+        W = full.shape[1]
+        j = np.arange(W)
+
+        # Moving sums along each row (window of offsets [o - a, o + c])
+        cs = np.zeros((N, W + 1))
+        np.cumsum(full, axis=1, out=cs[:, 1:])
+        row_box = cs[:, np.minimum(j + c + 1, W)] - cs[:, np.maximum(j - a, 0)]
+
+        # Shear into (column, offset) coordinates: sheared[s, o] = row_box[s - o, o]
+        sheared = np.zeros((N, W))
+        for idx in range(W):
+            o = idx - (k - 1)
+            if o >= 0:
+                sheared[o:, idx] = row_box[:N - o, idx]
+            else:
+                sheared[:N + o, idx] = row_box[-o:, idx]
+
+        # Moving sums along each column (rows [r - a, r + c] are offsets [o - c, o + a] at a fixed column)
+        cs = np.zeros((N, W + 1))
+        np.cumsum(sheared, axis=1, out=cs[:, 1:])
+        col_box = cs[:, np.minimum(j + a + 1, W)] - cs[:, np.maximum(j - c, 0)]
+
+        out = np.zeros((n_diagonals, N))
+        for o in range(min(n_diagonals, N)):
+            out[o, :N - o] = col_box[o:, k - 1 + o]
+        return BandMatrix(out / K ** 2, copy=False)
+
+    def _binary(self, other, op):
+        # The unused tails of the strata are reset to zero by the constructor
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if isinstance(other, BandMatrix):
+                if other.shape != self.shape:
+                    raise ValueError('Shapes not matched!')
+                k = min(self.n_diagonals, other.n_diagonals)
+                return BandMatrix(op(self.data[:k], other.data[:k]), copy=False)
+            return BandMatrix(op(self.data, other), copy=False)
+
+    def __add__(self, other):
+        return self._binary(other, np.add)
+
+    def __sub__(self, other):
+        return self._binary(other, np.subtract)
+
+    def __mul__(self, other):
+        return self._binary(other, np.multiply)
+
+    def __truediv__(self, other):
+        return self._binary(other, np.divide)
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return BandMatrix(-self.data, copy=False)
@@ -1,9 +1,12 @@
 import numpy as np
 import scipy.sparse as sp
-from scipy.signal import convolve2d
+from .band_matrix import BandMatrix
 
 
 def smooothing(mat, h=1):
+    from scipy.signal import convolve2d
+    if isinstance(mat, BandMatrix):
+        return mat.smooth(h)
     sparse = isinstance(mat, sp.csr_matrix)
     if sparse:
         mat = mat.toarray()
@@ -15,6 +18,115 @@ def smooothing(mat, h=1):
         return new_mat
 
 
+def _coarsen_bias(bias, factor):
+    """
+    Sum the bias of every (factor) bins, ignoring removed (NaN) bins; NaN if all of them are removed.
+    For a divisive bias b, coarse[I, J] / (B_I * B_J) is then the b_i * b_j -weighted mean of the balanced
+    fine pixels in block (I, J) (an approximation; balance the coarse map again for an exact one).
+    """
+    bias = np.asarray(bias, dtype=float)
+    M = -(-len(bias) // factor)
+    idx = np.arange(len(bias)) // factor
+    valid = np.isfinite(bias)
+    sums = np.bincount(idx[valid], weights=bias[valid], minlength=M)
+    counts = np.bincount(idx[valid], minlength=M)
+    return np.where(counts > 0, sums, np.nan)
+
+
+def _coarsen_band(band, factor):
+    """Coarsen a BandMatrix, keeping the coarse diagonals fully covered by the stored band (at least 1)."""
+    N, k = band.shape[0], min(band.n_diagonals, band.shape[0])
+    M, K = -(-N // factor), max(band.n_diagonals // factor, 1)
+    d = np.repeat(np.arange(k), N)
+    row = np.tile(np.arange(N), k)
+    keep = (row + d < N) & (band.data[:k].ravel() != 0)
+    d, row, val = d[keep], row[keep], band.data[:k].ravel()[keep]
+    return BandMatrix.from_upper(row // factor, (row + d) // factor, val, M, K)
+
+
+def _coarsen(mat, factor, symmetric=True):
+    """
+    Sum the pixels of every factor x factor block. For a symmetric map, only the upper triangle is summed
+    and then mirrored, so that a contact inside a diagonal block is counted once, as the loaders do.
+    """
+    if factor == 1:
+        return mat
+    if isinstance(mat, BandMatrix):
+        return _coarsen_band(mat, factor)
+    n1, n2 = -(-mat.shape[0] // factor), -(-mat.shape[1] // factor)
+    if sp.issparse(mat):
+        coo = sp.coo_matrix(mat)
+        if symmetric:
+            upper = coo.row <= coo.col
+            coo = sp.coo_matrix((coo.data[upper], (coo.row[upper], coo.col[upper])), shape=coo.shape)
+        out = sp.csr_matrix((coo.data, (coo.row // factor, coo.col // factor)), shape=(n1, n2))
+        out.sum_duplicates()
+        return out + sp.triu(out, 1).T.tocsr() if symmetric else out
+    mat = np.asarray(mat)
+    padded = np.zeros((n1 * factor, n2 * factor), dtype=np.result_type(mat.dtype, np.float64))
+    padded[:mat.shape[0], :mat.shape[1]] = np.triu(mat) if symmetric else mat
+    out = padded.reshape((n1, factor, n2, factor)).sum(axis=(1, 3))
+    return out + np.triu(out, 1).T if symmetric else out
+
+
+def coarsen(mat, factor=2, bias=None, symmetric=None):
+    """
+    Aggregate a contact map to a lower resolution: coarse bin I is fine bins [I * factor, (I + 1) * factor),
+    the last coarse bin may cover fewer bins. It is the same map as loading the file at resolution * factor.
+    Several factors are computed from each other where possible (e.g., 10 from 5 from 1).
+
+    Args:
+        mat (scipy.sparse matrix or pyHiC.utils.BandMatrix or numpy.array): contact map.
+            A BandMatrix of k diagonals gives a BandMatrix of k // factor (at least 1) diagonals.
+        factor (int or list): coarsening factor, or a list of factors
+        bias (numpy.array or None): bias vector of the fine map, coarsened along (see _coarsen_bias). Default: None
+        symmetric (bool or None): whether mat is a symmetric (intra-chromosomal) map; if False, all pixels are
+            summed (e.g., an inter-chromosomal block). Default: None (True for square maps)
+
+    Return:
+        the coarse map (same type as mat), or (map, bias) if bias is given;
+        a dict {factor: result} if factor is a list
+    """
+    factors = [factor] if np.isscalar(factor) else list(factor)
+    for f in factors:
+        if int(f) != f or f < 1:
+            raise ValueError('Coarsening factor must be a positive integer, got {0}!'.format(f))
+    if symmetric is None:
+        symmetric = mat.shape[0] == mat.shape[1]
+    if bias is not None and len(bias) != mat.shape[0]:
+        raise ValueError('Bias length {0} does not match the map ({1})!'.format(len(bias), mat.shape[0]))
+
+    done = {1: (mat, bias)}
+    for f in sorted(set(int(f) for f in factors)):
+        base = max(b for b in done if f % b == 0)
+        m, b = done[base]
+        done[f] = (_coarsen(m, f // base, symmetric), None if b is None else _coarsen_bias(b, f // base))
+
+    results = {f: done[int(f)] if bias is not None else done[int(f)][0] for f in factors}
+    return results[factor] if np.isscalar(factor) else results
+
+
+def coarsen_resolutions(mat, resolution, resolutions, bias=None, symmetric=None):
+    """
+    Several resolutions from one fine-resolution map (see coarsen).
+
+    Args:
+        mat: contact map at the fine resolution
+        resolution (int): resolution of mat
+        resolutions (list): target resolutions, multiples of resolution
+        bias (numpy.array or None): bias vector of mat. Default: None
+        symmetric (bool or None): see coarsen. Default: None
+
+    Return:
+        dict {resolution: map} (or {resolution: (map, bias)} if bias is given)
+    """
+    for res in resolutions:
+        if res % resolution != 0:
+            raise ValueError('Resolution {0} is not a multiple of {1}!'.format(res, resolution))
+    results = coarsen(mat, [res // resolution for res in resolutions], bias=bias, symmetric=symmetric)
+    return {res: results[res // resolution] for res in resolutions}
+
+
 def random_walk():
     pass
 
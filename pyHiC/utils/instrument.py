@@ -0,0 +1,191 @@
+"""
+Progress events, phase timings and profiling.
+
+pyHiC functions report their progress as events (a name and a dict of fields), e.g.
+    "parse.progress"   lines, bytes, seconds, lines_per_second, bytes_per_second
+    "kr.iteration"     iteration, residual, inner_iterations, seconds, eta_seconds
+    "ice.iteration"    iteration, deviation, seconds, eta_seconds
+    "kr.done" / "ice.done"  iterations, residual / deviation, converged, seconds
+    "phase"            name, seconds (and peak_mb if tracemalloc is tracing) of a timed step
+Events are sent to
+    - the callbacks registered with add_callback: func(event, fields)
+    - the active profile() contexts
+    - the "pyHiC" logger (the fields are also in record.event / record.fields), e.g.
+      logging.basicConfig(level=logging.INFO) shows them.
+If none of them is listening, emit() and phase() return right away.
+"""
+
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('pyHiC')
+logger.addHandler(logging.NullHandler())
+
+_callbacks = []
+_profiles = []
+_phase_stack = []
+_peak = [0]
+
+
+def add_callback(func):
+    """Register func(event, fields), called for every event."""
+    _callbacks.append(func)
+
+
+def remove_callback(func):
+    _callbacks.remove(func)
+
+
+def enabled(level=logging.INFO):
+    """Whether an event of this level would be received by anyone."""
+    return bool(_callbacks or _profiles) or logger.isEnabledFor(level)
+
+
+def _format(value):
+    return '{0:.4g}'.format(value) if isinstance(value, float) else str(value)
+
+
+def emit(event, level=logging.INFO, **fields):
+    """Send an event to the callbacks, the active profiles and the logger."""
+    if not (_callbacks or _profiles or logger.isEnabledFor(level)):
+        return
+    for func in _callbacks:
+        func(event, fields)
+    for prof in _profiles:
+        prof._add(event, fields)
+    if logger.isEnabledFor(level):
+        logger.log(level, '%s %s', event, ' '.join('{0}={1}'.format(k, _format(v)) for k, v in fields.items()),
+                   extra={'event': event, 'fields': fields})
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, name, fields):
+        self.name, self.fields = name, fields
+
+    def __enter__(self):
+        self.memory = tracemalloc.is_tracing()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # Keep the peak so far for the enclosing phases before resetting it
+            _peak[0] = max(_peak[0], peak)
+            if _phase_stack:
+                _phase_stack[-1].sub_peak = max(_phase_stack[-1].sub_peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory, self.sub_peak = current, 0
+        _phase_stack.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+        _phase_stack.pop()
+        fields = dict(name=self.name, seconds=seconds, **self.fields)
+        if self.memory and tracemalloc.is_tracing():
+            peak = max(self.sub_peak, tracemalloc.get_traced_memory()[1])
+            _peak[0] = max(_peak[0], peak)
+            if _phase_stack:
+                _phase_stack[-1].sub_peak = max(_phase_stack[-1].sub_peak, peak)
+            fields['peak_mb'] = (peak - self.start_memory) / 2 ** 20
+        emit('phase', **fields)
+        return False
+
+
+def phase(name, **fields):
+    """
+    Time a step: "with phase('KR'): ..." emits a "phase" event with its name and seconds when it ends.
+    Does nothing if nobody is listening.
+    """
+    if not (_callbacks or _profiles or logger.isEnabledFor(logging.INFO)):
+        return _NULL_PHASE
+    return _Phase(name, fields)
+
+
+class Profile:
+    """
+    Timings collected by profile().
+
+    Attributes:
+        phases (dict): {name: {"calls", "seconds", "max_seconds", "peak_mb"}}
+        events (list): (event, fields) of every event, if keep_events
+        seconds (float): total time of the profiled block
+        peak_mb (float or None): peak memory traced in the block (memory=True only)
+    """
+    def __init__(self, memory=False, keep_events=True):
+        self.memory, self.keep_events = memory, keep_events
+        self.phases, self.events = {}, []
+        self.seconds, self.peak_mb = None, None
+
+    def _add(self, event, fields):
+        if self.keep_events:
+            self.events.append((event, dict(fields)))
+        if event == 'phase':
+            stats = self.phases.setdefault(fields['name'], {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                            'peak_mb': None})
+            stats['calls'] += 1
+            stats['seconds'] += fields['seconds']
+            stats['max_seconds'] = max(stats['max_seconds'], fields['seconds'])
+            if 'peak_mb' in fields:
+                stats['peak_mb'] = max(stats['peak_mb'] or 0, fields['peak_mb'])
+
+    def summary(self):
+        """A table of the phases, slowest first."""
+        lines = ['{0:<36s} {1:>6s} {2:>10s} {3:>10s} {4:>9s}'.format('phase', 'calls', 'total (s)', 'max (s)',
+                                                                      'peak (MB)')]
+        for name, s in sorted(self.phases.items(), key=lambda kv: -kv[1]['seconds']):
+            lines.append('{0:<36s} {1:>6d} {2:10.4f} {3:10.4f} {4:>9s}'.format(
+                name, s['calls'], s['seconds'], s['max_seconds'],
+                '-' if s['peak_mb'] is None else '{0:.1f}'.format(s['peak_mb'])))
+        if self.seconds is not None:
+            lines.append('total {0:.4f} s{1}'.format(
+                self.seconds, '' if self.peak_mb is None else ', peak {0:.1f} MB'.format(self.peak_mb)))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile(memory=False, keep_events=True):
+    """
+    Collect the phase timings (and events) of everything run inside the block:
+
+        with profile(memory=True) as prof:
+            mat = load_HiC(...)
+            normalization(mat, 'KR')
+        print(prof.summary())
+
+    Args:
+        memory (bool): also trace the peak memory of each phase with tracemalloc (slower). Default: False
+        keep_events (bool): keep all events in prof.events. Default: True
+
+    Only the current process is profiled (not the workers of a process pool).
+    """
+    prof = Profile(memory, keep_events)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if memory:
+        tracemalloc.reset_peak()
+        _peak[0] = 0
+    _profiles.append(prof)
+    t0 = time.perf_counter()
+    try:
+        yield prof
+    finally:
+        prof.seconds = time.perf_counter() - t0
+        _profiles.remove(prof)
+        if memory:
+            prof.peak_mb = max(_peak[0], tracemalloc.get_traced_memory()[1]) / 2 ** 20
+            if started:
+                tracemalloc.stop()
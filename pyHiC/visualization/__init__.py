@@ -1,2 +1,4 @@
 from .visualize_HiC import *
 from .visualize_HiC_and_epigenetics import *
+from .tile_pyramid import build_tile_pyramid, TilePyramid
+from .batch_plot import plot_loci
@@ -0,0 +1,209 @@
+"""
+Plot many loci (Hi-C triangle + epigenetic tracks, as visualize_HiC_epigenetics) in one call.
+
+Each process builds one figure (an Agg canvas, no pyplot state) and reuses it for every locus:
+the image, the track polygons, the limits and the ticks are updated instead of creating new artists.
+The contact map and the tracks of a locus are only sliced when it is plotted.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .visualize_HiC import _triangle_image
+from ..utils.instrument import emit
+
+
+class _LocusTemplate:
+    """A figure with a heatmap and n_tracks signal axes, built once and updated for each locus."""
+    def __init__(self, n_tracks, fig_width=12.0, cmap='Reds', colorbar=True, colorbar_orientation='vertical',
+                 epi_labels=None, fontsize=24, epi_colors=None, epi_yaxis=True,
+                 heatmap_ratio=0.6, epi_ratio=0.1, interval_after_heatmap=0.05, interval_between_epi=0.01,
+                 dpi=100):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.gridspec import GridSpec
+        from matplotlib.collections import PolyCollection
+        from matplotlib.transforms import Affine2D
+        rs = [heatmap_ratio, interval_after_heatmap] + [epi_ratio, interval_between_epi] * n_tracks
+        rs = np.array(rs[:-1]) if n_tracks else np.array([heatmap_ratio])
+        fig_height = fig_width * np.sum(rs)
+        rs = rs / np.sum(rs)
+        self.fig = Figure(figsize=(fig_width, fig_height), dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        gs = GridSpec(len(rs), 1, height_ratios=rs, figure=self.fig)
+        self.fontsize = fontsize
+
+        self.ax0 = self.fig.add_subplot(gs[0, :])
+        self.im = self.ax0.imshow(np.full((1, 1), np.nan), origin='lower', extent=(0, 1, 0, 1),
+                                  interpolation='nearest', aspect='auto', cmap=cmap)
+        self.im.set_transform(Affine2D(np.array([[0.5, 0.5, 0], [1, -1, 0], [0, 0, 1]])) + self.ax0.transData)
+        self.ax0.axis('off')
+        self.n_pixels = int(np.ceil(self.ax0.get_position().width * fig_width * dpi))
+        if colorbar:
+            if colorbar_orientation == 'horizontal':
+                _left, _width, _bottom, _height = 0.12, 0.25, 1 - rs[0] * 0.25, rs[0] * 0.03
+            elif colorbar_orientation == 'vertical':
+                _left, _width, _bottom, _height = 0.9, 0.02, 1 - rs[0] * 0.7, rs[0] * 0.5
+            else:
+                raise ValueError('Wrong orientation!')
+            cbar = self.fig.colorbar(self.im, cax=self.fig.add_axes([_left, _bottom, _width, _height]),
+                                     orientation=colorbar_orientation)
+            cbar.ax.tick_params(labelsize=fontsize)
+            cbar.outline.set_visible(False)
+
+        if epi_labels:
+            assert n_tracks == len(epi_labels)
+        if epi_colors:
+            assert n_tracks == len(epi_colors)
+        self.axes, self.polys = [], []
+        for i in range(n_tracks):
+            ax = self.fig.add_subplot(gs[2 + 2 * i, :])
+            poly = PolyCollection([np.zeros((0, 2))], facecolors=epi_colors[i] if epi_colors else 'C0')
+            ax.add_collection(poly)
+            if not epi_yaxis:
+                ax.set_yticks([])
+                ax.spines['left'].set_visible(False)
+            else:
+                ax.tick_params(labelsize=fontsize)
+            ax.spines['right'].set_visible(False)
+            ax.spines['top'].set_visible(False)
+            ax.spines['bottom'].set_visible(i == n_tracks - 1)
+            if i != n_tracks - 1:
+                ax.set_xticks([])
+            if epi_labels:
+                ax.set_ylabel(epi_labels[i], fontsize=fontsize)
+            self.axes.append(ax)
+            self.polys.append(poly)
+
+    def update(self, HiC, tracks, vmin=0, vmax=None, x_ticks=None):
+        N = HiC.shape[0]
+        image, _ = _triangle_image(HiC, self.n_pixels)
+        if vmax is None:
+            # The max of the drawn (averaged) pixels, not of the raw bins, as visualize_HiC_triangle
+            vmax = np.nanmax(image) if np.isfinite(image).any() else 1
+        self.im.set_data(image)
+        self.im.set_extent((0, N, 0, N))
+        self.im.set_clim(vmin, vmax)
+        self.ax0.set_xlim([0, N])
+        self.ax0.set_ylim([0, N])
+
+        x = np.arange(N)
+        for ax, poly, epi in zip(self.axes, self.polys, tracks):
+            epi = np.nan_to_num(np.asarray(epi, dtype=float))
+            # The polygon drawn by fill_between(x, 0, epi)
+            poly.set_verts([np.column_stack([np.concatenate([[0], x, [N - 1]]),
+                                             np.concatenate([[0], epi, [0]])])])
+            ax.set_xlim([-0.5, N - 0.5])
+            low, high = min(epi.min(), 0), max(epi.max(), 0)
+            ax.set_ylim([low, high + 0.05 * (high - low) if high > low else 1])
+        if self.axes:
+            ax = self.axes[-1]
+            if x_ticks:
+                ax.set_xticks(np.linspace(0, N - 1, len(x_ticks)))
+                ax.set_xticklabels(x_ticks, fontsize=self.fontsize)
+            else:
+                ax.set_xticks([])
+
+    def save(self, output):
+        self.fig.savefig(output)
+
+
+class _LocusPlotter:
+    """Slices loci from the contact maps and tracks and draws them with one template."""
+    def __init__(self, source, tracks, resolution, template_args, vmin, vmax, n_ticks):
+        if isinstance(source, str):
+            from ..loading import ContactStore
+            self.store, self.mats = ContactStore(source), None
+            self.resolution = self.store.resolution
+        else:
+            self.store, self.mats = None, source
+            self.resolution = resolution
+        self.tracks = tracks
+        self.template = _LocusTemplate(len(tracks), **template_args)
+        self.vmin, self.vmax, self.n_ticks = vmin, vmax, n_ticks
+
+    def _slice(self, chrom, start, end):
+        if self.store is not None:
+            b0, b1 = self.store.bin_range(chrom, start, end)
+            HiC = self.store.query(chrom, start, end)
+        else:
+            mat = self.mats[chrom]
+            b0 = max(start // self.resolution, 0)
+            b1 = mat.shape[0] if end == -1 else min(int(np.ceil(end / self.resolution)), mat.shape[0])
+            HiC = mat[b0:b1, b0:b1]
+        return HiC, [track[chrom][b0:b1] for track in self.tracks], b0, b1
+
+    def plot(self, task):
+        (chrom, start, end), output = task
+        t0 = time.time()
+        HiC, tracks, b0, b1 = self._slice(chrom, start, end)
+        t1 = time.time()
+        x_ticks = None
+        if self.n_ticks:
+            x_ticks = ['{0:.2f}Mb'.format(p / 1e6) for p in
+                       np.linspace(b0 * self.resolution, b1 * self.resolution, self.n_ticks)]
+        self.template.update(HiC, tracks, self.vmin, self.vmax, x_ticks)
+        t2 = time.time()
+        self.template.save(output)
+        t3 = time.time()
+        return {'region': (chrom, start, end), 'output': output, 'n_bins': b1 - b0,
+                'slice': t1 - t0, 'draw': t2 - t1, 'save': t3 - t2, 'total': t3 - t0}
+
+
+_WORKER = {}
+
+
+def _init_worker(*args):
+    _WORKER['plotter'] = _LocusPlotter(*args)
+
+
+def _plot_in_worker(task):
+    return _WORKER['plotter'].plot(task)
+
+
+def plot_loci(regions, source, tracks, output_dir, resolution=10000, file_format='png',
+              vmin=0, vmax=None, n_ticks=3, n_workers=None, **kwargs):
+    """
+    Plot Hi-C + epigenetic signal figures (as visualize_HiC_epigenetics) for many regions.
+
+    Args:
+        regions (list): (chromosome, start, end) or (chromosome, start, end, name) in base pairs
+        source (str or dict): the path of a pyHiC store or {chromosome: contact map (scipy.sparse.csr_matrix)}
+        tracks (list): epigenetic signals, each a dict {chromosome: numpy.array} at the resolution of the maps
+            (numpy.memmap works, only the region is read)
+        output_dir (str): the folder of the figures, named "{name}.{file_format}" (default name: chrom_start_end)
+        resolution (int): resolution of a dict source. Default: 10000
+        file_format (str): Default: 'png'
+        vmin (float): min value of the colormap. Default: 0
+        vmax (float): max value of the colormap. Default: None (the max of the drawn pixels of each region;
+            pixels average several bins when a region has more bins than the figure has pixels)
+        n_workers (int or None): number of processes. Default: None (number of CPUs)
+        **kwargs: figure layout, same as visualize_HiC_epigenetics (fig_width, cmap, colorbar, colorbar_orientation,
+            epi_labels, fontsize, epi_colors, epi_yaxis, heatmap_ratio, epi_ratio,
+            interval_after_heatmap, interval_between_epi) and dpi
+
+    Return:
+        list of dict (one per region): "region", "output", "n_bins", and the seconds spent on
+        "slice", "draw", "save" and "total"
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = []
+    for region in regions:
+        chrom, start, end = region[:3]
+        name = region[3] if len(region) > 3 else '{0}_{1}_{2}'.format(chrom, start, end)
+        tasks.append(((chrom, start, end), os.path.join(output_dir, '{0}.{1}'.format(name, file_format))))
+    args = (source, tracks, resolution, kwargs, vmin, vmax, n_ticks)
+
+    t0 = time.time()
+    if n_workers == 1 or len(tasks) <= 1:
+        plotter = _LocusPlotter(*args)
+        timings = [plotter.plot(task) for task in tasks]
+    else:
+        n_workers = min(n_workers or os.cpu_count(), len(tasks))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=args) as pool:
+            timings = list(pool.map(_plot_in_worker, tasks, chunksize=max(len(tasks) // (4 * n_workers), 1)))
+    if timings:
+        emit('plot_loci.done', loci=len(timings), seconds=time.time() - t0,
+             seconds_per_locus=float(np.mean([t['total'] for t in timings])))
+    return timings
@@ -0,0 +1,241 @@
+"""
+Multi-resolution tile pyramid for browsing whole chromosomes.
+
+A pyramid is a directory:
+    meta.json                          finest resolution, tile size, and the levels / digest of each chromosome
+    <chrom>/<level>/<i>_<j>.npz        pixels (row, col, value relative to the tile) of tile (i, j), i <= j
+    <chrom>/<level>/<i>_<j>.png        optional pre-rendered tile
+Level 0 is the input resolution; level L + 1 is level L coarsened 2 x 2 (pyHiC.utils.coarsen).
+Each tile covers tile_size x tile_size bins of its level; empty tiles are not written.
+"""
+
+import os
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from ..normalization.cache import _matrix_digest
+from ..utils import coarsen
+
+
+META_FILE = 'meta.json'
+
+
+def _read_meta(path):
+    meta_file = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    tmp = os.path.join(path, META_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(path, META_FILE))
+
+
+def _render_tile(file, tile, vmin, vmax, cmap):
+    import matplotlib.pyplot as plt
+    plt.imsave(file, tile, vmin=vmin, vmax=vmax, cmap=cmap, origin='upper')
+
+
+def _write_tiles(folder, mat, tile_size, render=None):
+    """Write the upper tiles (i <= j) of one level. Return the number of tiles written."""
+    os.makedirs(folder, exist_ok=True)
+    coo = sp.coo_matrix(mat)
+    ti, tj = coo.row // tile_size, coo.col // tile_size
+    keep = ti <= tj
+    row, col, val, ti, tj = coo.row[keep], coo.col[keep], coo.data[keep], ti[keep], tj[keep]
+    n_tiles = (mat.shape[1] + tile_size - 1) // tile_size
+    key = ti.astype(np.int64) * n_tiles + tj
+    order = np.argsort(key, kind='stable')
+    keys, starts = np.unique(key[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for k, st, ed in zip(keys, starts, ends):
+        i, j = int(k // n_tiles), int(k % n_tiles)
+        sel = order[st:ed]
+        r, c = (row[sel] - i * tile_size).astype(np.uint16), (col[sel] - j * tile_size).astype(np.uint16)
+        np.savez(os.path.join(folder, '{0}_{1}.npz'.format(i, j)), row=r, col=c, value=val[sel].astype(np.float32))
+        if render is not None:
+            tile = np.zeros((tile_size, tile_size), dtype=np.float32)
+            tile[r, c] = val[sel]
+            _render_tile(os.path.join(folder, '{0}_{1}.png'.format(i, j)), tile, *render)
+    return len(keys)
+
+
+def _build_chromosome(source, chrom, path, tile_size, render, old_digest, force):
+    """
+    Build all levels of one chromosome into a temporary folder, then swap it in.
+
+    Return:
+        (chromosome, {'n_bins', 'levels', 'digest'}) or None if up to date
+    """
+    if isinstance(source, str):
+        from ..loading import ContactStore
+        mat = ContactStore(source).query(chrom)
+    else:
+        mat = sp.csr_matrix(source)
+    digest = _matrix_digest(mat)
+    if not force and digest == old_digest:
+        return None
+
+    tmp = os.path.join(path, '.{0}.tmp.{1}'.format(chrom, os.getpid()))
+    shutil.rmtree(tmp, ignore_errors=True)
+    level, n_bins = 0, mat.shape[0]
+    while True:
+        level_render = None
+        if render is not None:
+            cmap, vmin, vmax = render
+            level_render = (vmin, vmax if vmax is not None else (mat.max() if mat.nnz else 1), cmap)
+        _write_tiles(os.path.join(tmp, str(level)), mat, tile_size, level_render)
+        if mat.shape[0] <= tile_size:
+            break
+        mat = coarsen(mat, 2)
+        level += 1
+
+    final = os.path.join(path, chrom)
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(tmp, final)
+    return chrom, {'n_bins': int(n_bins), 'levels': level + 1, 'digest': digest}
+
+
+def build_tile_pyramid(source, path, resolution=10000, tile_size=256, chromosomes=None,
+                       render=False, cmap='Reds', vmin=0, vmax=None, n_workers=None, force=False):
+    """
+    Build (or update) a tile pyramid from finest-resolution contact maps.
+    Chromosomes are built in parallel; a chromosome whose map has not changed since the last build is skipped.
+
+    Args:
+        source (dict or str): {chromosome: contact map (scipy.sparse or numpy.array)} or the path of a pyHiC store
+        path (str): folder of the pyramid
+        resolution (int): resolution of the input maps (ignored for a store). Default: 10000
+        tile_size (int): number of bins on each side of a tile. Default: 256
+        chromosomes (list or None): chromosomes to build. Default: None (all)
+        render (bool): whether also write colored PNG tiles. Default: False
+        cmap, vmin, vmax: colormap of the rendered tiles (vmax=None: the max value of each level)
+        n_workers (int or None): number of processes. Default: None (number of CPUs)
+        force (bool): rebuild the chromosomes even if unchanged. Default: False
+
+    Return:
+        list of the rebuilt chromosomes
+    """
+    if isinstance(source, str):
+        from ..loading import ContactStore
+        store = ContactStore(source)
+        resolution = store.resolution
+        names = [ch for ch in store.chromosomes if (ch, ch) in store.blocks]
+    else:
+        names = list(source.keys())
+    names = names if chromosomes is None else [ch for ch in names if ch in chromosomes]
+
+    os.makedirs(path, exist_ok=True)
+    meta = _read_meta(path)
+    if meta is None or meta['resolution'] != resolution or meta['tile_size'] != tile_size:
+        meta = {'format': 'pyHiC-tiles', 'version': 1, 'resolution': int(resolution),
+                'tile_size': int(tile_size), 'chromosomes': {}}
+        force = True
+    render_args = (cmap, vmin, vmax) if render else None
+
+    def _args(_ch):
+        _source = source if isinstance(source, str) else source[_ch]
+        _old = meta['chromosomes'].get(_ch, {}).get('digest')
+        return _source, _ch, path, tile_size, render_args, _old, force
+
+    if n_workers == 1:
+        results = [_build_chromosome(*_args(ch)) for ch in names]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+            results = list(pool.map(_build_chromosome, *zip(*[_args(ch) for ch in names]))) if names else []
+
+    rebuilt = []
+    for result in results:
+        if result is not None:
+            meta['chromosomes'][result[0]] = result[1]
+            rebuilt.append(result[0])
+    _write_meta(path, meta)
+    return rebuilt
+
+
+class TilePyramid:
+    """
+    Read-only access to a tile pyramid.
+
+    Args:
+        path (str): the folder of the pyramid
+    """
+    def __init__(self, path):
+        meta = _read_meta(path)
+        if meta is None:
+            raise ValueError('Not a pyHiC tile pyramid: ' + path)
+        self.path = path
+        self.resolution = meta['resolution']
+        self.tile_size = meta['tile_size']
+        self.chromosomes = meta['chromosomes']
+
+    def __repr__(self):
+        return 'TilePyramid({0}, resolution={1}, {2} chromosomes)'.format(
+            self.path, self.resolution, len(self.chromosomes))
+
+    def level_resolution(self, level):
+        return self.resolution * 2 ** level
+
+    def tile(self, chrom, level, i, j):
+        """
+        Dense tile (tile_size x tile_size) of bins [i * tile_size, (i + 1) * tile_size) x [j * tile_size, ...).
+        Tiles below the diagonal (i > j) are the transposed upper tiles; missing tiles are zeros.
+        """
+        T = self.tile_size
+        out = np.zeros((T, T))
+        a, b = (i, j) if i <= j else (j, i)
+        file = os.path.join(self.path, chrom, str(level), '{0}_{1}.npz'.format(a, b))
+        if os.path.exists(file):
+            with np.load(file) as data:
+                out[data['row'], data['col']] = data['value']
+        return out if i <= j else out.T
+
+    def choose_level(self, chrom, n_bins, max_pixels=1024):
+        """The finest level at which n_bins (finest-resolution) bins fit in max_pixels."""
+        level = 0
+        while n_bins / 2 ** level > max_pixels and level < self.chromosomes[chrom]['levels'] - 1:
+            level += 1
+        return level
+
+    def viewport(self, chrom, start=0, end=-1, start2=None, end2=None, max_pixels=1024, level=None):
+        """
+        Contact map of a region at the finest zoom level with at most max_pixels bins on each side.
+
+        Args:
+            chrom (str): chromosome
+            start & end (int): region in base pairs. Default: 0 and -1 (0: start, -1: end)
+            start2 & end2 (int or None): columns of the region. Default: None (same as start & end)
+            max_pixels (int): max number of bins on each side. Default: 1024
+            level (int or None): use this zoom level instead. Default: None
+
+        Return:
+            numpy.array, resolution of the returned map (int)
+        """
+        info = self.chromosomes[chrom]
+        length = info['n_bins'] * self.resolution
+        end = length if end == -1 or end is None else min(end, length)
+        start2 = start if start2 is None else start2
+        end2 = end if end2 is None else (length if end2 == -1 else min(end2, length))
+        if level is None:
+            n_bins = max(end - start, end2 - start2) / self.resolution
+            level = self.choose_level(chrom, n_bins, max_pixels)
+        res = self.level_resolution(level)
+        n_level = int(np.ceil(info['n_bins'] / 2 ** level))
+        r0, r1 = start // res, min(int(np.ceil(end / res)), n_level)
+        c0, c1 = start2 // res, min(int(np.ceil(end2 / res)), n_level)
+
+        T = self.tile_size
+        out = np.zeros((max(r1 - r0, 0), max(c1 - c0, 0)))
+        for i in range(r0 // T, (r1 - 1) // T + 1 if r1 > r0 else 0):
+            for j in range(c0 // T, (c1 - 1) // T + 1 if c1 > c0 else 0):
+                tile = self.tile(chrom, level, i, j)
+                a0, a1 = max(r0, i * T), min(r1, (i + 1) * T)
+                b0, b1 = max(c0, j * T), min(c1, (j + 1) * T)
+                out[a0 - r0:a1 - r0, b0 - c0:b1 - c0] = tile[a0 - i * T:a1 - i * T, b0 - j * T:b1 - j * T]
+        return out, res
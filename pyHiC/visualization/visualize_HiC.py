@@ -3,8 +3,76 @@ Visualize a given region of HiC contact map or compare two contact maps.
 """
 import numpy as np
 import scipy.sparse as sp
-import matplotlib.pyplot as plt
-import seaborn as sns
+from ..utils import BandMatrix
+
+
+def _triangle_image(HiC, n_pixels):
+    """
+    Rasterize the upper triangle of a contact map into an M x M image (M <= n_pixels).
+    If the map has more bins than pixels, each image pixel is the mean of f x f bins (f = ceil(N / n_pixels)).
+    Pixels below the diagonal, and outside the stored band of a BandMatrix, are NaN (not drawn).
+
+    Return:
+        image (numpy.array), f (int)
+    """
+    N = HiC.shape[0]
+    f = max(int(np.ceil(N / max(n_pixels, 1))), 1)
+    M = int(np.ceil(N / f))
+    sizes = np.minimum(f, N - np.arange(M) * f).astype(float)
+
+    if isinstance(HiC, BandMatrix) or sp.issparse(HiC):
+        if isinstance(HiC, BandMatrix):
+            k = min(HiC.n_diagonals, N)
+            rows = np.concatenate([np.arange(N - d) for d in range(k)])
+            cols = np.concatenate([np.arange(d, N) for d in range(k)])
+            vals = np.concatenate(HiC.strata(k))
+        else:
+            coo = sp.triu(sp.coo_matrix(HiC)).tocoo()
+            rows, cols, vals = coo.row, coo.col, coo.data
+        R, C = rows // f, cols // f
+        # An off-diagonal pixel in a diagonal block also stands for its mirror
+        weights = np.where((R == C) & (rows != cols), 2.0, 1.0)
+        sums = np.bincount(R * M + C, weights=vals * weights, minlength=M * M).reshape((M, M))
+        if isinstance(HiC, BandMatrix):
+            # Only the stored pixels are counted
+            counts = np.bincount(R * M + C, weights=weights, minlength=M * M).reshape((M, M))
+        else:
+            counts = np.outer(sizes, sizes)
+    else:
+        HiC = np.asarray(HiC, dtype=float)
+        if f == 1:
+            sums, counts = HiC.copy(), np.ones((N, N))
+        else:
+            padded = np.zeros((M * f, M * f))
+            padded[:N, :N] = HiC
+            sums = padded.reshape((M, f, M, f)).sum(axis=(1, 3))
+            counts = np.outer(sizes, sizes)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        image = sums / counts
+    image[counts == 0] = np.nan
+    image[np.tril_indices(M, -1)] = np.nan
+    return image, f
+
+
+def _plot_triangle(ax, HiC, vmin=0, vmax=None, cmap='Reds'):
+    """
+    Draw the upper triangle rotated by 45 degrees: bin pair (i, j) is centered at ((i + j + 1) / 2, j - i).
+    The map is rasterized to the width of the axes in pixels and drawn with one affine-transformed image.
+    """
+    from matplotlib.transforms import Affine2D
+    N = HiC.shape[0]
+    image, _ = _triangle_image(HiC, int(np.ceil(ax.get_window_extent().width)))
+    if vmax is None:
+        # The max of the drawn (averaged) pixels, not of the raw bins
+        vmax = np.nanmax(image) if np.isfinite(image).any() else None
+    im = ax.imshow(image, origin='lower', extent=(0, N, 0, N), interpolation='nearest',
+                   aspect='auto', vmin=vmin, vmax=vmax, cmap=cmap)
+    # Image coordinates (column, row) -> ((row + column) / 2, column - row)
+    im.set_transform(Affine2D(np.array([[0.5, 0.5, 0], [1, -1, 0], [0, 0, 1]])) + ax.transData)
+    ax.set_ylim([0, N])
+    ax.set_xlim([0, N])
+    return im
 
 
 def visualize_HiC_triangle(HiC, output, fig_size=(12, 6.5),
@@ -14,11 +82,14 @@ def visualize_HiC_triangle(HiC, output, fig_size=(12, 6.5),
     """
         Visualize matched HiC and epigenetic signals in one figure
         Args:
-            HiC (numpy.array): Hi-C contact map, only upper triangle is used.
+            HiC (numpy.array or scipy.sparse.csr_matrix or pyHiC.utils.BandMatrix): Hi-C contact map,
+                only upper triangle is used. Sparse and band maps are rasterized without densifying them;
+                if the map has more bins than the figure has pixels, each pixel shows the mean of several bins.
             output (str): the output path. Must in a proper format (e.g., 'png', 'pdf', 'svg', ...).
             fig_size (tuple): (width, height). Default: (12, 8)
             vmin (float): min value of the colormap. Default: 0
-            vmax (float): max value of the colormap. Will use the max value in Hi-C data if not specified.
+            vmax (float): max value of the colormap. Will use the max value of the drawn (rasterized) image
+                if not specified.
             cmap (str or plt.cm): which colormap to use. Default: 'Reds'
             colorbar (bool): whether to add colorbar for the heatmap. Default: True
             colorbar_orientation (str): "horizontal" or "vertical". Default: "vertical"
@@ -27,16 +98,10 @@ def visualize_HiC_triangle(HiC, output, fig_size=(12, 6.5),
 
         No return. Save a figure only.
         """
-    if isinstance(HiC, sp.csr_matrix):
-        HiC = HiC.toarray()
-
-    N = len(HiC)
-    coordinate = np.array([[[(x + y) / 2, y - x] for y in range(N + 1)] for x in range(N + 1)])
-    X, Y = coordinate[:, :, 0], coordinate[:, :, 1]
-    vmax = vmax if vmax is not None else np.max(HiC)
-
+    import matplotlib.pyplot as plt
+    N = HiC.shape[0]
     fig, ax = plt.subplots(figsize=fig_size)
-    im = plt.pcolormesh(X, Y, HiC, vmin=vmin, vmax=vmax, cmap=cmap)
+    im = _plot_triangle(ax, HiC, vmin=vmin, vmax=vmax, cmap=cmap)
     # plt.axis('off')
     plt.yticks([], [])
     ax.spines['right'].set_visible(False)
@@ -86,6 +151,8 @@ def visualize_HiC_square(HiC, output, fig_size=(12, 6.5),
 
         No return. Save a figure only.
         """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     if isinstance(HiC, sp.csr_matrix):
         HiC = HiC.toarray()
 
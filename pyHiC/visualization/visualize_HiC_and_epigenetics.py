@@ -4,9 +4,7 @@ Visualize matched HiC and epigenetic signals in one figure
 @author: Fan Feng
 """
 import numpy as np
-import scipy.sparse as sp
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
+from .visualize_HiC import _plot_triangle
 
 
 def visualize_HiC_epigenetics(HiC, epis, output, fig_width=12.0,
@@ -19,12 +17,13 @@ def visualize_HiC_epigenetics(HiC, epis, output, fig_width=12.0,
     """
     Visualize matched HiC and epigenetic signals in one figure
     Args:
-        HiC (numpy.array): Hi-C contact map, only upper triangle is used.
+        HiC (numpy.array or scipy.sparse.csr_matrix or pyHiC.utils.BandMatrix): Hi-C contact map,
+            only upper triangle is used. Sparse and band maps are rasterized without densifying them.
         epis (list): epigenetic signals
         output (str): the output path. Must in a proper format (e.g., 'png', 'pdf', 'svg', ...).
         fig_width (float): the width of the figure. Then the height will be automatically calculated. Default: 12.0
         vmin (float): min value of the colormap. Default: 0
-        vmax (float): max value of the colormap. Will use the max value in Hi-C data if not specified.
+        vmax (float): max value of the colormap. Will use the max value of the drawn (rasterized) image if not specified.
         cmap (str or plt.cm): which colormap to use. Default: 'Reds'
         colorbar (bool): whether to add colorbar for the heatmap. Default: True
         colorbar_orientation (str): "horizontal" or "vertical". Default: "vertical"
@@ -40,14 +39,13 @@ def visualize_HiC_epigenetics(HiC, epis, output, fig_width=12.0,
 
     No return. Save a figure only.
     """
-    if isinstance(HiC, sp.csr_matrix):
-        HiC = HiC.toarray()
-
+    import matplotlib.pyplot as plt
+    from matplotlib.gridspec import GridSpec
     # Make sure the lengths match
     len_epis = [len(epi) for epi in epis]
-    if max(len_epis) != min(len_epis) or max(len_epis) != len(HiC):
+    if max(len_epis) != min(len_epis) or max(len_epis) != HiC.shape[0]:
         raise ValueError('Size not matched!')
-    N = len(HiC)
+    N = HiC.shape[0]
 
     # Define the space for each row (heatmap - interval - signal - interval - signal ...)
     rs = [heatmap_ratio, interval_after_heatmap] + [epi_ratio, interval_between_epi] * len(epis)
@@ -63,15 +61,9 @@ def visualize_HiC_epigenetics(HiC, epis, output, fig_width=12.0,
 
     # Ready for plotting heatmap
     ax0 = plt.subplot(gs[0, :])
-    # Define the rotated axes and coordinates
-    coordinate = np.array([[[(x + y) / 2, y - x] for y in range(N + 1)] for x in range(N + 1)])
-    X, Y = coordinate[:, :, 0], coordinate[:, :, 1]
-    # Plot the heatmap
-    vmax = vmax if vmax is not None else np.max(HiC)
-    im = ax0.pcolormesh(X, Y, HiC, vmin=vmin, vmax=vmax, cmap=cmap)
+    # Plot the heatmap, rotated by 45 degrees
+    im = _plot_triangle(ax0, HiC, vmin=vmin, vmax=vmax, cmap=cmap)
     ax0.axis('off')
-    ax0.set_ylim([0, N])
-    ax0.set_xlim([0, N])
     if colorbar:
         if colorbar_orientation == 'horizontal':
             _left, _width, _bottom, _height = 0.12, 0.25, 1 - rs[0] * 0.25, rs[0] * 0.03
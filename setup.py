@@ -31,6 +31,9 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=install_requires,
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['pyhic=pyHiC.pipeline:main'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
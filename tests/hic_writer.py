@@ -0,0 +1,183 @@
+"""
+A small writer of .hic files (versions 6 - 9), only for testing pyHiC.loading.HiCFile.
+
+It follows the layout described in pyHiC/loading/hic.py. To cover every branch of the reader, the encoding of
+each block depends on its number: dense (block_type 2) blocks, 32-bit counts and, in version 9, 32-bit bins
+are mixed with the default sparse 16-bit blocks. Intra-chromosomal blocks of version 9 are numbered by their
+position along the diagonal and their depth, as in Juicer.
+"""
+
+import zlib
+import struct
+import numpy as np
+
+
+def _string(x):
+    return x.encode() + b'\x00'
+
+
+def _int8(x):
+    return struct.pack('<b', int(x))
+
+
+def _int16(x):
+    return struct.pack('<h', int(x))
+
+
+def _int32(x):
+    return struct.pack('<i', int(x))
+
+
+def _int64(x):
+    return struct.pack('<q', int(x))
+
+
+def _float32(x):
+    return struct.pack('<f', float(x))
+
+
+def _float64(x):
+    return struct.pack('<d', float(x))
+
+
+def _encode_block(version, x, y, v, number, stats):
+    """Records (binX, binY, count) of one block, before compression."""
+    n = len(v)
+    if version < 7:
+        return _int32(n) + b''.join(_int32(a) + _int32(b) + _float32(c) for a, b, c in zip(x, y, v))
+    x0, y0 = int(x.min()), int(y.min())
+    integer = np.all(v == np.round(v)) and v.max() < 32767
+    short_count = integer and number % 5 != 4
+    short_x, short_y = (number % 2 == 0, number % 3 != 1) if version > 8 else (True, True)
+    count = _int16 if short_count else _float32
+    out = _int32(n) + _int32(x0) + _int32(y0) + _int8(0 if short_count else 1)
+    if version > 8:
+        out += _int8(0 if short_x else 1) + _int8(0 if short_y else 1)
+
+    if number % 3 == 0:
+        # Dense square, row by row (binY), with missing values
+        width, height = int(x.max()) - x0 + 1, int(y.max()) - y0 + 1
+        values = np.full((width * height,), -32768 if short_count else np.nan)
+        values[(y - y0) * width + (x - x0)] = v
+        stats['dense'] += 1
+        return out + _int8(2) + _int32(width * height) + _int16(width) + b''.join(count(c) for c in values)
+
+    write_y, write_x = (_int16 if short_y else _int32), (_int16 if short_x else _int32)
+    rows = np.unique(y)
+    out += _int8(1) + write_y(len(rows))
+    for row in rows:
+        sel = np.flatnonzero(y == row)
+        out += write_y(row - y0) + write_x(len(sel))
+        for k in sel:
+            out += write_x(x[k] - x0) + count(v[k])
+    stats['sparse'] += 1
+    return out
+
+
+def _block_numbers(version, x, y, intra, block_bin_count, n_columns):
+    if intra and version > 8:
+        depth = np.floor(np.log2(1 + np.abs(x - y) / np.sqrt(2) / block_bin_count)).astype(np.int64)
+        return depth * n_columns + (x + y) // 2 // block_bin_count
+    return (y // block_bin_count) * n_columns + x // block_bin_count
+
+
+def make_hic(path, version, chroms, resolutions, contacts, norms=None, block_bin_count=7):
+    """
+    Write a .hic file.
+
+    Args:
+        path (str): output file
+        version (int): 6 - 9
+        chroms (list): [(chromosome, length (bp))]
+        resolutions (list): base-pair resolutions
+        contacts (dict): {(chromosome1, chromosome2): (pos1, pos2, count)}; each pair of chromosomes at most once
+        norms (dict or None): {(type, chromosome, resolution): vector}. Default: None
+        block_bin_count (int): width (in bins) of a block. Default: 7
+
+    Return:
+        dict: number of "sparse" and "dense" blocks written
+    """
+    names = ['All'] + [ch for ch, _ in chroms]
+    lengths = dict(chroms)
+    wide = version > 8
+    stats = {'sparse': 0, 'dense': 0}
+
+    buf = bytearray(b'HIC\x00' + _int32(version))
+    footer_slot = len(buf)
+    buf += _int64(0) + _string('test_genome')
+    if wide:
+        norm_index_slot = len(buf)
+        buf += _int64(0) + _int64(0)
+    buf += _int32(1) + _string('software') + _string('hic_writer')
+    buf += _int32(len(names))
+    for name in names:
+        length = lengths.get(name, sum(lengths.values()) // 1000)
+        buf += _string(name) + (_int64(length) if wide else _int32(length))
+    buf += _int32(len(resolutions)) + b''.join(_int32(r) for r in resolutions)
+    # No fragment resolutions
+    buf += _int32(0)
+
+    master = {}
+    for (c1, c2), (p1, p2, counts) in contacts.items():
+        i, j = names.index(c1), names.index(c2)
+        if i > j:
+            i, j, p1, p2 = j, i, p2, p1
+        zooms = []
+        for resolution in resolutions:
+            x, y = p1 // resolution, p2 // resolution
+            if i == j:
+                x, y = np.minimum(x, y), np.maximum(x, y)
+            n = max(lengths[names[i]], lengths[names[j]]) // resolution + 1
+            keys, inverse = np.unique(x * n + y, return_inverse=True)
+            values = np.bincount(inverse, weights=counts)
+            x, y = keys // n, keys % n
+            n_columns = n // block_bin_count + 1
+            numbers = _block_numbers(version, x, y, i == j, block_bin_count, n_columns)
+            blocks = {}
+            for number in np.unique(numbers):
+                sel = numbers == number
+                data = zlib.compress(_encode_block(version, x[sel], y[sel], values[sel], int(number), stats))
+                blocks[int(number)] = (len(buf), len(data))
+                buf += data
+            zooms.append((resolution, n_columns, blocks))
+        master['{0}_{1}'.format(i, j)] = len(buf)
+        buf += _int32(i) + _int32(j) + _int32(len(zooms))
+        for k, (resolution, n_columns, blocks) in enumerate(zooms):
+            buf += _string('BP') + _int32(k) + _float32(1) * 4
+            buf += _int32(resolution) + _int32(block_bin_count) + _int32(n_columns) + _int32(len(blocks))
+            for number, (position, size) in sorted(blocks.items()):
+                buf += _int32(number) + _int64(position) + _int32(size)
+
+    struct.pack_into('<q', buf, footer_slot, len(buf))
+    value = _float32 if wide else _float64
+    length = _int64 if wide else _int32
+    buf += length(0) + _int32(len(master))
+    for key, position in master.items():
+        buf += _string(key) + _int64(position) + _int32(100)
+    # Expected values (with one chromosome scale factor) and normalized expected values
+    buf += _int32(1) + _string('BP') + _int32(resolutions[0]) + length(3) + value(1) + value(.5) + value(.25)
+    buf += _int32(1) + _int32(1) + value(1.0)
+    buf += _int32(1) + _string('KR') + _string('BP') + _int32(resolutions[0]) + length(2) + value(1) + value(.5)
+    buf += _int32(0)
+
+    # Normalization vector index, then the vectors
+    norms = norms or {}
+    norm_index = len(buf)
+    # chromosome, unit, resolution, position and size of each vector
+    entry_size = 4 + len(_string('BP')) + 4 + 8 + (8 if wide else 4)
+    index_size = 4 + sum(len(_string(norm)) + entry_size for norm, _, _ in norms)
+    entries, vectors = b'', b''
+    for (norm, ch, resolution), vector in norms.items():
+        data = length(len(vector)) + b''.join(value(a) for a in vector)
+        entries += _string(norm) + _int32(names.index(ch)) + _string('BP') + _int32(resolution)
+        entries += _int64(norm_index + index_size + len(vectors)) + (_int64 if wide else _int32)(len(data))
+        vectors += data
+    buf += _int32(len(norms)) + entries
+    assert len(buf) == norm_index + index_size
+    buf += vectors
+    if wide:
+        struct.pack_into('<qq', buf, norm_index_slot, norm_index, index_size)
+
+    with open(path, 'wb') as f:
+        f.write(bytes(buf))
+    return stats
@@ -0,0 +1,60 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from pyHiC.loading.store import write_store
+from pyHiC.normalization import genome_bias, split_bias, ICE_bias, KR_bias
+
+SIZES = {'chr1': 60, 'chr2': 40}
+
+
+def _intra(rng, n):
+    d = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+    mat = rng.poisson(200.0 / (d + 1)).astype(float) + 1
+    return np.triu(mat) + np.triu(mat, 1).T
+
+
+@pytest.fixture(scope='module')
+def genome(tmp_path_factory):
+    """A store with two chromosomes and their inter-chromosomal block, and the assembled genome-wide map."""
+    rng = np.random.default_rng(0)
+    intra = {ch: _intra(rng, n) for ch, n in SIZES.items()}
+    inter = rng.poisson(2.0, size=(SIZES['chr1'], SIZES['chr2'])).astype(float) + 1
+    path = str(tmp_path_factory.mktemp('genome') / 'contacts.store')
+    write_store(path, {ch: sp.csr_matrix(m) for ch, m in intra.items()},
+                {('chr1', 'chr2'): sp.csr_matrix(inter)}, resolution=10000)
+    full = np.block([[intra['chr1'], inter], [inter.T, intra['chr2']]])
+    return path, intra, full
+
+
+def _scaled(bias):
+    return bias / np.mean(bias)
+
+
+@pytest.mark.parametrize('method', ['ICE', 'KR'])
+def test_workers_agree(genome, method):
+    path = genome[0]
+    # Small chunks: several chunks per block, split across the workers
+    single = genome_bias(path, method, chunk_size=300, n_workers=1, tolerance=1e-8, max_iteration=500)
+    parallel = genome_bias(path, method, chunk_size=300, n_workers=2, tolerance=1e-8, max_iteration=500)
+    assert np.allclose(single, parallel, rtol=1e-10)
+
+
+@pytest.mark.parametrize('method, func', [('ICE', ICE_bias), ('KR', KR_bias)])
+def test_matches_genome_wide_matrix(genome, method, func):
+    path, _, full = genome
+    bias = genome_bias(path, method, chunk_size=300, n_workers=2, tolerance=1e-8, max_iteration=500)
+    expected = func(full, max_iteration=500, tolerance=1e-8)
+    assert np.allclose(_scaled(bias), _scaled(expected), rtol=1e-5)
+    # The balanced map has equal row sums
+    sums = (full / np.outer(bias, bias)).sum(axis=1)
+    assert np.allclose(sums, sums.mean(), rtol=1e-5)
+
+
+@pytest.mark.parametrize('method, func', [('ICE', ICE_bias), ('KR', KR_bias)])
+def test_cis_only_matches_each_chromosome(genome, method, func):
+    path, intra, _ = genome
+    bias = genome_bias(path, method, trans=False, chunk_size=300, n_workers=2, tolerance=1e-8, max_iteration=500)
+    parts = split_bias(bias, path)
+    for ch, mat in intra.items():
+        expected = func(mat, max_iteration=500, tolerance=1e-8)
+        assert np.allclose(_scaled(parts[ch]), _scaled(expected), rtol=1e-5)
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+from pyHiC.loading import HiCFile, load_HiC
+from hic_writer import make_hic
+
+SIZES = {'chr1': 2000000, 'chr2': 1300000, 'chr3': 900000}
+RESOLUTIONS = [25000, 50000, 100000]
+VERSIONS = [6, 7, 8, 9]
+
+
+def _contacts(rng):
+    """Read pairs of each pair of chromosomes: many near the diagonal, some anywhere (far from the diagonal)."""
+    contacts = {}
+    names = list(SIZES)
+    for a, c1 in enumerate(names):
+        for c2 in names[a:]:
+            n = 3000 if c1 == c2 else 500
+            p1 = rng.integers(0, SIZES[c1], n)
+            if c1 == c2:
+                near = rng.random(n) < 0.7
+                p2 = np.where(near, np.clip(p1 + rng.integers(-200000, 200000, n), 0, SIZES[c1] - 1),
+                              rng.integers(0, SIZES[c1], n))
+            else:
+                p2 = rng.integers(0, SIZES[c2], n)
+            contacts[(c1, c2)] = (p1, p2, rng.integers(1, 5, n).astype(float))
+    # One pair stored the other way round (chromosome 3 before chromosome 1)
+    p1, p2, v = contacts.pop(('chr1', 'chr3'))
+    contacts[('chr3', 'chr1')] = (p2, p1, v)
+    return contacts
+
+
+def _reference(contacts, c1, c2, resolution):
+    """The full (symmetric for c1 == c2) contact map of two chromosomes."""
+    shape = (-(-SIZES[c1] // resolution), -(-SIZES[c2] // resolution))
+    mat = np.zeros(shape)
+    for (a, b), (p1, p2, v) in contacts.items():
+        if (a, b) == (c1, c2):
+            np.add.at(mat, (p1 // resolution, p2 // resolution), v)
+        elif (b, a) == (c1, c2):
+            np.add.at(mat, (p2 // resolution, p1 // resolution), v)
+    if c1 == c2:
+        mat = mat + mat.T - np.diag(np.diag(mat))
+    return mat
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    contacts = _contacts(rng)
+    norms = {('KR', 'chr1', 50000): rng.random(40) + 0.5,
+             ('VC', 'chr2', 25000): np.r_[rng.random(51) + 0.5, 0.0],
+             ('KR', 'chr3', 100000): rng.random(9) + 0.5}
+    folder = tmp_path_factory.mktemp('hic')
+    paths, stats = {}, {}
+    for version in VERSIONS:
+        paths[version] = str(folder / 'test_v{0}.hic'.format(version))
+        stats[version] = make_hic(paths[version], version, list(SIZES.items()), RESOLUTIONS, contacts, norms)
+    return paths, stats, contacts, norms
+
+
+@pytest.mark.parametrize('version', VERSIONS)
+def test_header(files, version):
+    hic = HiCFile(files[0][version])
+    assert hic.version == version
+    assert hic.chromosomes == SIZES
+    assert hic.resolutions == RESOLUTIONS
+    assert hic.norms == ['KR', 'VC']
+    if version > 6:
+        # Both block types are in the file
+        assert files[1][version]['dense'] > 0 and files[1][version]['sparse'] > 0
+
+
+@pytest.mark.parametrize('version', VERSIONS)
+def test_query_whole_chromosomes(files, version):
+    paths, _, contacts, _ = files
+    hic = HiCFile(paths[version])
+    for resolution in RESOLUTIONS:
+        for c1 in SIZES:
+            for c2 in SIZES:
+                got = hic.query(c1, chrom2=c2, resolution=resolution, sparse=False)
+                assert np.array_equal(got, _reference(contacts, c1, c2, resolution)), (c1, c2, resolution)
+
+
+@pytest.mark.parametrize('version', VERSIONS)
+def test_query_regions(files, version):
+    paths, _, contacts, _ = files
+    hic = HiCFile(paths[version])
+    rng = np.random.default_rng(version)
+    for resolution in RESOLUTIONS:
+        for c1 in SIZES:
+            for c2 in SIZES:
+                ref = _reference(contacts, c1, c2, resolution)
+                for _ in range(5):
+                    s1 = int(rng.integers(0, SIZES[c1]))
+                    e1 = int(rng.integers(s1 + 1, SIZES[c1] + resolution))
+                    s2 = int(rng.integers(0, SIZES[c2]))
+                    e2 = int(rng.integers(s2 + 1, SIZES[c2] + resolution))
+                    got = hic.query(c1, s1, e1, c2, s2, e2, resolution=resolution, sparse=False)
+                    expected = ref[s1 // resolution:-(-e1 // resolution), s2 // resolution:-(-e2 // resolution)]
+                    assert np.array_equal(got, expected), (c1, s1, e1, c2, s2, e2, resolution)
+
+
+@pytest.mark.parametrize('version', VERSIONS)
+def test_query_off_diagonal(files, version):
+    """Regions of one chromosome far from the diagonal (deep blocks of the version 9 numbering), both ways."""
+    paths, _, contacts, _ = files
+    hic = HiCFile(paths[version])
+    ref = _reference(contacts, 'chr1', 'chr1', 25000)
+    got = hic.query('chr1', 0, 400000, 'chr1', 1500000, 2000000, resolution=25000, sparse=False)
+    assert got.sum() > 0
+    assert np.array_equal(got, ref[:16, 60:80])
+    got = hic.query('chr1', 1500000, 2000000, '1', 0, 400000, resolution=25000, sparse=False)
+    assert np.array_equal(got, ref[60:80, :16])
+
+
+@pytest.mark.parametrize('version', VERSIONS)
+def test_load_HiC(files, version):
+    paths, _, contacts, _ = files
+    ref = _reference(contacts, 'chr2', 'chr2', 50000)
+    mat = load_HiC(paths[version], format='hic', chromosome='chr2', resolution=50000)
+    # Same output as the text formats: the explicit epsilon diagonal
+    assert np.allclose(mat.toarray(), ref + np.eye(len(ref)) * np.finfo(float).eps, rtol=0, atol=1e-12)
+    mat = load_HiC(paths[version], format='hic', chromosome='2', start_pos=200000, end_pos=1000000,
+                   resolution=50000, sparse=False)
+    assert np.allclose(mat, ref[4:20, 4:20])
+    band = load_HiC(paths[version], format='hic', chromosome='chr2', resolution=50000, max_distance=150000)
+    assert band.n_diagonals == 4
+    assert np.allclose(band.strata(4)[3], np.diag(ref, 3))
+
+
+@pytest.mark.parametrize('version', VERSIONS)
+def test_norm_vector(files, version):
+    paths, _, _, norms = files
+    hic = HiCFile(paths[version])
+    assert np.allclose(hic.norm_vector('KR', 'chr1', 50000), norms[('KR', 'chr1', 50000)], rtol=1e-6)
+    assert np.allclose(hic.norm_vector('KR', 'chr3', 100000), norms[('KR', 'chr3', 100000)], rtol=1e-6)
+    # Zeros are removed bins (NaN)
+    vc = hic.norm_vector('VC', 'chr2', 25000)
+    assert len(vc) == 52 and np.isnan(vc[-1])
+    assert np.allclose(vc[:-1], norms[('VC', 'chr2', 25000)][:-1], rtol=1e-6)
+    mat, bias = load_HiC(paths[version], format='hic', chromosome='chr1', start_pos=500000, end_pos=1000000,
+                         resolution=50000, norm='KR')
+    assert mat.shape == (10, 10)
+    assert np.allclose(bias, norms[('KR', 'chr1', 50000)][10:20], rtol=1e-6)
+    with pytest.raises(ValueError):
+        hic.norm_vector('SCALE', 'chr1', 50000)
+    with pytest.raises(ValueError):
+        hic.query('chr1', resolution=10000)
@@ -0,0 +1,119 @@
+import gzip
+import warnings
+import numpy as np
+import pytest
+from pyHiC.loading import load_HiC, convert_to_store, ContactStore
+from pyHiC.loading.parsing import _read_table
+from pyHiC.utils import coarsen
+
+RESOLUTION = 10000
+LENGTHS = {'chr1': 1500000, 'chr2': 800000}
+EPS = np.finfo(float).eps
+
+
+def _contacts(rng, n=5000):
+    """Random (chromosome, position 1, position 2, score) contacts, mostly near the diagonal."""
+    contacts = {}
+    for ch, length in LENGTHS.items():
+        p1 = rng.integers(0, length, n)
+        p2 = np.clip(p1 + rng.integers(-300000, 300000, n), 0, length - 1)
+        # Make the last bin non-empty, so that the loaded map covers the whole chromosome
+        p1[0], p2[0] = length - 1, length - 1
+        contacts[ch] = (p1, p2, rng.integers(1, 10, n).astype(float))
+    return contacts
+
+
+def _reference(p1, p2, v, start=0, end=None, resolution=RESOLUTION):
+    """The dense symmetric map of the contacts within [start, end), each contact counted once."""
+    end = max(p1.max(), p2.max()) + 1 if end is None else end
+    keep = (p1 >= start) & (p2 >= start) & (p1 < end) & (p2 < end)
+    n = -(-(end - start) // resolution)
+    b1, b2 = (p1[keep] - start) // resolution, (p2[keep] - start) // resolution
+    mat = np.zeros((n, n))
+    np.add.at(mat, (np.minimum(b1, b2), np.maximum(b1, b2)), v[keep])
+    return mat + np.triu(mat, 1).T
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    contacts = _contacts(rng)
+    folder = tmp_path_factory.mktemp('loading')
+    long_lines = ''.join('{0}\t{1}\t{0}\t{2}\t{3:g}\n'.format(ch, a, b, c)
+                         for ch, (p1, p2, v) in contacts.items() for a, b, c in zip(p1, p2, v))
+    p1, p2, v = contacts['chr1']
+    short_lines = ''.join('{0} {1} {2:g}\n'.format(a, b, c) for a, b, c in zip(p1, p2, v))
+    paths = {'long': str(folder / 'contacts.txt'), 'long_gz': str(folder / 'contacts.txt.gz'),
+             'short': str(folder / 'chr1.txt')}
+    with open(paths['long'], 'w') as f:
+        f.write(long_lines)
+    with gzip.open(paths['long_gz'], 'wt') as f:
+        f.write(long_lines)
+    with open(paths['short'], 'w') as f:
+        f.write(short_lines)
+    return paths, contacts, folder
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+@pytest.mark.parametrize('variant', ['long', 'long_gz', 'short'])
+def test_load_whole_chromosome(files, variant, n_workers):
+    paths, contacts, _ = files
+    fmt = 'short' if variant == 'short' else 'long'
+    mat = load_HiC(paths[variant], format=fmt, chromosome='chr1', resolution=RESOLUTION,
+                   gzip=variant == 'long_gz', n_workers=n_workers)
+    ref = _reference(*contacts['chr1'])
+    # The loaders keep an explicit (epsilon) diagonal
+    assert np.allclose(mat.toarray(), ref + np.eye(len(ref)) * EPS, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_load_region_and_band(files, n_workers):
+    paths, contacts, _ = files
+    ref = _reference(*contacts['chr2'], start=200000, end=650000)
+    mat = load_HiC(paths['long'], format='long', chromosome='chr2', start_pos=200000, end_pos=650000,
+                   resolution=RESOLUTION, sparse=False, n_workers=n_workers)
+    assert mat.shape == (45, 45)
+    assert np.allclose(mat, ref + np.eye(45) * EPS, rtol=0, atol=1e-12)
+    band = load_HiC(paths['long'], format='long', chromosome='chr2', start_pos=200000, end_pos=650000,
+                    resolution=RESOLUTION, max_distance=5 * RESOLUTION, n_workers=n_workers)
+    assert band.n_diagonals == 6
+    expected = np.triu(np.tril(ref, 5), -5)
+    assert np.allclose(band.toarray(), expected + np.eye(45) * EPS, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('factor', [2, 5])
+def test_coarsen_matches_coarse_loading(files, factor):
+    paths, _, _ = files
+    fine = load_HiC(paths['long'], format='long', chromosome='chr1', resolution=RESOLUTION)
+    coarse = load_HiC(paths['long'], format='long', chromosome='chr1', resolution=RESOLUTION * factor)
+    # Up to the epsilon diagonals
+    assert np.allclose(coarsen(fine, factor).toarray(), coarse.toarray(), rtol=0, atol=1e-12)
+
+
+def test_store_matches_load_HiC(files):
+    paths, contacts, folder = files
+    store_path = str(folder / 'contacts.store')
+    convert_to_store(paths['long'], store_path, format='long', resolution=RESOLUTION)
+    store = ContactStore(store_path)
+    for ch in LENGTHS:
+        loaded = load_HiC(paths['long'], format='long', chromosome=ch, resolution=RESOLUTION, sparse=False)
+        assert np.allclose(store.query(ch, sparse=False), loaded, rtol=0, atol=1e-12)
+        from_store = load_HiC(store_path, format='store', chromosome=ch, start_pos=300000, end_pos=700000,
+                              resolution=RESOLUTION, sparse=False)
+        assert np.allclose(from_store, loaded[30:70, 30:70], rtol=0, atol=1e-12)
+
+
+def test_read_table_short_lines():
+    # All lines have the same (too small) number of columns: skipped with a warning, as ragged short lines
+    lines = [b'chr1\t100\tchr1\n', b'chr1\t200\tchr1\n']
+    with pytest.warns(UserWarning, match='2 line'):
+        table = _read_table(lines, [1, 2, 3, 4, 5])
+    assert table.shape == (0, 5)
+    lines = [b'chr1\t100\tchr1\t300\t2\n', b'chr1\t200\tchr1\n', b'\n']
+    with pytest.warns(UserWarning, match='1 line'):
+        table = _read_table(lines, [1, 2, 3, 4, 5])
+    assert table.tolist() == [[b'chr1', b'100', b'chr1', b'300', b'2']]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        table = _read_table([b'1 2 3\n', b'4 5 6\n'], [0, 1, 0, 2, 3])
+    assert table.shape == (2, 3)
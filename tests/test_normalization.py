@@ -0,0 +1,103 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from pyHiC.normalization import normalization, expected_vector, apply_expected
+from pyHiC.utils import BandMatrix
+
+
+def _symmetric(rng, n):
+    d = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+    mat = rng.poisson(50.0 / (d + 1)).astype(float)
+    return np.triu(mat) + np.triu(mat, 1).T
+
+
+def _dense_oe(mat):
+    """Observed / expected with the mean of each diagonal, computed bin by bin."""
+    n = len(mat)
+    means = np.array([np.mean(np.diag(mat, d)) for d in range(n)])
+    means[means == 0] = 1
+    out = np.zeros_like(mat)
+    for i in range(n):
+        for j in range(n):
+            out[i, j] = mat[i, j] / means[abs(i - j)]
+    return out
+
+
+def test_oe_dense_sparse_band_agree():
+    """The sparse path used to count both triangles (half the dense OE values)."""
+    mat = _symmetric(np.random.default_rng(0), 40)
+    expected = _dense_oe(mat)
+    assert np.allclose(expected_vector(mat), [np.mean(np.diag(mat, d)) for d in range(40)])
+    assert np.allclose(expected_vector(sp.csr_matrix(mat)), expected_vector(mat))
+    assert np.allclose(normalization(mat.copy(), 'OE'), expected)
+    assert np.allclose(normalization(sp.csr_matrix(mat), 'OE').toarray(), expected)
+    band = normalization(BandMatrix.from_matrix(mat, 8), 'OE')
+    assert np.allclose(band.toarray(), np.triu(np.tril(expected, 7), -7))
+
+
+def test_apply_expected_region():
+    mat = _symmetric(np.random.default_rng(1), 40)
+    full = _dense_oe(mat)
+    expected = expected_vector(mat)
+    assert np.allclose(apply_expected(mat[5:20, 25:38], expected, start=5, start2=25), full[5:20, 25:38])
+    got = apply_expected(sp.csr_matrix(mat[25:38, 5:20]), expected, start=25, start2=5)
+    assert np.allclose(got.toarray(), full[25:38, 5:20])
+
+
+@pytest.fixture(scope='module')
+def contact_map():
+    mat = _symmetric(np.random.default_rng(2), 50) + 1
+    # One removed (all-zero) bin
+    mat[7, :] = mat[:, 7] = 0
+    return mat
+
+
+def _balanced_reference(mat, bias):
+    """mat[i, j] / (bias[i] * bias[j]); removed (NaN) bins are all-zero."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = mat / np.outer(bias, bias)
+    return np.nan_to_num(out, nan=0.0)
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse'])
+@pytest.mark.parametrize('method, func', [('VC', lambda s: s), ('VC_SQRT', np.sqrt)])
+def test_coverage_normalizations(contact_map, kind, method, func):
+    mat = contact_map if kind == 'dense' else sp.csr_matrix(contact_map)
+    out, bias = normalization(mat, method, return_bias=True)
+    sums = contact_map.sum(axis=0)
+    expected_bias = np.where(sums == 0, np.nan, func(sums))
+    assert np.allclose(bias, expected_bias, equal_nan=True)
+    out = out.toarray() if sp.issparse(out) else out
+    assert np.allclose(out, _balanced_reference(contact_map, expected_bias))
+
+
+@pytest.mark.parametrize('method', ['VC', 'VC_SQRT'])
+def test_coverage_normalizations_band(contact_map, method):
+    """Row sums of a BandMatrix are taken over the stored band."""
+    band = BandMatrix.from_matrix(contact_map, 6)
+    truncated = np.triu(np.tril(contact_map, 5), -5)
+    out, bias = normalization(band, method, return_bias=True)
+    sums = truncated.sum(axis=0)
+    expected_bias = np.where(sums == 0, np.nan, sums if method == 'VC' else np.sqrt(sums))
+    assert np.allclose(bias, expected_bias, equal_nan=True)
+    assert np.allclose(out.toarray(), _balanced_reference(truncated, expected_bias))
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse', 'band'])
+@pytest.mark.parametrize('method', ['KR', 'IC'])
+def test_matrix_balancing(contact_map, kind, method):
+    """Balanced maps have equal row sums and are mat / (bias bias^T), whatever the input type."""
+    if kind == 'dense':
+        mat, dense = contact_map, contact_map
+    elif kind == 'sparse':
+        mat, dense = sp.csr_matrix(contact_map), contact_map
+    else:
+        mat = BandMatrix.from_matrix(contact_map, 10)
+        dense = np.triu(np.tril(contact_map, 9), -9)
+    out, bias = normalization(mat, method, return_bias=True, max_iteration=500, tolerance=1e-8)
+    out = out.toarray() if not isinstance(out, np.ndarray) else out
+    assert np.isnan(bias[7]) and np.all(np.isfinite(np.delete(bias, 7)))
+    assert np.allclose(out, _balanced_reference(dense, bias))
+    sums = np.delete(out.sum(axis=0), 7)
+    assert np.allclose(sums, sums.mean(), rtol=1e-5)
+    assert np.allclose(out[7], 0)
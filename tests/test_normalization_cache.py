@@ -0,0 +1,74 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from pyHiC.normalization import normalization, NormalizationCache, apply_expected, expected_vector
+from pyHiC.utils import BandMatrix
+
+
+def _map(n, seed=0):
+    rng = np.random.default_rng(seed)
+    mat = rng.poisson(50.0 / (np.abs(np.subtract.outer(np.arange(n), np.arange(n))) + 1)).astype(float) + 1
+    return np.triu(mat) + np.triu(mat, 1).T
+
+
+@pytest.fixture
+def source(tmp_path):
+    file = tmp_path / 'chr1.txt'
+    file.write_text('placeholder\n')
+    return str(file)
+
+
+def test_file_key_includes_region_and_shape(source):
+    cache = NormalizationCache()
+    full = _map(50)
+    key = dict(file=source, chromosome='chr1', resolution=10000)
+    a = normalization(sp.csr_matrix(full), 'VC', cache=cache, cache_key=key)
+    # A smaller region of the same file is not the whole chromosome
+    region = full[10:40, 10:40]
+    b = normalization(region, 'VC', cache=cache, cache_key=dict(key, start=100000, end=400000))
+    assert np.allclose(b, normalization(region, 'VC'))
+    # A region of the same size at another offset
+    other = full[20:50, 20:50]
+    c = normalization(other, 'VC', cache=cache, cache_key=dict(key, start=200000, end=500000))
+    assert np.allclose(c, normalization(other, 'VC'))
+    # A band of the whole chromosome
+    band = BandMatrix.from_matrix(full, 5)
+    d = normalization(band, 'VC', cache=cache, cache_key=key)
+    assert np.allclose(d.data, normalization(band, 'VC').data)
+    assert cache.stats()['misses'] == 4
+    # The same input again
+    normalization(sp.csr_matrix(full), 'VC', cache=cache, cache_key=key)
+    assert cache.stats()['hits'] == 1
+    assert np.allclose(a.toarray(), normalization(full, 'VC'))
+
+
+def test_wrong_cached_vector_raises(source):
+    cache = NormalizationCache()
+    full = _map(50)
+    key = dict(file=source, chromosome='chr1', resolution=10000)
+    normalization(full, 'KR', cache=cache, cache_key=key)
+    # Plant a vector of the wrong length under the key of a 50-bin map
+    cache.put(next(iter(cache._memory)), np.ones((30,)))
+    with pytest.raises(ValueError):
+        normalization(full, 'KR', cache=cache, cache_key=key)
+
+
+def test_cache_key_fields(source):
+    with pytest.raises(ValueError):
+        normalization(_map(10), 'VC', cache=NormalizationCache(), cache_key=dict(file=source, method='KR'))
+
+
+def test_verbose_not_in_key():
+    cache = NormalizationCache()
+    mat = _map(30)
+    normalization(mat, 'KR', cache=cache, verbose=1)
+    normalization(mat, 'KR', cache=cache, verbose=0)
+    assert cache.stats()['hits'] == 1
+
+
+def test_apply_expected_checks_length():
+    band = BandMatrix.from_matrix(_map(20), 6)
+    with pytest.raises(ValueError):
+        apply_expected(band, expected_vector(band)[:3])
+    with pytest.raises(ValueError):
+        apply_expected(_map(20), np.zeros((0,)))
@@ -0,0 +1,225 @@
+import gzip
+import numpy as np
+import pytest
+from pyHiC.loading.pairs import ingest_pairs, PairsFile, region_pairs, read_pairs_header
+from pyHiC.utils.instrument import add_callback, remove_callback
+
+# Not in alphabetical order: pairs are oriented by the order of the chromosome sizes
+SIZES = {'chr2': 300000, 'chr1': 500000, 'chr10': 200000}
+RANK = {ch: i for i, ch in enumerate(SIZES)}
+HEADER = '## pairs format v1.0\n' + ''.join('#chromsize: {0} {1}\n'.format(k, v) for k, v in SIZES.items()) + \
+    '#columns: readID chr1 pos1 chr2 pos2 strand1 strand2\n'
+
+
+def _random_pairs(rng, n=6000):
+    """0-based pairs in random order and orientation: mostly intra-chromosomal and close, some trans."""
+    names = list(SIZES)
+    c1 = rng.choice(names, n, p=[0.3, 0.5, 0.2])
+    trans = rng.random(n) < 0.15
+    c2 = np.where(trans, rng.choice(names, n), c1)
+    length1 = np.array([SIZES[c] for c in c1])
+    length2 = np.array([SIZES[c] for c in c2])
+    p1 = rng.integers(0, length1)
+    near = np.clip(p1 + rng.integers(-30000, 30000, n), 0, length2 - 1)
+    p2 = np.where(~trans & (rng.random(n) < 0.7), near, rng.integers(0, length2))
+    return c1, p1, c2, p2
+
+
+def _lines(pairs):
+    return ''.join('r{0}\t{1}\t{2}\t{3}\t{4}\t+\t-\n'.format(i, a, b + 1, c, d + 1)
+                   for i, (a, b, c, d) in enumerate(zip(*pairs)))
+
+
+def _oriented(pairs):
+    c1, p1, c2, p2 = pairs
+    r1, r2 = np.array([RANK[c] for c in c1]), np.array([RANK[c] for c in c2])
+    swap = (r1 > r2) | ((c1 == c2) & (p1 > p2))
+    return np.where(swap, c2, c1), np.where(swap, p2, p1), np.where(swap, c1, c2), np.where(swap, p1, p2)
+
+
+def _reference(pairs, resolution):
+    """Dense maps (symmetric intra maps, oriented inter maps) binned directly."""
+    c1, p1, c2, p2 = _oriented(pairs)
+    n_bins = {ch: -(-length // resolution) for ch, length in SIZES.items()}
+    intra, inter = {}, {}
+    for a in SIZES:
+        for b in SIZES:
+            sel = (c1 == a) & (c2 == b)
+            if a == b:
+                mat = np.zeros((n_bins[a], n_bins[a]))
+                np.add.at(mat, (p1[sel] // resolution, p2[sel] // resolution), 1)
+                intra[a] = mat + np.triu(mat, 1).T
+            elif RANK[a] < RANK[b] and sel.any():
+                mat = np.zeros((n_bins[a], n_bins[b]))
+                np.add.at(mat, (p1[sel] // resolution, p2[sel] // resolution), 1)
+                inter[(a, b)] = mat
+    return intra, inter
+
+
+def _check(result, pairs, resolution):
+    intra, inter = result
+    ref_intra, ref_inter = _reference(pairs, resolution)
+    assert list(intra) == list(SIZES)
+    for ch in SIZES:
+        # The loaders keep an explicit (epsilon) diagonal
+        expected = ref_intra[ch] + np.eye(len(ref_intra[ch])) * np.finfo(float).eps
+        assert np.allclose(intra[ch].toarray(), expected, rtol=0, atol=1e-12), (ch, resolution)
+    assert sorted(inter) == sorted(ref_inter)
+    for key in ref_inter:
+        assert np.array_equal(inter[key].toarray(), ref_inter[key]), (key, resolution)
+
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    pairs = _random_pairs(rng)
+    folder = tmp_path_factory.mktemp('pairs')
+    body = _lines(pairs)
+    files = {'plain': str(folder / 'unsorted.pairs'), 'gzip': str(folder / 'unsorted.pairs.gz'),
+             'no_header': str(folder / 'no_header.pairs')}
+    with open(files['plain'], 'w') as f:
+        f.write(HEADER + body)
+    with gzip.open(files['gzip'], 'wt') as f:
+        f.write(HEADER + body)
+    with open(files['no_header'], 'w') as f:
+        f.write(body)
+    # A sorted copy written with small runs and blocks: the runs are merged
+    events = []
+
+    def _listen(event, fields):
+        events.append((event, fields))
+    add_callback(_listen)
+    try:
+        files['sorted'] = str(folder / 'sorted.pairs.gz')
+        results = ingest_pairs(files['gzip'], [10000], sorted_copy=files['sorted'],
+                               run_lines=500, block_lines=300, block_size=8192)
+    finally:
+        remove_callback(_listen)
+    return {'pairs': pairs, 'files': files, 'folder': folder, 'events': events, 'sorted_results': results}
+
+
+@pytest.mark.parametrize('variant', ['plain', 'gzip'])
+def test_ingest_unsorted(data, variant):
+    result = ingest_pairs(data['files'][variant], [10000])
+    _check(result[10000], data['pairs'], 10000)
+
+
+def test_ingest_workers(data):
+    result = ingest_pairs(data['files']['gzip'], [10000, 25000], n_workers=3, block_size=16384)
+    for res in [10000, 25000]:
+        _check(result[res], data['pairs'], res)
+
+
+def test_coarsened_resolutions(data):
+    """10000 and 30000 are coarsened from 5000; 7000 is binned directly; all match direct binning."""
+    resolutions = [5000, 7000, 10000, 30000]
+    result = ingest_pairs(data['files']['plain'], resolutions)
+    for res in resolutions:
+        _check(result[res], data['pairs'], res)
+        direct = ingest_pairs(data['files']['plain'], [res])[res]
+        for ch in SIZES:
+            assert np.allclose(result[res][0][ch].toarray(), direct[0][ch].toarray(), rtol=0, atol=1e-12)
+
+
+def test_no_header_cis_only(data):
+    # Without sizes, chromosomes are ranked by name and sized by their largest positions
+    result = ingest_pairs(data['files']['no_header'], [10000], inter=False)[10000]
+    assert list(result) == sorted(SIZES)
+    ref = _reference(data['pairs'], 10000)[0]
+    for ch, mat in result.items():
+        n = mat.shape[0]
+        assert n <= ref[ch].shape[0]
+        assert np.allclose(mat.toarray(), ref[ch][:n, :n] + np.eye(n) * np.finfo(float).eps, rtol=0, atol=1e-12)
+        assert ref[ch][n:].sum() < 1e-10
+
+
+def test_sorted_copy(data):
+    # Several runs were merged
+    assert any(event == 'phase' and fields['name'] == 'ingest_pairs.merge' and fields['runs'] > 1
+               for event, fields in data['events'])
+    _check(data['sorted_results'][10000], data['pairs'], 10000)
+    # The copy is a valid .pairs.gz: same header, every pair once, sorted by chromosome pair and position
+    sorted_file = data['files']['sorted']
+    header = read_pairs_header(sorted_file)
+    assert header['chromsizes'] == SIZES
+    with gzip.open(sorted_file, 'rt') as f:
+        rows = [line.split() for line in f if not line.startswith('#')]
+    assert len(rows) == len(data['pairs'][0])
+    # The lines are copied as they are; they are sorted by their oriented pairs
+    c1, p1, c2, p2 = _oriented((np.array([r[1] for r in rows]), np.array([int(r[2]) for r in rows]),
+                                np.array([r[3] for r in rows]), np.array([int(r[4]) for r in rows])))
+    keys = list(zip(c1, c2, p1, p2))
+    assert all((a[:2] != b[:2]) or a[2:] <= b[2:] for a, b in zip(keys, keys[1:]))
+    # The pairs of each chromosome pair are together
+    groups = [k[:2] for i, k in enumerate(keys) if i == 0 or k[:2] != keys[i - 1][:2]]
+    assert len(groups) == len(set(groups))
+    # A sorted input is written in one run, to the same bytes
+    copy = str(data['folder'] / 'copy.pairs.gz')
+    events = []
+
+    def _listen(event, fields):
+        events.append((event, fields))
+    add_callback(_listen)
+    try:
+        ingest_pairs(sorted_file, [10000], sorted_copy=copy, run_lines=500, block_lines=300, block_size=8192)
+    finally:
+        remove_callback(_listen)
+    assert not any(event == 'phase' and fields['name'] == 'ingest_pairs.merge' for event, fields in events)
+    with open(sorted_file, 'rb') as a, open(copy, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def _brute_pairs(pairs, chrom, start, end, chrom2, start2, end2):
+    """Oriented pairs between two regions, each once, as (position on chrom, position on chrom2)."""
+    c1, p1, c2, p2 = _oriented(pairs)
+    forward = (c1 == chrom) & (p1 >= start) & (p1 < end) & (c2 == chrom2) & (p2 >= start2) & (p2 < end2)
+    backward = (c2 == chrom) & (p2 >= start) & (p2 < end) & (c1 == chrom2) & (p1 >= start2) & (p1 < end2)
+    backward &= ~forward
+    return sorted(zip(np.concatenate([p1[forward], p2[backward]]), np.concatenate([p2[forward], p1[backward]])))
+
+
+REGIONS = [('chr1', 100000, 300000, 'chr1', 100000, 300000),
+           ('chr1', 0, 150000, 'chr1', 120000, 400000),
+           ('chr1', 350000, 500000, 'chr1', 0, 100000),
+           ('chr10', 20000, 150000, 'chr1', 100000, 350000),
+           ('chr1', 100000, 350000, 'chr10', 20000, 150000),
+           ('chr2', 0, 300000, 'chr10', 0, 200000)]
+
+
+@pytest.mark.parametrize('region', REGIONS)
+def test_pairs_query(data, region):
+    pf = PairsFile(data['files']['sorted'])
+    p1, p2 = pf.pairs(*region)
+    assert sorted(zip(p1, p2)) == _brute_pairs(data['pairs'], *region)
+
+
+@pytest.mark.parametrize('region', REGIONS + [('chr2', 0, -1, None, None, None)])
+@pytest.mark.parametrize('resolution', [10000, 25000])
+def test_matrix_query(data, region, resolution):
+    """PairsFile.query against the symmetric dense genome-wide map, at a resolution which was not ingested."""
+    pf = PairsFile(data['files']['sorted'])
+    chrom, start, end, chrom2, start2, end2 = region
+    got = pf.query(chrom, start, end, chrom2, start2, end2, resolution=resolution, sparse=False)
+    intra, inter = _reference(data['pairs'], resolution)
+    chrom2 = chrom if chrom2 is None else chrom2
+    if chrom == chrom2:
+        full = intra[chrom]
+    else:
+        full = inter[(chrom, chrom2)] if (chrom, chrom2) in inter else inter[(chrom2, chrom)].T
+    end = SIZES[chrom] if end == -1 else end
+    if start2 is None:
+        start2, end2 = start, end
+    expected = full[start // resolution:-(-end // resolution), start2 // resolution:-(-end2 // resolution)]
+    assert np.array_equal(got, expected)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_region_pairs(data, n_workers):
+    expected = [(a, b) for a, b in _brute_pairs(data['pairs'], 'chr1', 50000, 250000, 'chr1', 50000, 250000)
+                if a <= b]
+    # Without an index, the file is read
+    p1, p2 = region_pairs(data['files']['gzip'], 'chr1', 50000, 250000, n_workers=n_workers)
+    assert sorted(zip(p1, p2)) == expected
+    # With the index of the sorted copy
+    p1, p2 = region_pairs(data['files']['sorted'], 'chr1', 50000, 250000)
+    assert sorted(zip(p1, p2)) == expected
@@ -0,0 +1,92 @@
+import os
+import json
+import numpy as np
+from pyHiC.pipeline import run_pipeline, main
+from pyHiC.loading import ContactStore
+from pyHiC.benchmarks.synthetic import synthetic_contacts, write_contacts
+from pyHiC.utils.instrument import add_callback, remove_callback
+
+
+def _write_sizes(file, sizes):
+    with open(file, 'w') as f:
+        for ch, length in sizes.items():
+            f.write('{0}\t{1}\n'.format(ch, length))
+
+
+def _statuses(report):
+    return {(label, stage): status for label, stage, status, _ in report}
+
+
+def _setup(tmp_path):
+    sizes = {'chr1': 2000000, 'chr2': 1500000}
+    write_contacts(synthetic_contacts(sizes, n_contacts=20000, seed=0), str(tmp_path / 'sample.txt'))
+    _write_sizes(str(tmp_path / 'chrom.sizes'), sizes)
+    config = {
+        'output': 'results',
+        'resolution': 100000,
+        'chrom_sizes': 'chrom.sizes',
+        'samples': {'S': {'file': 'sample.txt', 'format': 'long'}},
+        'normalize': {'method': 'ICE'},
+        'insulation': {'windows': 3},
+    }
+    config_file = str(tmp_path / 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    return config_file, sizes
+
+
+def test_pipeline_runs_then_skips(tmp_path):
+    config_file, sizes = _setup(tmp_path)
+    first = _statuses(run_pipeline(config_file, n_workers=2))
+    assert first[('S', 'load')] == 'done'
+    assert first[('S chr1', 'normalize')] == 'done'
+    assert first[('S chr2', 'insulation')] == 'done'
+    store = ContactStore(str(tmp_path / 'results' / 'S' / 'contacts.store'))
+    assert store.chromosomes == {ch: int(np.ceil(length / 100000)) for ch, length in sizes.items()}
+    assert os.path.exists(str(tmp_path / 'results' / 'S' / 'chr1' / 'insulation.npz'))
+
+    second = _statuses(run_pipeline(config_file, n_workers=2))
+    assert set(second.values()) == {'up to date'}
+
+    dry = _statuses(run_pipeline(config_file, n_workers=2, force=True, dry_run=True))
+    assert set(dry.values()) == {'to run'}
+
+
+def test_pipeline_reloads_after_chrom_sizes_change(tmp_path):
+    config_file, sizes = _setup(tmp_path)
+    run_pipeline(config_file, n_workers=2)
+
+    # A longer chr1: the store has more bins, so it and everything after it must be rebuilt
+    sizes_file = str(tmp_path / 'chrom.sizes')
+    _write_sizes(sizes_file, dict(sizes, chr1=2500000))
+    newer = os.path.getmtime(str(tmp_path / 'results' / 'S' / 'contacts.store' / 'meta.json')) + 10
+    os.utime(sizes_file, (newer, newer))
+
+    rerun = _statuses(run_pipeline(config_file, n_workers=2))
+    assert rerun[('S', 'load')] == 'done'
+    assert rerun[('S chr1', 'normalize')] == 'done'
+    assert rerun[('S chr1', 'insulation')] == 'done'
+    store = ContactStore(str(tmp_path / 'results' / 'S' / 'contacts.store'))
+    assert store.chromosomes['chr1'] == 25
+
+
+def test_report_events_and_main(tmp_path, capsys):
+    config_file, _ = _setup(tmp_path)
+    events = []
+
+    def _listen(event, fields):
+        events.append((event, fields))
+    add_callback(_listen)
+    try:
+        report = run_pipeline(config_file, n_workers=2)
+    finally:
+        remove_callback(_listen)
+    # run_pipeline prints nothing: the stages are sent as events
+    assert capsys.readouterr().out == ''
+    stages = [(f['label'], f['stage'], f['status'], f['seconds']) for e, f in events if e == 'pipeline.stage']
+    assert stages == report
+    # The command prints the report
+    assert main(['run', config_file]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == len(report)
+    assert '[S] load: up to date' in lines
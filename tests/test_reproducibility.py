@@ -0,0 +1,105 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from pyHiC.reproducibility import HiCRep, HiCRepMatrix
+from pyHiC.reproducibility.reproducibility import smoothed_strata
+from pyHiC.utils import BandMatrix, smooothing
+from pyHiC.utils.instrument import add_callback, remove_callback
+
+SIZES = {'chr1': 80, 'chr2': 50}
+
+
+def _sample(rng, n):
+    d = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+    mat = rng.poisson(100.0 / (d + 1)).astype(float)
+    return np.triu(mat) + np.triu(mat, 1).T
+
+
+@pytest.fixture(scope='module')
+def samples():
+    rng = np.random.default_rng(0)
+    return {'rep{0}'.format(i): {ch: _sample(rng, n) for ch, n in SIZES.items()} for i in range(4)}
+
+
+def _dense_strata(mat, n_strata, h):
+    """Strata of the full dense map after the 2-D mean filter."""
+    smoothed = smooothing(mat, h) if h else mat
+    return [np.diag(smoothed, d) for d in range(n_strata)]
+
+
+@pytest.mark.parametrize('h', [0, 1, 2, 3])
+def test_smoothed_strata_match_dense(samples, h):
+    mat = samples['rep0']['chr1']
+    expected = _dense_strata(mat, 6, h)
+    for source in [mat, sp.csr_matrix(mat), BandMatrix.from_matrix(mat, 6 + h)]:
+        strata = smoothed_strata(source, n_strata=6, h=h)
+        assert len(strata) == 6
+        for d in range(6):
+            assert np.allclose(strata[d], expected[d]), (type(source), d)
+
+
+@pytest.mark.parametrize('vstran', [False, True])
+def test_score_matches_dense(samples, vstran):
+    """The score is the std * std * length -weighted mean of the Pearson correlations of the strata."""
+    from scipy.stats import rankdata
+    # Continuous noise: the ranks of tied values would depend on rounding
+    noise = np.random.default_rng(3).random((2, 50, 50))
+    m1, m2 = [samples[name]['chr2'] + e + e.T for name, e in zip(['rep0', 'rep1'], noise)]
+    s1, s2 = _dense_strata(m1, 5, 2), _dense_strata(m2, 5, 2)
+    if vstran:
+        s1, s2 = [rankdata(s) / len(s) for s in s1], [rankdata(s) / len(s) for s in s2]
+    weights = np.array([np.std(a) * np.std(b) * len(a) for a, b in zip(s1, s2)])
+    corrs = np.array([np.corrcoef(a, b)[0, 1] for a, b in zip(s1, s2)])
+    expected = np.sum(weights * corrs) / np.sum(weights)
+    assert np.isclose(HiCRep(m1, m2, n_strata=5, h=2, vstran=vstran), expected)
+    assert np.isclose(HiCRep(sp.csr_matrix(m1), BandMatrix.from_matrix(m2, 7), n_strata=5, h=2, vstran=vstran),
+                      expected)
+
+
+def _smoothed_samples(engine):
+    """Run engine.compute() and count the samples smoothed on each chromosome."""
+    counts = {}
+
+    def _listen(event, fields):
+        if event == 'phase' and fields['name'] == 'HiCRepMatrix.smooth':
+            counts[fields['chromosome']] = counts.get(fields['chromosome'], 0) + fields['samples']
+    add_callback(_listen)
+    try:
+        scores = engine.compute()
+    finally:
+        remove_callback(_listen)
+    return scores, counts
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_matrix_matches_pairwise(samples, n_workers):
+    engine = HiCRepMatrix(n_strata=5, h=1, n_workers=n_workers)
+    engine.add_samples(samples)
+    scores = engine.compute()
+    names = list(samples)
+    for ch in SIZES:
+        assert np.allclose(np.diag(scores[ch]), 1)
+        for i, a in enumerate(names):
+            for j, b in enumerate(names):
+                expected = HiCRep(samples[a][ch], samples[b][ch], n_strata=5, h=1)
+                assert np.isclose(scores[ch][i, j], expected), (ch, a, b)
+
+
+def test_strata_kept_in_memory(samples):
+    """Without a NormalizationCache, compute() after add_sample only smooths the new sample."""
+    names = list(samples)
+    engine = HiCRepMatrix(n_strata=5, h=1)
+    engine.add_samples({name: samples[name] for name in names[:3]})
+    _, counts = _smoothed_samples(engine)
+    assert counts == {ch: 3 for ch in SIZES}
+    engine.add_sample(names[3], samples[names[3]])
+    scores, counts = _smoothed_samples(engine)
+    assert counts == {ch: 1 for ch in SIZES}
+    # Nothing left to score
+    _, counts = _smoothed_samples(engine)
+    assert counts == {}
+
+    fresh = HiCRepMatrix(n_strata=5, h=1)
+    fresh.add_samples(samples)
+    for ch, mat in fresh.compute().items():
+        assert np.allclose(scores[ch], mat)
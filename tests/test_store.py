@@ -0,0 +1,68 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from pyHiC.loading.store import write_store, ContactStore
+
+SIZES = {'chr1': 70, 'chr2': 45, 'chr3': 30}
+RESOLUTION = 10000
+
+
+def _intra(rng, n):
+    """A sparse symmetric map, with some empty rows."""
+    mat = np.triu(rng.poisson(3.0, size=(n, n)) * (rng.random((n, n)) < 0.4)).astype(float)
+    mat[rng.choice(n, n // 10, replace=False)] = 0
+    return mat + np.triu(mat, 1).T
+
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    intra = {ch: _intra(rng, n) for ch, n in SIZES.items()}
+    inter = {('chr1', 'chr2'): rng.poisson(1.0, size=(70, 45)).astype(float),
+             ('chr2', 'chr3'): rng.poisson(1.0, size=(45, 30)).astype(float)}
+    path = str(tmp_path_factory.mktemp('store') / 'contacts.store')
+    write_store(path, {ch: sp.csr_matrix(m) for ch, m in intra.items()},
+                {key: sp.csr_matrix(m) for key, m in inter.items()}, resolution=RESOLUTION)
+    return ContactStore(path), intra, inter
+
+
+def _dense(intra, inter, c1, c2):
+    if c1 == c2:
+        return intra[c1]
+    return inter[(c1, c2)] if (c1, c2) in inter else inter[(c2, c1)].T
+
+
+def test_whole_chromosomes(store):
+    cs, intra, inter = store
+    for c1 in SIZES:
+        assert np.array_equal(cs.query(c1, sparse=False), intra[c1])
+    for c1, c2 in [('chr1', 'chr2'), ('chr2', 'chr1'), ('chr3', 'chr2')]:
+        assert np.array_equal(cs.query(c1, chrom2=c2, sparse=False), _dense(intra, inter, c1, c2))
+
+
+def test_regions(store):
+    cs, intra, inter = store
+    rng = np.random.default_rng(1)
+    for c1, c2 in [('chr1', 'chr1'), ('chr2', 'chr2'), ('chr1', 'chr2'), ('chr2', 'chr1'), ('chr3', 'chr2')]:
+        full = _dense(intra, inter, c1, c2)
+        for _ in range(30):
+            s1 = int(rng.integers(0, SIZES[c1])) * RESOLUTION
+            e1 = int(rng.integers(s1 // RESOLUTION + 1, SIZES[c1] + 1)) * RESOLUTION
+            s2 = int(rng.integers(0, SIZES[c2])) * RESOLUTION
+            e2 = int(rng.integers(s2 // RESOLUTION + 1, SIZES[c2] + 1)) * RESOLUTION
+            got = cs.query(c1, s1, e1, c2, s2, e2, sparse=False)
+            expected = full[s1 // RESOLUTION:e1 // RESOLUTION, s2 // RESOLUTION:e2 // RESOLUTION]
+            assert np.array_equal(got, expected), (c1, s1, e1, c2, s2, e2)
+
+
+@pytest.mark.parametrize('n_diagonals', [1, 3, 200])
+def test_band(store, n_diagonals):
+    cs, intra, _ = store
+    mat = intra['chr1'][10:60, 10:60]
+    b1, b2, v, n = cs.band('chr1', 10 * RESOLUTION, 60 * RESOLUTION, n_diagonals=n_diagonals)
+    assert n == 50
+    assert np.all((b2 >= b1) & (b2 - b1 < n_diagonals))
+    got = np.zeros((n, n))
+    got[b1, b2] = v
+    expected = np.triu(mat) - np.triu(mat, n_diagonals)
+    assert np.array_equal(got, expected)
@@ -0,0 +1,56 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from pyHiC.loading.store import write_store
+from pyHiC.structures import insulation_score, insulation_score_store
+from pyHiC.utils import BandMatrix
+
+
+@pytest.fixture(scope='module')
+def contact_map():
+    rng = np.random.default_rng(0)
+    n = 120
+    d = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+    mat = rng.poisson(80.0 / (d + 1)).astype(float)
+    mat = np.triu(mat) + np.triu(mat, 1).T
+    # Removed bins
+    for i in [0, 40, 41, 90]:
+        mat[i, :] = mat[:, i] = 0
+    return mat
+
+
+def _dense_insulation(mat, w, ignore_diags=1):
+    """Mean of the valid pixels in rows [i - w + 1, i] and columns [i, i + w - 1], pixel by pixel."""
+    n = len(mat)
+    valid = mat.sum(axis=0) > 0
+    score = np.full((n,), np.nan)
+    for i in range(n):
+        if not valid[i]:
+            continue
+        values = [mat[r, c] for r in range(max(i - w + 1, 0), i + 1) for c in range(i, min(i + w, n))
+                  if c - r >= ignore_diags and valid[r] and valid[c]]
+        if values:
+            score[i] = np.mean(values)
+    return score
+
+
+@pytest.mark.parametrize('ignore_diags', [1, 2])
+def test_insulation_matches_dense(contact_map, ignore_diags):
+    expected = {w: _dense_insulation(contact_map, w, ignore_diags) for w in [3, 5, 8]}
+    for mat in [contact_map, sp.csr_matrix(contact_map), BandMatrix.from_matrix(contact_map, 15)]:
+        scores = insulation_score(mat, windows=[3, 5, 8], ignore_diags=ignore_diags, normalize=False)
+        for w, score in scores.items():
+            assert np.allclose(score, expected[w], equal_nan=True), (type(mat), w)
+    normalized = insulation_score(contact_map, windows=5, ignore_diags=ignore_diags)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reference = np.log2(expected[5] / np.nanmedian(expected[5]))
+    assert np.allclose(normalized, reference, equal_nan=True)
+
+
+def test_insulation_store_matches_dense(contact_map, tmp_path):
+    path = str(tmp_path / 'contacts.store')
+    write_store(path, {'chr1': sp.csr_matrix(contact_map)}, resolution=10000)
+    # Chunks smaller than the map: the scores near the chunk borders need the margins
+    scores = insulation_score_store(path, 'chr1', windows=[3, 5], normalize=False, chunk_size=25)
+    for w in [3, 5]:
+        assert np.allclose(scores[w], _dense_insulation(contact_map, w), equal_nan=True)
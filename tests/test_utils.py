@@ -0,0 +1,62 @@
+import numpy as np
+import scipy.sparse as sp
+import pytest
+from pyHiC.utils import BandMatrix, coarsen, coarsen_resolutions
+
+
+def _block_sums(mat, factor):
+    """Sum every factor x factor block of a map (the last blocks may be smaller)."""
+    n1, n2 = -(-mat.shape[0] // factor), -(-mat.shape[1] // factor)
+    out = np.zeros((n1, n2))
+    for i in range(n1):
+        for j in range(n2):
+            out[i, j] = mat[i * factor:(i + 1) * factor, j * factor:(j + 1) * factor].sum()
+    return out
+
+
+def _symmetric_block_sums(mat, factor):
+    """The map binned at factor x the resolution: each contact (pixel of the upper triangle) is counted once."""
+    out = _block_sums(np.triu(mat), factor)
+    return np.triu(out) + np.triu(out, 1).T
+
+
+@pytest.fixture(scope='module')
+def maps():
+    rng = np.random.default_rng(0)
+    mat = rng.poisson(3.0, size=(53, 53)).astype(float)
+    symmetric = np.triu(mat) + np.triu(mat, 1).T
+    inter = rng.poisson(1.0, size=(53, 31)).astype(float)
+    return symmetric, inter
+
+
+@pytest.mark.parametrize('factor', [1, 2, 5, 10])
+def test_coarsen_matches_block_sums(maps, factor):
+    symmetric, inter = maps
+    expected = _symmetric_block_sums(symmetric, factor)
+    assert np.allclose(coarsen(symmetric, factor), expected)
+    assert np.allclose(coarsen(sp.csr_matrix(symmetric), factor).toarray(), expected)
+    assert np.allclose(coarsen(inter, factor), _block_sums(inter, factor))
+    assert np.allclose(coarsen(sp.csr_matrix(inter), factor).toarray(), _block_sums(inter, factor))
+
+
+def test_coarsen_band(maps):
+    """A band of k diagonals gives the first k // factor coarse diagonals, exactly."""
+    symmetric, _ = maps
+    band = coarsen(BandMatrix.from_matrix(symmetric, 12), 3)
+    assert band.n_diagonals == 4
+    expected = _symmetric_block_sums(np.triu(np.tril(symmetric, 11), -11), 3)
+    assert np.allclose(band.toarray(), np.triu(np.tril(expected, 3), -3))
+
+
+def test_coarsen_several_factors_and_bias(maps):
+    symmetric, _ = maps
+    bias = np.random.default_rng(1).random(53) + 0.5
+    bias[4] = np.nan
+    results = coarsen_resolutions(sp.csr_matrix(symmetric), 5000, [10000, 20000, 50000], bias=bias)
+    for res, (mat, coarse_bias) in results.items():
+        factor = res // 5000
+        assert np.allclose(mat.toarray(), _symmetric_block_sums(symmetric, factor))
+        expected_bias = [np.nansum(bias[i:i + factor]) for i in range(0, 53, factor)]
+        assert np.allclose(coarse_bias, expected_bias)
+    with pytest.raises(ValueError):
+        coarsen(symmetric, 0)